@@ -0,0 +1,435 @@
+# Asyncio scraping engine.
+#
+# Provider pages are fetched with an async http client and parsed without a
+# browser (see Provider_Page_Parser.py), so many pages can be in flight at
+# once from a single thread. Requests go through the RateController of their
+# host (see Rate_Control.py), the same one that paces the state pages and the
+# cached fetches made over http from threads. It paces the requests and caps
+# how many are in flight, raising both while the site answers quickly and
+# cutting them when it throttles, fails or slows down, so the engine runs as
+# fast as the site tolerates and no faster than `max_rate` requests a second.
+# Throttled and transient failures are retried with jittered exponential
+# backoff.
+#
+# State homepages and provider pages that can't be read over plain http are
+# still scraped with Selenium, one page at a time, in a worker thread. So is
+# everything else that blocks: the journal and page cache files and the
+# on_state_done callback, which builds the state's output.
+#
+# check_async_engine() runs the engine against a Stand_In_Server.py that
+# throttles and fails requests, offline and without a browser:
+#
+#   python3 Async_Scraper.py
+#
+
+# Python standard libs
+import asyncio
+import json
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+# 3rd party libs
+import httpx
+from selenium import webdriver
+
+# local module
+from Driver_Manager import DriverManager
+from Json_Stream import json_default
+from Page_Cache import PageCache
+from Provider_Page_Parser import HTTP_TIMEOUT, USER_AGENT, read_provider_page
+from Provider_Record import compact_provider
+from Rate_Control import DEFAULT_MAX_RATE, DEFAULT_RATE, DEFAULT_RETRIES, OK, FATAL, THROTTLED
+from Rate_Control import RateController, backoff_delay, classify, configure
+from Rate_Control import host_controller, retry_after
+from Scrape_Electrical_Providers import get_provider_info_retrying
+from Scrape_Electrical_Providers import read_state_provider_urls
+from Scrape_Electrical_Providers import sort_providers
+from Scrape_Electrical_Providers import table_row_limit
+from Scrape_Journal import ScrapeJournal
+from Scrape_Trace import complete, span
+
+DEFAULT_CONCURRENCY = 16   # most requests in flight per host
+WINDOW_POLL = 0.05          # seconds between looks at a full window
+
+# check_async_engine(): a stand-in site answering CHECK_CAPACITY requests a
+#  second, with tables on a single page so no provider needs the browser
+CHECK_STATES = [ 'AK', 'HI' ]
+CHECK_CAPACITY = 20
+CHECK_ERROR_RATE = 0.05
+CHECK_PAGE_SIZE = 1000
+
+
+class ScrapeMetrics:
+    '''Throughput and latency of the requests made by an engine.'''
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.latencies = []
+        self.errors = 0
+        self.bytes = 0
+
+    def record(self, latency: float, num_bytes: int, ok: bool) -> None:
+        self.latencies.append(latency)
+        self.bytes += num_bytes
+        if not ok:
+            self.errors += 1
+
+    def pages_per_second(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return len(self.latencies) / elapsed if elapsed > 0 else 0.0
+
+    def latency_percentile(self, percent: float) -> float:
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+
+    def summary(self) -> Dict:
+        return {
+            'pages': len(self.latencies),
+            'errors': self.errors,
+            'bytes': self.bytes,
+            'pages-per-second': round(self.pages_per_second(), 2),
+            'latency-p50': round(self.latency_percentile(50), 3),
+            'latency-p95': round(self.latency_percentile(95), 3),
+            'latency-max': round(max(self.latencies, default=0.0), 3),
+        }
+
+
+class AsyncScraper:
+    '''Fetch and parse provider pages concurrently, paced by the rate controller of each host.'''
+
+    def __init__(self, concurrency: int = DEFAULT_CONCURRENCY, retries: int = DEFAULT_RETRIES,
+            client: Optional[httpx.AsyncClient] = None):
+        self.retries = retries
+        self.client = client
+        self.metrics = ScrapeMetrics()
+
+        # woken whenever one of this scraper's requests finishes and a window may have room
+        self._window = asyncio.Condition()
+        self._limits = httpx.Limits(max_connections=concurrency,
+            max_keepalive_connections=concurrency)
+
+    async def __aenter__(self) -> 'AsyncScraper':
+        if self.client is None:
+            self.client = httpx.AsyncClient(headers={'User-Agent': USER_AGENT},
+                limits=self._limits, timeout=HTTP_TIMEOUT, follow_redirects=True)
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.client.aclose()
+
+    def control(self, url: str) -> RateController:
+        '''The controller of the host, shared with the http requests made from threads.'''
+        return host_controller(url)
+
+    async def _start(self, control: RateController) -> None:
+        # never block the event loop on the controller. Slots freed by requests
+        #  from other threads don't wake the condition, so look again now and then
+        while True:
+            wait = control.try_start()
+            if wait is not None:
+                break
+            async with self._window:
+                try:
+                    await asyncio.wait_for(self._window.wait(), WINDOW_POLL)
+                except asyncio.TimeoutError:
+                    pass
+        await asyncio.sleep(wait)
+
+    async def _finish(self, control: RateController, latency: Optional[float],
+            outcome: Optional[str], pause: Optional[float] = None) -> None:
+        control.finish(latency, outcome, pause)
+        async with self._window:
+            self._window.notify_all()
+
+    async def fetch(self, url: str) -> Optional[str]:
+        '''Fetch the html for a page, returns None if the request failed after its retries.'''
+        control = self.control(url)
+        track = asyncio.current_task().get_name()
+
+        for attempt in range(self.retries + 1):
+            await self._start(control)
+
+            response, error = None, None
+            start = time.monotonic()
+            traced = time.perf_counter()
+            try:
+                response = await self.client.get(url)
+            except httpx.HTTPError as err:
+                error = err
+            except BaseException:
+                # cancelled, give the slot back
+                await self._finish(control, None, None)
+                raise
+
+            latency = time.monotonic() - start
+            outcome = classify(response, error)
+            await self._finish(control, latency, outcome,
+                retry_after(response) if outcome == THROTTLED else None)
+
+            if outcome == OK:
+                self.metrics.record(latency, len(response.content), ok=True)
+                complete('http get', 'http', traced, track=track, url=url)
+                return response.text
+
+            failure = error or httpx.HTTPStatusError("{} for {}".format(response.status_code, url),
+                request=response.request, response=response)
+            self.metrics.record(latency, 0, ok=False)
+            complete('http get', 'http', traced, track=track, url=url, error=repr(failure))
+            if outcome == FATAL or attempt == self.retries:
+                print(failure, file=sys.stderr)
+                return None
+
+            delay = backoff_delay(attempt)
+            print("{}: {}, retry {} in {:.1f}s".format(url, error or response.status_code,
+                attempt + 1, delay), file=sys.stderr)
+            control.retrying()
+            await asyncio.sleep(delay)
+
+    async def scrape_provider(self, url: str) -> Optional[Dict]:
+        '''Provider record read over http, None if the page needs a browser.'''
+        html = await self.fetch(url)
+        if html is None:
+            return None
+
+        return read_provider_page(html, url, table_row_limit())
+
+    async def scrape_providers(self, urls: List[str]) -> Dict[str, Optional[Dict]]:
+        results = await asyncio.gather(*[ self.scrape_provider(url) for url in urls ])
+        return dict(zip(urls, results))
+
+
+async def scrape_states_async(driver_factory: Callable[[], webdriver], states: Dict[str, str],
+        concurrency: int = DEFAULT_CONCURRENCY, rate: float = DEFAULT_RATE,
+        on_state_done: Optional[Callable[[str, List[Dict]], None]] = None,
+        http_client: Optional[httpx.Client] = None, cache: Optional[PageCache] = None,
+        journal: Optional[ScrapeJournal] = None,
+        drivers: Optional[DriverManager] = None,
+        max_rate: float = DEFAULT_MAX_RATE) -> Dict[str, List[Dict]]:
+    '''Scrape every state in states ({abbreviation: url}) with the asyncio engine.
+
+    Takes the same callbacks and helpers as Scraper_Pool.scrape_states(),
+    states that fail are left out of the results and reported. rate,
+    max_rate and concurrency are set as the Rate_Control settings of the
+    run: requests start at rate a second per host and go up to max_rate
+    while the site keeps up.
+    '''
+    driver = None
+    used = False
+    browser_lock = asyncio.Lock()
+    if drivers is None:
+        drivers = DriverManager(driver_factory)
+
+    def get_driver() -> webdriver:
+        nonlocal driver, used
+        if driver is None:
+            driver = drivers.acquire()
+        used = True
+        return driver
+
+    def run_page(function: Callable, *args) -> object:
+        nonlocal driver, used
+        used = False
+        try:
+            result = function(*args)
+        except Exception:
+            if driver is not None and drivers.is_dead(driver):
+                # retry once in a new session
+                drivers.discard(driver)
+                driver = None
+                result = function(*args)
+            else:
+                raise
+
+        if used and not drivers.release(driver):
+            driver = None
+        return result
+
+    async def in_browser(function: Callable, *args) -> object:
+        # only one page at a time in the single browser session
+        async with browser_lock:
+            return await asyncio.to_thread(run_page, function, *args)
+
+    async def read_state(state: str, url: str) -> List[str]:
+        provider_urls = journal.get_state_urls(state) if journal is not None else None
+        if provider_urls is None:
+            provider_urls = await in_browser(read_state_provider_urls,
+                get_driver, url, state, http_client, cache)
+            if journal is not None:
+                await asyncio.to_thread(journal.record_state_urls, state, provider_urls)
+        return provider_urls
+
+    async def read_provider(scraper: AsyncScraper, url: str) -> Dict:
+        # each provider runs in its own asyncio task, give it its own track
+        with span('provider', 'provider', track=asyncio.current_task().get_name(), url=url):
+            return await read_provider_record(scraper, url)
+
+    # cached records are full ones, cut down records aren't cached
+    cache_records = cache is not None and table_row_limit() is None
+
+    async def read_provider_record(scraper: AsyncScraper, url: str) -> Dict:
+        # the journal and the page cache write and fsync files, keep that off the event loop
+        if journal is not None:
+            provider_info = await asyncio.to_thread(journal.load_provider, url)
+            if provider_info is not None:
+                return provider_info
+
+        provider_info = await asyncio.to_thread(cache.get_record, url) if cache_records else None
+        scraped = provider_info is None
+        try:
+            if provider_info is None:
+                provider_info = await scraper.scrape_provider(url)
+            if provider_info is None:
+                provider_info = await in_browser(get_provider_info_retrying, get_driver, url)
+        except Exception as err:
+            if journal is not None:
+                await asyncio.to_thread(journal.record_failure, url, repr(err))
+            raise
+
+        # records from the cache are there already
+        if scraped and cache_records:
+            await asyncio.to_thread(cache.put_record, url, provider_info)
+        if journal is not None:
+            await asyncio.to_thread(journal.record_provider, url, provider_info)
+        return compact_provider(provider_info)
+
+    configure(rate=rate, max_rate=max_rate, max_window=concurrency)
+
+    results = {}
+    failed_states = []
+    # each provider is scraped once however many states list it
+    providers = {}
+    started = time.perf_counter()
+
+    try:
+        async with AsyncScraper(concurrency) as scraper:
+            # a state page that fails only loses that state, like in Scraper_Pool
+            listed = await asyncio.gather(*[ read_state(state, url)
+                for state, url in states.items() ], return_exceptions=True)
+
+            state_urls = {}
+            for state, provider_urls in zip(states, listed):
+                if isinstance(provider_urls, BaseException):
+                    print("Failed {}: {!r}".format(state, provider_urls), file=sys.stderr)
+                    failed_states.append(state)
+                    continue
+                state_urls[state] = provider_urls
+
+                for provider_url in provider_urls:
+                    if provider_url not in providers:
+                        providers[provider_url] = asyncio.ensure_future(
+                            read_provider(scraper, provider_url))
+
+            for state, provider_urls in state_urls.items():
+                try:
+                    providers_info = [ await providers[url] for url in provider_urls ]
+                except Exception as err:
+                    print("Failed {}: {!r}".format(state, err), file=sys.stderr)
+                    failed_states.append(state)
+                    continue
+
+                results[state] = sort_providers(providers_info)
+                complete('state', 'state', started, track='state {}'.format(state),
+                    state=state, providers=len(providers_info))
+                if on_state_done is not None:
+                    await asyncio.to_thread(on_state_done, state, results[state])
+                if journal is not None:
+                    await asyncio.to_thread(journal.record_state_done, state)
+
+            print("Async engine: {}".format(scraper.metrics.summary()))
+    finally:
+        for future in providers.values():
+            if not future.done():
+                future.cancel()
+            elif not future.cancelled():
+                # providers of a failed state that weren't awaited, their error was reported with it
+                future.exception()
+        drivers.close()
+        print("Browser sessions: {}".format(drivers.summary()))
+
+    if failed_states:
+        print("Failed states: {}".format(", ".join(failed_states)), file=sys.stderr)
+
+    return results
+
+
+#### checks ####
+
+def check_async_engine(states: List[str] = CHECK_STATES) -> List[str]:
+    '''Scrape a throttling and failing stand-in site with the engine, returns the checks that failed.'''
+    # only needed here, Stand_In_Server serves the records in OUTPUT_DIR
+    from Provider_Page_Parser import read_state_page
+    from Stand_In_Server import StandInServer
+
+    failed = []
+
+    def check(name: str, passed: bool, details: str) -> None:
+        print("{}: {} ({})".format(name, "ok" if passed else "FAILED", details))
+        if not passed:
+            failed.append(name)
+
+    def no_browser() -> webdriver:
+        raise RuntimeError("no browser in the check")
+
+    def plain(providers: List[Dict]) -> List[Dict]:
+        return json.loads(json.dumps(providers, default=json_default))
+
+    with StandInServer(states, page_size=CHECK_PAGE_SIZE, capacity=CHECK_CAPACITY,
+            error_rate=CHECK_ERROR_RATE) as server:
+        # a new host, so a new controller with these settings
+        configure(rate=CHECK_CAPACITY * 4, max_rate=CHECK_CAPACITY * 8, max_window=DEFAULT_CONCURRENCY)
+
+        async def scrape_all() -> Dict[str, Optional[Dict]]:
+            async with AsyncScraper() as scraper:
+                return await scraper.scrape_providers(server.provider_urls())
+
+        records = asyncio.run(scrape_all())
+        mismatched = sum(record != server.record(url) for url, record in records.items())
+        check('pages scraped under throttling', mismatched == 0,
+            "{} of {} records as served".format(len(records) - mismatched, len(records)))
+        control = host_controller(server.url)
+        check('backed off', server.throttled > 0 and control.stats['decreases'] > 0,
+            "{} throttled, {} cuts".format(server.throttled, control.stats['decreases']))
+
+        # the state pages need the browser, list the providers through the journal instead
+        with tempfile.TemporaryDirectory() as directory:
+            journal = ScrapeJournal(directory)
+            state_urls = {}
+            for state in states:
+                state_urls[state] = server.state_url(state)
+                journal.record_state_urls(state, read_state_page(server.pages['/' + state],
+                    state_urls[state])['urls'])
+
+            # a provider page of the first state is gone and there is no browser to fall back to
+            failing = journal.get_state_urls(states[0])[0]
+            del server.pages['/' + failing.split('/', 3)[-1]]
+
+            written = {}
+            results = asyncio.run(scrape_states_async(no_browser, state_urls,
+                on_state_done=lambda state, providers: written.update({ state: providers }),
+                journal=journal))
+            journal.close()
+
+        expected = { state: sort_providers([ server.record(url)
+            for url in read_state_page(server.pages['/' + state], state_urls[state])['urls'] ])
+            for state in states[1:] }
+        check('failed state left out', sorted(results) == sorted(expected)
+            and all(plain(results[state]) == providers for state, providers in expected.items())
+            and sorted(written) == sorted(expected),
+            "{} failed, {} written".format(states[0], ", ".join(sorted(written)) or "none"))
+
+    return failed
+
+def main() -> int:
+    failed = check_async_engine()
+    if failed:
+        print("Async engine checks failed: {}".format(", ".join(failed)), file=sys.stderr)
+        return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,390 @@
+# Benchmarks for the scraper and the dataset processing, runnable offline.
+#
+# Scraping runs against Stand_In_Server.py instead of findenergy.com:
+#
+#   parse    provider pages fetched over http and parsed without a browser
+#   scrape   scrape_state() end to end in a real browser (--scrape, needs a
+#            webdriver), reporting pages/sec, WebDriver commands per page,
+#            time spent sleeping vs working and memory
+#
+# The Collect_State_Info functions are timed on synthetic DataFrames with the
+#  same columns as the census, EIA and EPA datasets, so no dataset files are
+#  needed either.
+#
+# The saved pages in fixtures/ are parsed too (see check_fixtures() in
+#  Provider_Page_Parser.py) and a page not parsed as expected fails the run.
+#
+# The import time of each entry point is measured in a fresh interpreter, and
+#  the light ones (the utility-scraper.py command line, Merge_Json.py, ...)
+#  fail the comparison if they load pandas or selenium again, as does
+#  Scrape_Electrical_Providers.py if it loads more than selenium.
+#
+# Results can be saved with --save and compared with --baseline, which exits
+#  with 1 when a benchmark got more than --tolerance slower, for use in CI.
+#
+#   python3 Benchmark.py --save baseline.json
+#   python3 Benchmark.py --baseline baseline.json
+#   python3 Benchmark.py --scrape AK HI --driver-path ./geckodriver
+#
+
+# Python standard libs
+import argparse
+import contextlib
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+from collections import Counter
+from typing import Callable, Dict, List, Optional
+
+# 3rd party libs
+from pandas import DataFrame
+from selenium import webdriver
+
+# local module
+import Collect_State_Info as CSI
+from Driver_Manager import browser_rss_mb
+from Provider_Page_Parser import check_fixtures, fetch_page, get_http_client, read_provider_page
+from Scrape_Electrical_Providers import FIREFOX_PATH, get_driver, scrape_state
+from Scrape_Trace import start_trace, stop_trace
+from Stand_In_Server import StandInServer, available_states
+
+DEFAULT_REPEAT = 5
+DEFAULT_TOLERANCE = 0.25
+PARSE_STATES = [ 'AK', 'HI', 'MA', 'NY' ]
+SEED = 1
+
+# entry points timed by bench_import(), module (or script) -> the HEAVY_MODULES
+#  it may load, None for any
+IMPORT_MODULES = {
+    'utility-scraper.py': [],
+    'Merge_Json': [],
+    'Geo_Index': [],
+    'Utility_Store': [],
+    'Stand_In_Server': [],
+    'Collect_State_Info': None,
+    'Scrape_Electrical_Providers': [ 'selenium' ],
+}
+# packages an entry point must not import unless IMPORT_MODULES allows it
+HEAVY_MODULES = [ 'pandas', 'selenium', 'pyarrow', 'httpx', 'bs4' ]
+
+# run in a fresh interpreter by bench_import(), prints the seconds and heavy packages loaded
+IMPORT_SCRIPT = '''
+import importlib.util, json, sys, time
+start = time.perf_counter()
+{load}
+elapsed = time.perf_counter() - start
+print(json.dumps([ elapsed, [ name for name in {heavy!r} if name in sys.modules ] ]))
+'''
+# how IMPORT_SCRIPT loads a script, whose hyphenated name can't be imported by name
+LOAD_SCRIPT = '''
+spec = importlib.util.spec_from_file_location({name!r}, {path!r})
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+'''
+
+
+#### measuring ####
+
+class SleepTimer:
+    '''Total time the scraper spent in its waits and sleeps while active.
+
+    Read from a trace (see Scrape_Trace.py) of the WebDriverWait waits and
+    the backoff and pacing sleeps, time.sleep() itself isn't touched.
+    '''
+
+    def __init__(self):
+        self.seconds = 0.0
+        self._tracer = None
+
+    def __enter__(self) -> 'SleepTimer':
+        self._tracer = start_trace()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.seconds = self._tracer.seconds_in('wait', 'sleep')
+        stop_trace(quiet=True)
+
+
+def count_commands(driver: webdriver) -> Counter:
+    '''Count the WebDriver commands sent by driver from now on, by command name.'''
+    commands = Counter()
+    execute = driver.execute
+
+    def counted_execute(driver_command: str, params: Optional[Dict] = None) -> Dict:
+        commands[driver_command] += 1
+        return execute(driver_command, params)
+
+    driver.execute = counted_execute
+    return commands
+
+def max_rss_mb() -> float:
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def time_function(function: Callable, repeat: int) -> Dict:
+    times = timeit.repeat(function, number=1, repeat=repeat)
+    return { 'min': min(times), 'median': statistics.median(times) }
+
+#### Collect_State_Info micro-benchmarks ####
+
+def synthetic_datasets(scale: float = 1.0) -> Dict[str, DataFrame]:
+    '''DataFrames shaped like the ones read from the census, EIA and EPA files.'''
+    rng = random.Random(SEED)
+    states = list(CSI.STATES.items())
+
+    population = []
+    for name, _ in states:
+        population.append([ 40, name, name, rng.randint(5e5, 4e7), rng.randint(5e5, 4e7) ])
+        for county in range(int(60 * scale)):
+            population.append([ 50, "County {}".format(county), name,
+                rng.randint(1e3, 1e6), rng.randint(1e3, 1e6) ])
+        for city in range(int(400 * scale)):
+            population.append([ 162, "City {} city".format(city), name,
+                rng.randint(1e2, 1e6), rng.randint(1e2, 1e6) ])
+            population.append([ 61, "Place {}".format(city), name, 1, 2 ])
+    population_df = DataFrame(population, columns=CSI.POPULATION_COLUMNS)
+
+    water = []
+    for index in range(int(150000 * scale)):
+        water.append([ "X{:07d}".format(index), "city of  springfield {}".format(index % 97),
+            rng.choice(states)[0], "community water system", "local government",
+            "ground water", "{:,}".format(rng.randint(25, 2000000)) ])
+    water_df = DataFrame(water, columns=CSI.WATER_PROVIDER_COLUMNS)
+
+    sources = [ 'Total', 'Coal', 'Natural Gas', 'Hydroelectric Conventional', 'Wind', 'Solar' ]
+    producers = [ 'Total Electric Power Industry', 'Electric Generators, Electric Utilities' ]
+    energy = []
+    for year in range(CSI.YEAR_MIN, CSI.YEAR_MAX + 1):
+        for _, abrv in states:
+            for producer in producers:
+                for source in sources:
+                    energy.append([ year, abrv, producer, source, rng.randint(0, 1e8) ])
+    energy_df = DataFrame(energy, columns=[ 'YEAR', 'STATE', 'TYPE OF PRODUCER',
+        'ENERGY SOURCE', 'GENERATION (Megawatthours)' ])
+
+    return { 'population': population_df, 'water': water_df, 'energy': energy_df }
+
+def bench_collect_state_info(repeat: int, scale: float) -> Dict[str, Dict]:
+    datasets = synthetic_datasets(scale)
+    population_df, water_df, energy_df = datasets['population'], datasets['water'], datasets['energy']
+
+    counties = population_df[population_df['SUMLEV'] == 50]
+    cities = population_df[population_df['SUMLEV'] == 162]
+    production = energy_df[(energy_df['STATE'] == 'CA') & (energy_df['YEAR'] == CSI.YEAR_MAX)]
+    sample_states = list(CSI.STATES.items())[:5]
+
+    benchmarks = {
+        'csi.partition': lambda: CSI.partition(population_df, 'SUMLEV'),
+        'csi.county_populations_from_rows': lambda: CSI.county_populations_from_rows(counties),
+        'csi.city_populations_from_rows': lambda: CSI.city_populations_from_rows(cities),
+        'csi.yearly_production_from_rows': lambda: CSI.yearly_production_from_rows(production),
+        'csi.water_providers_from_rows': lambda: CSI.water_providers_from_rows(water_df),
+        'csi.get_state_info.5-states': lambda: [ CSI.get_state_info(name, abrv,
+            energy_df, water_df, population_df) for name, abrv in sample_states ],
+        'csi.get_all_state_info': lambda: CSI.get_all_state_info(energy_df, water_df,
+            population_df),
+    }
+
+    return { name: time_function(function, repeat) for name, function in benchmarks.items() }
+
+#### scraping ####
+
+def bench_parse(server: StandInServer, repeat: int) -> Dict[str, Dict]:
+    '''Fetch and parse every stand-in provider page over http.'''
+    client = get_http_client()
+    urls = server.provider_urls()
+    outcome = {}
+
+    def parse_all() -> None:
+        outcome['parsed'] = outcome['browser'] = outcome['mismatched'] = 0
+        for url in urls:
+            with contextlib.redirect_stdout(None):
+                provider_info = read_provider_page(fetch_page(client, url), url)
+            if provider_info is None:
+                # a table spans several pages
+                outcome['browser'] += 1
+            else:
+                outcome['parsed'] += 1
+                outcome['mismatched'] += provider_info != server.record(url)
+
+    result = time_function(parse_all, repeat)
+    client.close()
+
+    result.update(outcome)
+    result['pages'] = len(urls)
+    result['pages-per-second'] = round(len(urls) / result['min'], 1)
+
+    return { 'parse.provider-pages': result }
+
+def bench_scrape(server: StandInServer, states: List[str], browser: str, driver_path: str,
+        with_http: bool, lightweight: bool = True) -> Optional[Dict[str, Dict]]:
+    '''Run scrape_state() for states in a browser, None if no webdriver could be created.'''
+    driver = get_driver(browser, driver_path, [ '--headless' ], lightweight)
+    if driver is None:
+        return None
+
+    client = get_http_client() if with_http else None
+    commands = count_commands(driver)
+    pages = 0
+    mismatched = 0
+
+    try:
+        start = time.perf_counter()
+        with SleepTimer() as slept:
+            for state in states:
+                providers = scrape_state(driver, server.state_url(state), state, client)
+                pages += 1 + len(providers)
+                records = { record['company']: record for record in server.records.values() }
+                mismatched += sum(provider != records.get(provider['company'])
+                    for provider in providers)
+        elapsed = time.perf_counter() - start
+        browser_mb = browser_rss_mb(driver)
+    finally:
+        driver.quit()
+        if client is not None:
+            client.close()
+
+    name = 'scrape.{}{}{}'.format(browser.lower(), '+http' if with_http else '',
+        '' if lightweight else '+full-pages')
+    return { name: {
+        'min': elapsed,
+        'pages': pages,
+        'pages-per-second': round(pages / elapsed, 2),
+        'commands': sum(commands.values()),
+        'commands-per-page': round(sum(commands.values()) / pages, 1),
+        'top-commands': dict(commands.most_common(5)),
+        'sleeping': round(slept.seconds, 3),
+        'working': round(elapsed - slept.seconds, 3),
+        'python-max-rss-mb': round(max_rss_mb(), 1),
+        'browser-rss-mb': None if browser_mb is None else round(browser_mb, 1),
+        'mismatched': mismatched,
+    } }
+
+#### import time ####
+
+def time_import(module: str) -> List:
+    '''[ seconds, heavy packages loaded ] to import module (or load a .py script) in a fresh interpreter.'''
+    if module.endswith('.py'):
+        name = os.path.splitext(os.path.basename(module))[0].replace('-', '_')
+        load = LOAD_SCRIPT.format(name=name, path=os.path.abspath(module))
+    else:
+        load = "import {}".format(module)
+
+    output = subprocess.run([ sys.executable, '-c', IMPORT_SCRIPT.format(load=load, heavy=HEAVY_MODULES) ],
+        capture_output=True, text=True, check=True).stdout
+
+    return json.loads(output)
+
+def bench_import(repeat: int) -> Dict[str, Dict]:
+    '''Cold import time of each entry point and the heavy packages it loads.'''
+    results = {}
+    for module, allowed in IMPORT_MODULES.items():
+        runs = [ time_import(module) for _ in range(repeat) ]
+        times = [ elapsed for elapsed, _ in runs ]
+        results['import.{}'.format(module)] = {
+            'min': min(times),
+            'median': statistics.median(times),
+            'allowed': allowed,
+            'loads': runs[0][1],
+        }
+
+    return results
+
+def heavy_imports(results: Dict[str, Dict]) -> List[str]:
+    '''Names of the entry points that loaded a heavy package they aren't allowed to.'''
+    return [ name for name, result in results.items() if result.get('allowed') is not None
+        and set(result['loads']) - set(result['allowed']) ]
+
+#### reporting ####
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], tolerance: float) -> List[str]:
+    '''Names of the benchmarks more than tolerance slower than in baseline.'''
+    regressions = []
+    for name, result in results.items():
+        if name in baseline and 'min' in baseline[name] and baseline[name]['min'] > 0:
+            ratio = result['min'] / baseline[name]['min']
+            result['vs-baseline'] = round(ratio, 2)
+            if ratio > 1 + tolerance:
+                regressions.append(name)
+
+    return regressions
+
+def print_results(results: Dict[str, Dict]) -> None:
+    for name, result in results.items():
+        details = ", ".join("{} {}".format(key, round(value, 4) if isinstance(value, float) else value)
+            for key, value in result.items())
+        print("{:40} {}".format(name, details))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the scraper against a local "
+        "stand-in server and the dataset functions on synthetic data.")
+    parser.add_argument('--scrape', nargs='*', metavar='STATE',
+        help="also run scrape_state() in a browser for these states (default: AK)")
+    parser.add_argument('--browser', default='Firefox', help="(default: %(default)s)")
+    parser.add_argument('--driver-path', default=FIREFOX_PATH, help="(default: %(default)s)")
+    parser.add_argument('--http', action='store_true',
+        help="let scrape_state() read provider pages over http when it can")
+    parser.add_argument('--full-pages', action='store_true',
+        help="scrape without the lightweight browser profile")
+    parser.add_argument('--latency', type=float, default=0.0,
+        help="seconds the stand-in server adds to every response (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+        help="runs of each micro-benchmark (default: %(default)s)")
+    parser.add_argument('--scale', type=float, default=1.0,
+        help="size of the synthetic datasets (default: %(default)s)")
+    parser.add_argument('--save', metavar='FILE', help="write the results to a json file")
+    parser.add_argument('--baseline', metavar='FILE',
+        help="compare with saved results, exit with 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+        help="allowed slowdown against the baseline (default: %(default)s)")
+    args = parser.parse_args()
+
+    results = bench_import(args.repeat)
+    results.update(bench_collect_state_info(args.repeat, args.scale))
+
+    scrape_states = [ state.upper() for state in args.scrape or [ 'AK' ] ]
+    parse_states = [ state for state in PARSE_STATES if state in available_states() ]
+
+    with StandInServer(sorted(set(parse_states + scrape_states)), latency=args.latency) as server:
+        results.update(bench_parse(server, args.repeat))
+
+        if args.scrape is not None:
+            scrape_results = bench_scrape(server, scrape_states, args.browser, args.driver_path,
+                args.http, not args.full_pages)
+            if scrape_results is None:
+                print("Not able to create webdriver object, skipping the scrape benchmark",
+                    file=sys.stderr)
+            else:
+                results.update(scrape_results)
+
+    heavy = heavy_imports(results)
+    unparsed = check_fixtures()
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r') as rf:
+            regressions = compare(results, json.load(rf), args.tolerance)
+
+    print_results(results)
+
+    if args.save:
+        with open(args.save, 'w') as wf:
+            json.dump(results, wf, indent=1)
+
+    if heavy:
+        print("Entry points loading pandas, selenium, ...: {}".format(", ".join(heavy)), file=sys.stderr)
+    if unparsed:
+        print("Saved pages not parsed as expected: {}".format(", ".join(unparsed)), file=sys.stderr)
+    if regressions:
+        print("Slower than the baseline: {}".format(", ".join(regressions)), file=sys.stderr)
+    if heavy or unparsed or regressions:
+        return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,154 @@
+# Lightweight browser profile for scraping sessions.
+#
+# The scraper only needs the html and the Svelte scripts of findenergy.com,
+#  not the images, fonts, video, analytics, ads or maps the pages pull in.
+#  With the profile:
+#
+#   - pages are loaded with the 'eager' strategy, driver.get() returns once
+#     the document is parsed instead of waiting for every resource; the
+#     scraper waits for the element it needs instead (see wait_until_ready())
+#   - images, web fonts and media aren't downloaded
+#   - requests to BLOCKED_DOMAINS fail straight away, through a proxy
+#     autoconfig script in Firefox and Network.setBlockedURLs in Chrome
+#   - prefetching, telemetry, updates, notifications and the other browser
+#     features a scraper never uses are turned off
+#
+
+# Python standard libs
+import json
+from typing import List
+from urllib.parse import quote
+
+# 3rd party libs
+from selenium import webdriver
+
+PAGE_LOAD_STRATEGY = 'eager'
+
+# analytics, ads, tag managers and map tiles
+BLOCKED_DOMAINS = [
+    'google-analytics.com',
+    'googletagmanager.com',
+    'googletagservices.com',
+    'googlesyndication.com',
+    'googleadservices.com',
+    'doubleclick.net',
+    'adservice.google.com',
+    'fonts.googleapis.com',
+    'fonts.gstatic.com',
+    'maps.googleapis.com',
+    'maps.gstatic.com',
+    'api.mapbox.com',
+    'tiles.mapbox.com',
+    'connect.facebook.net',
+    'facebook.com',
+    'hotjar.com',
+    'clarity.ms',
+    'segment.com',
+    'segment.io',
+    'amazon-adsystem.com',
+    'adnxs.com',
+    'taboola.com',
+    'outbrain.com',
+]
+
+# resource types blocked by url in Chrome, Firefox uses its prefs for these
+BLOCKED_EXTENSIONS = [
+    'png', 'jpg', 'jpeg', 'gif', 'webp', 'avif', 'svg', 'ico',
+    'woff', 'woff2', 'ttf', 'otf', 'eot',
+    'mp4', 'webm', 'mp3',
+]
+
+# blocked hosts are sent to the discard port, which refuses the connection
+BLOCKED_PROXY = 'PROXY 127.0.0.1:9'
+
+FIREFOX_PREFS = {
+    'permissions.default.image': 2,
+    'gfx.downloadable_fonts.enabled': False,
+    'browser.display.use_document_fonts': 0,
+    'media.autoplay.default': 5,
+    'media.autoplay.blocking_policy': 2,
+    'network.prefetch-next': False,
+    'network.dns.disablePrefetch': True,
+    'network.http.speculative-parallel-limit': 0,
+    'browser.cache.disk.enable': False,
+    'geo.enabled': False,
+    'dom.webnotifications.enabled': False,
+    'dom.push.enabled': False,
+    'app.update.auto': False,
+    'extensions.update.enabled': False,
+    'browser.safebrowsing.malware.enabled': False,
+    'browser.safebrowsing.phishing.enabled': False,
+    'datareporting.healthreport.uploadEnabled': False,
+    'datareporting.policy.dataSubmissionEnabled': False,
+    'toolkit.telemetry.enabled': False,
+    'toolkit.telemetry.unified': False,
+}
+
+CHROME_ARGUMENTS = [
+    '--blink-settings=imagesEnabled=false',
+    '--disable-extensions',
+    '--disable-background-networking',
+    '--disable-component-update',
+    '--disable-default-apps',
+    '--disable-sync',
+    '--disable-notifications',
+    '--disable-dev-shm-usage',
+    '--mute-audio',
+    '--no-first-run',
+]
+
+CHROME_PREFS = {
+    'profile.managed_default_content_settings.images': 2,
+    'profile.managed_default_content_settings.notifications': 2,
+    'profile.managed_default_content_settings.geolocation': 2,
+    'profile.managed_default_content_settings.media_stream': 2,
+}
+
+
+def blocking_pac_script(domains: List[str] = BLOCKED_DOMAINS) -> str:
+    '''Proxy autoconfig script refusing every request to domains and their subdomains.'''
+    return ''.join([
+        'function FindProxyForURL(url, host) {',
+        'var blocked = {};'.format(json.dumps(domains)),
+        'for (var i = 0; i < blocked.length; i++) {',
+        'if (host == blocked[i] || dnsDomainIs(host, "." + blocked[i])) return "{}";'.format(BLOCKED_PROXY),
+        '}',
+        'return "DIRECT";',
+        '}',
+    ])
+
+def chrome_blocked_urls(domains: List[str] = BLOCKED_DOMAINS,
+        extensions: List[str] = BLOCKED_EXTENSIONS) -> List[str]:
+    '''Network.setBlockedURLs patterns for domains and resource extensions.'''
+    return ([ '*://*.{}/*'.format(domain) for domain in domains ]
+        + [ '*://{}/*'.format(domain) for domain in domains ]
+        + [ '*.{}'.format(extension) for extension in extensions ]
+        + [ '*.{}?*'.format(extension) for extension in extensions ])
+
+def firefox_options(options: webdriver.FirefoxOptions) -> webdriver.FirefoxOptions:
+    '''Add the scraping profile to Firefox options.'''
+    options.page_load_strategy = PAGE_LOAD_STRATEGY
+
+    for name, value in FIREFOX_PREFS.items():
+        options.set_preference(name, value)
+
+    options.set_preference('network.proxy.type', 2)
+    options.set_preference('network.proxy.autoconfig_url',
+        'data:text/javascript,' + quote(blocking_pac_script()))
+
+    return options
+
+def chrome_options(options: webdriver.ChromeOptions) -> webdriver.ChromeOptions:
+    '''Add the scraping profile to Chrome options, see also block_chrome_requests().'''
+    options.page_load_strategy = PAGE_LOAD_STRATEGY
+
+    for argument in CHROME_ARGUMENTS:
+        options.add_argument(argument)
+    options.add_experimental_option('prefs', CHROME_PREFS)
+
+    return options
+
+def block_chrome_requests(driver: webdriver.Chrome) -> None:
+    '''Block requests to BLOCKED_DOMAINS and for BLOCKED_EXTENSIONS in a Chrome session.'''
+    driver.execute_cdp_cmd('Network.enable', {})
+    driver.execute_cdp_cmd('Network.setBlockedURLs', { 'urls': chrome_blocked_urls() })
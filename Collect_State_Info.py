@@ -24,66 +24,23 @@
 # -------------------------------
 # https://www.census.gov/data/developers/data-sets/popest-popproj/popest/popest-vars.html
 
+import argparse
 import json
 import sys
-from typing import Dict, List
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 from pandas import read_excel
 from pandas import read_csv
 from pandas import DataFrame
+from pandas import Series
+from pandas import to_numeric
 
-STATES = {
-    'Alaska': 'AK',
-    'Alabama': 'AL',
-    'Arkansas': 'AR',
-    'Arizona': 'AZ',
-    'California': 'CA',
-    'Colorado': 'CO',
-    'Connecticut': 'CT',
-    'Delaware': 'DE',
-    'Florida': 'FL',
-    'Georgia': 'GA',
-    'Hawaii': 'HI',
-    'Iowa': 'IA',
-    'Idaho': 'ID',
-    'Illinois': 'IL',
-    'Indiana': 'IN',
-    'Kansas': 'KS',
-    'Kentucky': 'KY',
-    'Louisiana': 'LA',
-    'Massachusetts': 'MA',
-    'Maryland': 'MD',
-    'Maine': 'ME',
-    'Michigan': 'MI',
-    'Minnesota': 'MN',
-    'Missouri': 'MO',
-    'Mississippi': 'MS',
-    'Montana': 'MT',
-    'North Carolina': 'NC',
-    'North Dakota': 'ND',
-    'Nebraska': 'NE',
-    'New Hampshire': 'NH',
-    'New Jersey': 'NJ',
-    'New Mexico': 'NM',
-    'Nevada': 'NV',
-    'New York': 'NY',
-    'Ohio': 'OH',
-    'Oklahoma': 'OK',
-    'Oregon': 'OR',
-    'Pennsylvania': 'PA',
-    'Rhode Island': 'RI',
-    'South Carolina': 'SC',
-    'South Dakota': 'SD',
-    'Tennessee': 'TN',
-    'Texas': 'TX',
-    'Utah': 'UT',
-    'Virginia': 'VA',
-    'Vermont': 'VT',
-    'Washington': 'WA',
-    'Wisconsin': 'WI',
-    'West Virginia': 'WV',
-    'Wyoming': 'WY'
-}
+from Dataset_Cache import get_cached_df
+from Scraper_Settings import STATES
+from Scraper_Settings import DATASETS_DIRECTORY_PATH, US_ENERGY_PRODUCTION_BY_STATE_FILE
+from Scraper_Settings import US_POPULATION_BY_CITY_FILE, US_WATER_PROVIDERS_BY_STATE_FILE
+from Scraper_Settings import OUTPUT_FILE, COL_HEADER_1, COL_HEADER_2, POP_KEY_1, POP_KEY_2
+from Json_Stream import open_json_writer
 
 REGION_1 = [ 'CT', 'ME', 'MA', 'NH', 'RI', 'VT' ]
 REGION_2 = [ 'NJ', 'NY', ]
@@ -109,30 +66,23 @@ REGIONS = {
     "10": REGION_10
 }
 
-#### FILE INFO ####
-DATASETS_DIRECTORY_PATH             = "datasets" 
-US_ENERGY_PRODUCTION_BY_STATE_FILE  = "annual_generation_state.xls"
-US_POPULATION_BY_CITY_FILE          = "sub-est2021_all.csv"
-US_WATER_PROVIDERS_BY_STATE_FILE    = "Water System Detail.csv"
-
-OUTPUT_FILE = "all-states-water-population-info.json"
-
-#### CSV/XLS HEADER NAMES ####
-# These strings are from the files shown above and are consistent
-#   between the census.gov datasets. 
-# The year should be adjusted as needed
-COL_HEADER_1 = 'POPESTIMATE2020'
-COL_HEADER_2 = 'POPESTIMATE2021'
-
-# These specify the dictionary key for annual population
-#   Adjust accordingly
-POP_KEY_1 = 'estimate-2020'
-POP_KEY_2 = 'estimate-2021'
 
 ### Used when parsing info from ENERGY_PRODUCTION_PATH
 YEAR_MIN = 1990
 YEAR_MAX = 2020
 
+# Columns kept in the dataset cache (see Dataset_Cache.py). The energy
+#   production table is kept whole since its rows are read by position.
+POPULATION_COLUMNS = [ 'SUMLEV', 'NAME', 'STNAME', COL_HEADER_1, COL_HEADER_2 ]
+WATER_PROVIDER_COLUMNS = [
+    'PWS ID', 'PWS Name', 'Primacy Agency', 'PWS Type', 'Owner Type',
+    'Primary Source', 'Population Served Count'
+]
+# Keys of each water provider in the output, see clean_water_provider_df()
+WATER_PROVIDER_KEYS = [
+    'PWS-ID', 'PWS-Name', 'PWS-Type', 'Owner-Type', 'Primary-Source', 'Population-Served'
+]
+
 def capitalize(string: str) -> str:
     '''Capitalize the first letter in a string.'''
     return " ".join([ word.capitalize() for word in string.split() ])
@@ -165,14 +115,31 @@ def get_csv_df(filepath: str) -> DataFrame:
 
     return csv_data_df
 
-def get_state_population(df: DataFrame, state: str) -> Dict:
-    '''Get state population data for a specific state from dataframe.'''
-    states_pop = {}
+def get_energy_production_df(filepath: str) -> DataFrame:
+    '''Read the EIA generation xls through the dataset cache.'''
+    return get_cached_df(filepath,
+        lambda: get_excel_df(filepath, header=1, skiprows=0), variant="header=1")
 
-    states_df = df.query(
-            "(`NAME` == '{}') and (`SUMLEV` == 40)".format(state)
-        )
-    # SUMLEV 40 is State and/or Statistical Equivalent
+def get_water_provider_df(filepath: str) -> DataFrame:
+    '''Read the EPA water system csv through the dataset cache.'''
+    return get_cached_df(filepath, lambda: get_csv_df(filepath), WATER_PROVIDER_COLUMNS)
+
+def get_population_df(filepath: str) -> DataFrame:
+    '''Read the census population csv through the dataset cache.'''
+    return get_cached_df(filepath, lambda: get_csv_df(filepath), POPULATION_COLUMNS)
+
+def partition(df: DataFrame, columns: Any) -> Dict[Any, DataFrame]:
+    '''Split a dataframe into one dataframe per distinct value of columns.
+
+    Rows keep their original order within each part. Keys are tuples when
+    columns is a list.
+    '''
+    return { key: df.take(positions)
+        for key, positions in df.groupby(columns, sort=False).indices.items() }
+
+def state_population_from_rows(states_df: DataFrame) -> Dict:
+    '''Build the population totals of a state from its SUMLEV 40 rows.'''
+    states_pop = {}
 
     for state, pop1, pop2 in zip(states_df['NAME'], 
         states_df[COL_HEADER_1], states_df[COL_HEADER_2]):
@@ -181,15 +148,10 @@ def get_state_population(df: DataFrame, state: str) -> Dict:
 
     return states_pop
 
-def get_county_populations(df: DataFrame, state: str) -> List[Dict]:
-    '''Get county population data for a specific state from dataframe.'''
+def county_populations_from_rows(state_df: DataFrame) -> List[Dict]:
+    '''Build the list of counties of a state from its SUMLEV 50 rows.'''
     counties = []
 
-    state_df = df.query(
-        "(`STNAME` == '{}') and (`SUMLEV` == 50)".format(state) 
-    )
-    # SUMLEV 50 is County and/or Statistical Equivalent
-
     for county, pop1, pop2 in zip(state_df['NAME'], 
         state_df[COL_HEADER_1], state_df[COL_HEADER_2]):
 
@@ -202,15 +164,10 @@ def get_county_populations(df: DataFrame, state: str) -> List[Dict]:
     # sort the list by population of the most recent year
     return sorted(counties, reverse=True, key=lambda county: county[POP_KEY_2])
 
-def get_city_populations(df, state) -> List[Dict]:
-    '''Get city population data for a specific state from dataframe.'''
+def city_populations_from_rows(state_df: DataFrame) -> List[Dict]:
+    '''Build the list of cities of a state from its SUMLEV 162 rows.'''
     cities = []
 
-    state_df = df.query(
-        "(`STNAME` == '{}') and (`SUMLEV` == 162)".format(state) 
-    )
-    # SUMLEV 162 is Incorporated Place
-
     for city, pop1, pop2 in zip(state_df['NAME'], 
         state_df[COL_HEADER_1], state_df[COL_HEADER_2]):
 
@@ -223,6 +180,81 @@ def get_city_populations(df, state) -> List[Dict]:
     # sort the list by population of the most recent year
     return sorted(cities, reverse=True, key=lambda city: city[POP_KEY_2])
 
+def yearly_production_from_rows(state_df: DataFrame) -> Dict:
+    '''Build {energy source: MWh generated} from the rows of one state and year.'''
+    yearly_production = {}
+    for item in state_df.itertuples():
+        yearly_production[item._4] = item._5
+
+    return yearly_production
+
+def capitalize_column(column: Series) -> Series:
+    '''capitalize() of every value in a column, each distinct value is only done once.'''
+    values = column.unique()
+    return column.map(dict(zip(values, [ capitalize(value) for value in values ])))
+
+def number_column(column: Series) -> Series:
+    '''Parse a column of numbers written with thousands separators ("1,234").'''
+    if column.dtype.kind in 'iuf':
+        return column
+    return to_numeric(column.astype(str).str.replace(',', '', regex=False))
+
+def clean_water_provider_df(df: DataFrame) -> DataFrame:
+    '''Normalize the EPA rows into the water provider fields, sorted by population served.
+
+    Runs once over the whole table: the names and types are capitalized and
+    the population parsed column by column. 'Primacy Agency' is kept to split
+    the result by state, rows keep their order within a state.
+    '''
+    clean_df = DataFrame({
+        'Primacy Agency': df['Primacy Agency'],
+        'PWS-ID': df['PWS ID'],
+        'PWS-Name': capitalize_column(df['PWS Name']),
+        'PWS-Type': capitalize_column(df['PWS Type']),
+        'Owner-Type': capitalize_column(df['Owner Type']),
+        'Primary-Source': capitalize_column(df['Primary Source']),
+        'Population-Served': number_column(df['Population Served Count']).astype('int64'),
+    })
+
+    # Sort providers by population served (descending), stable like sorted()
+    return clean_df.sort_values('Population-Served', ascending=False, kind='stable')
+
+def water_providers_from_clean_rows(clean_df: DataFrame) -> List[Dict]:
+    '''Build the list of water providers from rows of clean_water_provider_df().'''
+    columns = [ clean_df[key].tolist() for key in WATER_PROVIDER_KEYS ]
+    return [ dict(zip(WATER_PROVIDER_KEYS, row)) for row in zip(*columns) ]
+
+def water_providers_from_rows(state_df: DataFrame) -> List[Dict]:
+    '''Build the list of water providers of a state from its EPA rows.'''
+    return water_providers_from_clean_rows(clean_water_provider_df(state_df))
+
+def get_state_population(df: DataFrame, state: str) -> Dict:
+    '''Get state population data for a specific state from dataframe.'''
+    states_df = df.query(
+            "(`NAME` == '{}') and (`SUMLEV` == 40)".format(state)
+        )
+    # SUMLEV 40 is State and/or Statistical Equivalent
+
+    return state_population_from_rows(states_df)
+
+def get_county_populations(df: DataFrame, state: str) -> List[Dict]:
+    '''Get county population data for a specific state from dataframe.'''
+    state_df = df.query(
+        "(`STNAME` == '{}') and (`SUMLEV` == 50)".format(state) 
+    )
+    # SUMLEV 50 is County and/or Statistical Equivalent
+
+    return county_populations_from_rows(state_df)
+
+def get_city_populations(df, state) -> List[Dict]:
+    '''Get city population data for a specific state from dataframe.'''
+    state_df = df.query(
+        "(`STNAME` == '{}') and (`SUMLEV` == 162)".format(state) 
+    )
+    # SUMLEV 162 is Incorporated Place
+
+    return city_populations_from_rows(state_df)
+
 def get_state_energy_production(df: DataFrame, state: str) -> Dict:
     '''Get energy production by source and MWhs generated for a particular state.'''
     state_info = {}
@@ -234,40 +266,17 @@ def get_state_energy_production(df: DataFrame, state: str) -> Dict:
                 and (`YEAR` == {})".format(state, year)
         )
         
-        yearly_production = {}
-        for item in state_df.itertuples():
-            yearly_production[item._4] = item._5
-        
-        state_info[year] = yearly_production
+        state_info[year] = yearly_production_from_rows(state_df)
 
     return state_info
 
 def get_state_water_providers(df: DataFrame, state: str) -> List[Dict]:
-    state_providers = []
-
     # Filter dataframe by state
     state_df = df.query(
         "`Primacy Agency` == '{}'".format(state)
     )
 
-    for pws_id, pws_name, pws_type, owner_type, source, pop_served in \
-        zip(
-            state_df['PWS ID'], state_df['PWS Name'], state_df['PWS Type'], 
-            state_df['Owner Type'], state_df['Primary Source'], 
-            state_df['Population Served Count']
-        ):
-        # print(pop_served)
-        state_providers.append({
-            'PWS-ID': pws_id,
-            'PWS-Name': capitalize(pws_name),
-            'PWS-Type': capitalize(pws_type),
-            'Owner-Type': capitalize(owner_type),
-            'Primary-Source': capitalize(source),
-            'Population-Served': int("".join(pop_served.split(',')))
-        })
-
-    # Sort list of providers by population served (descending) and return
-    return sorted(state_providers, reverse=True, key=lambda provider: provider['Population-Served'])
+    return water_providers_from_rows(state_df)
 
 def get_state_info(state_name: str, state_abrev: str, 
         energy_production_df: DataFrame, water_provider_df: DataFrame,
@@ -292,38 +301,96 @@ def get_state_info(state_name: str, state_abrev: str,
 
     return state_dict
 
-def main():
+def iter_all_state_info(energy_production_df: DataFrame, water_provider_df: DataFrame,
+        statewide_pop_df: DataFrame, states: Dict[str, str] = STATES) -> Iterator[Tuple[str, Dict]]:
+    '''Yields (abbreviation, get_state_info()) for every state in states, in order.
+
+    Each dataset is split by state (and SUMLEV/year) a single time instead of
+    being filtered again for every state, the output is identical. Each
+    state's dict is only built when it is reached.
+    '''
+    no_pop_rows = statewide_pop_df.iloc[:0]
+    no_energy_rows = energy_production_df.iloc[:0]
+    # the EPA rows are normalized once for every state
+    clean_water_df = clean_water_provider_df(water_provider_df)
+    no_water_rows = clean_water_df.iloc[:0]
+
+    # SUMLEV 40 is State, 50 is County and 162 is Incorporated Place
+    pop_by_level = partition(statewide_pop_df, 'SUMLEV')
+    state_rows = partition(pop_by_level.get(40, no_pop_rows), 'NAME')
+    county_rows = partition(pop_by_level.get(50, no_pop_rows), 'STNAME')
+    city_rows = partition(pop_by_level.get(162, no_pop_rows), 'STNAME')
+
+    total_production_df = energy_production_df[
+        energy_production_df['TYPE OF PRODUCER'] == 'Total Electric Power Industry']
+    production_rows = partition(total_production_df, ['STATE', 'YEAR'])
+
+    water_rows = partition(clean_water_df, 'Primacy Agency')
+
+    for state_name, state_abrev in states.items():
+        state_dict = {}
+
+        state_dict['population'] = {}
+        state_dict['energy-production'] = {}
+
+        state_dict['population']['total'] = state_population_from_rows(
+            state_rows.get(state_name, no_pop_rows))
+        state_dict['population']['counties'] = county_populations_from_rows(
+            county_rows.get(state_name, no_pop_rows))
+        state_dict['population']['cities'] = city_populations_from_rows(
+            city_rows.get(state_name, no_pop_rows))
+
+        annual = {}
+        for year in range(YEAR_MIN, YEAR_MAX+1):
+            annual[year] = yearly_production_from_rows(
+                production_rows.get((state_abrev, year), no_energy_rows))
+        state_dict['energy-production']['annual'] = annual
+
+        state_dict['water-providers'] = water_providers_from_clean_rows(
+            water_rows.get(state_name, no_water_rows))
+
+        yield state_abrev, state_dict
+
+def get_all_state_info(energy_production_df: DataFrame, water_provider_df: DataFrame,
+        statewide_pop_df: DataFrame, states: Dict[str, str] = STATES) -> Dict[str, Dict]:
+    '''Collects the same data as get_state_info() for every state in states at once.'''
+    return dict(iter_all_state_info(energy_production_df, water_provider_df,
+        statewide_pop_df, states))
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Collect population, energy production "
+        "and water provider info for all 50 states into {}.".format(OUTPUT_FILE))
+    parser.add_argument('--jsonl', action='store_true',
+        help="write JSON Lines, one state per line, instead of a single JSON object")
+    args = parser.parse_args(argv)
+
     energy_production_file = "{}/{}".format(
         DATASETS_DIRECTORY_PATH, US_ENERGY_PRODUCTION_BY_STATE_FILE
     )
     # read xls file into pandas dataframe
-    energy_production_df = get_excel_df(energy_production_file, header=1, skiprows=0)
+    energy_production_df = get_energy_production_df(energy_production_file)
     if energy_production_df is None: return 1
 
     water_provider_file = "{}/{}".format(
         DATASETS_DIRECTORY_PATH, US_WATER_PROVIDERS_BY_STATE_FILE
     )
 
-    water_provider_df = get_csv_df(water_provider_file)
+    water_provider_df = get_water_provider_df(water_provider_file)
     if water_provider_df is None: return 1
 
     population_file = "{}/{}".format(
         DATASETS_DIRECTORY_PATH, US_POPULATION_BY_CITY_FILE
     )
     # read csv file into pandas dataframe
-    statewide_pop_df = get_csv_df(population_file)
+    statewide_pop_df = get_population_df(population_file)
     if statewide_pop_df is None: return None
 
 
-    states_dict = {}
-    for state_name, state_abrev in STATES.items():
-        states_dict[state_abrev] = get_state_info(
-            state_name, state_abrev,
-            energy_production_df, water_provider_df, statewide_pop_df
-        )
-
-    # write info to json file
-    write_json(OUTPUT_FILE, states_dict)
+    # write info to json file, one state at a time
+    with open_json_writer(OUTPUT_FILE, lines=args.jsonl) as writer:
+        for state_abrev, state_dict in iter_all_state_info(
+                energy_production_df, water_provider_df, statewide_pop_df):
+            writer.write(state_abrev, state_dict)
 
     return 0
 
@@ -0,0 +1,131 @@
+# Columnar cache for the census, EIA and EPA datasets.
+#
+# Parsing the xls/csv files takes seconds on every run. The first time a file
+#  is read its needed columns are saved as a Feather (Arrow IPC) file under
+#  DATASET_CACHE_DIR, and later runs memory map that file instead of parsing
+#  the source again.
+#
+# A cached copy is used as long as the source file is unchanged. The mtime
+#  and size are checked first; only when they differ is the file hashed, so
+#  touching a dataset without changing it doesn't rebuild the cache.
+#
+# pyarrow is optional, without it the datasets are parsed on every run.
+#
+
+# Python standard libs
+import hashlib
+import json
+import os
+import sys
+from typing import Callable, List, Optional
+
+# 3rd party libs
+from pandas import DataFrame
+
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+DATASET_CACHE_DIR = ".cache/datasets"
+
+
+def file_sha256(filepath: str) -> str:
+    '''Hash a file without reading it into memory all at once.'''
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as rf:
+        for block in iter(lambda: rf.read(1024 * 1024), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def _cache_paths(filepath: str, variant: str, directory: str) -> List[str]:
+    # one cached copy per source file and set of read options/columns
+    name = hashlib.sha1("{}|{}".format(os.path.abspath(filepath), variant).encode('utf-8')).hexdigest()
+    base = os.path.join(directory, "{}-{}".format(os.path.basename(filepath), name[:12]))
+
+    return [ "{}.feather".format(base), "{}.json".format(base) ]
+
+def _source_info(filepath: str) -> dict:
+    stat = os.stat(filepath)
+    return { 'mtime': stat.st_mtime, 'size': stat.st_size }
+
+def _load_cached(filepath: str, data_path: str, manifest_path: str) -> Optional[DataFrame]:
+    '''Return the cached dataframe if the source file hasn't changed.'''
+    try:
+        with open(manifest_path, 'r') as rf:
+            manifest = json.load(rf)
+    except (OSError, ValueError):
+        return None
+
+    if not os.path.exists(data_path):
+        return None
+
+    source = _source_info(filepath)
+    if source['mtime'] != manifest['mtime'] or source['size'] != manifest['size']:
+        if source['size'] != manifest['size'] or file_sha256(filepath) != manifest['sha256']:
+            return None
+
+        # same content with a new mtime, remember it so the file isn't hashed again
+        manifest.update(source)
+        with open(manifest_path, 'w') as wf:
+            json.dump(manifest, wf)
+
+    return feather.read_table(data_path, memory_map=True).to_pandas()
+
+def _save_cached(filepath: str, df: DataFrame, data_path: str, manifest_path: str) -> None:
+    os.makedirs(os.path.dirname(data_path), exist_ok=True)
+
+    manifest = _source_info(filepath)
+    manifest['sha256'] = file_sha256(filepath)
+    manifest['source'] = filepath
+    manifest['columns'] = list(df.columns)
+
+    # uncompressed so the file can be memory mapped
+    tmp_path = "{}.tmp".format(data_path)
+    feather.write_feather(df, tmp_path, compression='uncompressed')
+    os.replace(tmp_path, data_path)
+
+    with open(manifest_path, 'w') as wf:
+        json.dump(manifest, wf)
+
+def get_cached_df(filepath: str, read: Callable[[], Optional[DataFrame]],
+        columns: Optional[List[str]] = None, variant: str = '',
+        directory: str = DATASET_CACHE_DIR) -> Optional[DataFrame]:
+    '''Read a dataset through the columnar cache.
+
+    read() parses the source file and is only called when there is no
+    cached copy for it. Only columns (all of them if None) are kept. variant
+    should describe any read options that change the result (e.g. the header
+    row of an xls file).
+    '''
+    if feather is None:
+        df = read()
+        return df if df is None or columns is None else df[columns]
+
+    data_path, manifest_path = _cache_paths(filepath, "{}|{}".format(variant, columns), directory)
+
+    try:
+        df = _load_cached(filepath, data_path, manifest_path)
+    except Exception as err:
+        print("Unable to read cached {}: {}".format(filepath, err), file=sys.stderr)
+        df = None
+
+    if df is not None:
+        return df
+
+    df = read()
+    if df is None:
+        return None
+
+    if columns is not None:
+        df = df[columns]
+    df = df.reset_index(drop=True)
+
+    try:
+        _save_cached(filepath, df, data_path, manifest_path)
+    except Exception as err:
+        # e.g. a column that arrow can't store, keep going with the parsed copy
+        print("Unable to cache {}: {}".format(filepath, err), file=sys.stderr)
+
+    return df
@@ -0,0 +1,199 @@
+# Refresh the per-state provider files in OUTPUT_DIR, only scraping the
+#  providers that are new or have changed since the files were written.
+#
+# For each state the provider count on the state's homepage is compared with
+#  the count recorded by the last refresh (DELTA_INDEX_FILE). If it matches,
+#  and the providers on the first page of the table are all known, the
+#  recorded list of provider urls is reused instead of paging through the
+#  table in the browser.
+#
+# Every provider page is then fetched once over plain http and summarized:
+#  company overview, sales/customer and production figures, cities, and the
+#  number of counties and states served. A provider whose summary matches its
+#  record in the existing output keeps that record, only the others are
+#  scraped again (see read_provider()). The state file is then rewritten in
+#  the format it was found in. A page whose markup can't be summarized is
+#  scraped in full, a state page the same way listed in the browser.
+#
+# Records written with --fields top or totals are compared on the table sizes
+#  they store ('counties-count', 'states-count'), not on their cut lists.
+#
+
+# Python standard libs
+import argparse
+import json
+import os
+import sys
+from typing import Callable, Dict, List, Optional, Tuple
+
+# 3rd party libs
+import httpx
+from selenium import webdriver
+
+# local module
+from Json_Stream import json_default
+from Provider_Page_Parser import fetch_page, get_http_client
+from Provider_Page_Parser import read_provider_summary, read_state_page
+from Scraper_Settings import BASE_URL, FIREFOX_PATH, OUTPUT_DIR, STATES
+from Scrape_Electrical_Providers import get_driver, get_state_provider_urls
+from Scrape_Electrical_Providers import read_provider, sort_providers
+
+DELTA_INDEX_FILE = os.path.join(OUTPUT_DIR, ".delta-index.json")
+
+
+def provider_summary(provider_info: Dict) -> Dict:
+    '''Summary of a scraped provider record comparable with parse_provider_summary().
+
+    The table sizes stored by the top and totals field profiles are used
+    when the record has them, the length of the lists otherwise.
+    '''
+    summary = { key: value for key, value in provider_info.items()
+        if key not in ('counties-served', 'states-served') }
+
+    summary.setdefault('website', '')
+    for count_key, list_key in (('counties-count', 'counties-served'), ('states-count', 'states-served')):
+        if count_key not in provider_info:
+            summary[count_key] = len(provider_info[list_key]) \
+                if list_key in provider_info else None
+
+    return summary
+
+def read_state_output(state: str) -> Tuple[Optional[List[Dict]], bool]:
+    '''Read the providers from a state's output file.
+
+    Returns the providers (None if there is no file) and whether the file
+    wraps them in {'electrical-providers': [...]}.
+    '''
+    filepath = '{}/{}-energy-utility-info.json'.format(OUTPUT_DIR, state)
+    if not os.path.exists(filepath):
+        return None, True
+
+    with open(filepath, 'r') as rf:
+        content = json.load(rf)
+
+    if isinstance(content, dict):
+        return content['electrical-providers'], True
+
+    return content, False
+
+def write_state_output(state: str, providers: List[Dict], wrapped: bool) -> None:
+    '''Write a state's output file in the same format it was read in.'''
+    filepath = '{}/{}-energy-utility-info.json'.format(OUTPUT_DIR, state)
+    tmp_path = "{}.tmp".format(filepath)
+
+    with open(tmp_path, 'w') as wf:
+        if wrapped:
+            json.dump({'electrical-providers': providers}, wf, indent=1, default=json_default)
+        else:
+            json.dump(providers, wf, default=json_default)
+
+    os.replace(tmp_path, filepath)
+
+def read_delta_index() -> Dict:
+    try:
+        with open(DELTA_INDEX_FILE, 'r') as rf:
+            return json.load(rf)
+    except (OSError, ValueError):
+        return {}
+
+def write_delta_index(index: Dict) -> None:
+    tmp_path = "{}.tmp".format(DELTA_INDEX_FILE)
+    with open(tmp_path, 'w') as wf:
+        json.dump(index, wf, indent=1)
+    os.replace(tmp_path, DELTA_INDEX_FILE)
+
+def delta_state_provider_urls(get_driver: Callable[[], webdriver], client: httpx.Client,
+        url: str, state: str, state_index: Optional[Dict]) -> List[str]:
+    '''List of provider urls for a state, reusing the recorded one when the table is unchanged.'''
+    html = fetch_page(client, url)
+    state_page = read_state_page(html, url) if html is not None else None
+
+    if state_page is not None and state_index is not None \
+            and state_page['count'] == len(state_index['providers']) \
+            and all(provider_url in state_index['providers'] for provider_url in state_page['urls']):
+        print("{}: {} providers, same as last time".format(state, state_page['count']))
+        return list(state_index['providers'])
+
+    return list(get_state_provider_urls(get_driver(), url, state))
+
+def delta_scrape_state(get_driver: Callable[[], webdriver], client: httpx.Client,
+        url: str, state: str, previous: List[Dict], state_index: Optional[Dict]) -> Tuple[List[Dict], Dict, Dict]:
+    '''Refresh the providers of one state.
+
+    Returns the providers, the new index entry for the state ({'providers':
+    {url: company}}) and counts of kept, changed, new and removed providers.
+    '''
+    previous_by_company = { provider['company']: provider for provider in previous }
+    known = state_index['providers'] if state_index is not None else {}
+
+    provider_urls = delta_state_provider_urls(get_driver, client, url, state, state_index)
+
+    providers_info = []
+    companies = {}
+    stats = { 'kept': 0, 'changed': 0, 'new': 0, 'removed': 0 }
+
+    for provider_url in provider_urls:
+        html = fetch_page(client, provider_url)
+        # a page that can't be summarized is scraped in full below
+        summary = read_provider_summary(html, provider_url) if html is not None else None
+
+        company = summary['company'] if summary is not None else known.get(provider_url)
+        old_info = previous_by_company.get(company)
+
+        if summary is not None and old_info is not None and provider_summary(old_info) == summary:
+            provider_info = old_info
+            stats['kept'] += 1
+        else:
+            # html is reused so the page is only opened again if it needs the browser
+            provider_info = read_provider(get_driver, provider_url, html=html)
+            stats['changed' if old_info is not None else 'new'] += 1
+
+        providers_info.append(provider_info)
+        companies[provider_url] = provider_info['company']
+
+    stats['removed'] = len(set(previous_by_company) - set(companies.values()))
+
+    return sort_providers(providers_info), { 'providers': companies }, stats
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Refresh {}/ by only scraping providers that changed.".format(OUTPUT_DIR))
+    parser.add_argument('states', nargs='*', default=list(STATES.values()),
+        help="state abbreviations to refresh (default: all)")
+    args = parser.parse_args(argv)
+
+    driver = None
+
+    def lazy_driver() -> webdriver:
+        nonlocal driver
+        if driver is None:
+            driver = get_driver('Firefox', FIREFOX_PATH, ['--headless', '--no-sandbox' ])
+        if driver is None:
+            raise RuntimeError("Not able to create webdriver object")
+        return driver
+
+    client = get_http_client()
+    index = read_delta_index()
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    try:
+        for state in [ state.upper() for state in args.states ]:
+            previous, wrapped = read_state_output(state)
+            url = "{}{}".format(BASE_URL, state)
+
+            providers, index[state], stats = delta_scrape_state(lazy_driver, client, url, state,
+                previous or [], index.get(state))
+
+            write_state_output(state, providers, wrapped)
+            write_delta_index(index)
+
+            print("{}: {kept} kept, {changed} changed, {new} new, {removed} removed".format(
+                state, **stats))
+    finally:
+        if driver is not None:
+            driver.quit()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,291 @@
+# Lifecycle of the webdriver sessions used by the scraper.
+#
+# A browser left running for a whole 50 state run keeps growing, and a single
+#  session that stops answering used to hang the run. The DriverManager hands
+#  out sessions and takes them back after every page:
+#
+#   - a session is recycled (quit, and a new one started in the background)
+#     after max_pages pages or once the driver and browser processes use more
+#     than max_rss_mb of memory (needs psutil)
+#   - a watchdog thread kills the browser of any session whose WebDriver
+#     command has been running for longer than command_timeout, so the command
+#     fails instead of blocking its worker forever
+#   - a session that died or was killed is dropped, callers get a new one on
+#     their next acquire() and can retry the page (see Scraper_Pool.py)
+#   - sessions can be pre-warmed, started before the first page needs them
+#
+
+# Python standard libs
+import sys
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+# 3rd party libs
+from selenium import webdriver
+from selenium.common.exceptions import InvalidSessionIdException
+from selenium.common.exceptions import NoSuchWindowException
+from selenium.common.exceptions import WebDriverException
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+DEFAULT_MAX_PAGES = 250
+DEFAULT_MAX_RSS_MB = 2048
+DEFAULT_COMMAND_TIMEOUT = 120   # seconds a single WebDriver command may take
+WATCHDOG_INTERVAL = 5           # seconds between watchdog checks
+
+
+def browser_rss_mb(driver: webdriver) -> Optional[float]:
+    '''Memory used by the driver and browser processes, None without psutil.'''
+    if psutil is None:
+        return None
+    try:
+        process = psutil.Process(driver.service.process.pid)
+        processes = [ process ] + process.children(recursive=True)
+        return sum(p.memory_info().rss for p in processes) / (1024 * 1024)
+    except (AttributeError, psutil.Error):
+        return None
+
+def kill_driver(driver: webdriver) -> None:
+    '''Kill the driver and browser processes of a session that stopped answering.'''
+    try:
+        process = driver.service.process
+    except AttributeError:
+        return
+
+    if psutil is not None:
+        try:
+            for child in psutil.Process(process.pid).children(recursive=True):
+                child.kill()
+        except psutil.Error:
+            pass
+
+    try:
+        process.kill()
+    except OSError:
+        pass
+
+def quit_driver(driver: webdriver) -> None:
+    try:
+        driver.quit()
+    except Exception as err:
+        print(err, file=sys.stderr)
+
+
+class ManagedSession:
+    '''A webdriver session and what the manager knows about it.'''
+
+    def __init__(self, driver: webdriver):
+        self.driver = driver
+        self.pages = 0
+        self.command_started = None     # time.monotonic() of the command in flight
+        self.dead = False
+
+        execute = driver.execute
+
+        def watched_execute(driver_command: str, params: Optional[Dict] = None) -> Dict:
+            self.command_started = time.monotonic()
+            try:
+                return execute(driver_command, params)
+            except (InvalidSessionIdException, NoSuchWindowException):
+                self.dead = True
+                raise
+            except WebDriverException as err:
+                # subclasses are page errors (no such element, stale element,
+                #  ...), the base class is raised when the driver itself failed
+                if type(err) is WebDriverException:
+                    self.dead = not self._answers(execute)
+                raise
+            except Exception:
+                # lost the connection to the driver process
+                self.dead = True
+                raise
+            finally:
+                self.command_started = None
+
+        driver.execute = watched_execute
+
+    def _answers(self, execute: Callable) -> bool:
+        '''Whether the session still answers after a command failed.'''
+        if self.dead:
+            return False
+        try:
+            execute('getCurrentUrl', None)
+            return True
+        except Exception:
+            return False
+
+
+class DriverManager:
+    '''Hand out webdriver sessions, recycling and replacing them as needed.
+
+    driver_factory is called to start every session and should return a
+    webdriver object or None. Each session is used by one caller at a time:
+    acquire() it, call release() after every page and discard() it after a
+    failure.
+    '''
+
+    def __init__(self, driver_factory: Callable[[], webdriver],
+            max_pages: int = DEFAULT_MAX_PAGES, max_rss_mb: Optional[float] = DEFAULT_MAX_RSS_MB,
+            command_timeout: float = DEFAULT_COMMAND_TIMEOUT, prewarm: int = 0):
+        self.driver_factory = driver_factory
+        self.max_pages = max_pages
+        self.max_rss_mb = max_rss_mb
+        self.command_timeout = command_timeout
+
+        self.stats = { 'started': 0, 'recycled': 0, 'replaced': 0, 'hung': 0 }
+
+        self._lock = threading.Lock()
+        self._sessions = {}         # id(driver) -> ManagedSession handed out
+        self._spares = []           # started sessions waiting to be handed out
+        self._starting = 0
+        self._closed = threading.Event()
+
+        self._watchdog = threading.Thread(target=self._watch, daemon=True)
+        self._watchdog.start()
+
+        for _ in range(prewarm):
+            self._start_spare()
+
+    def _start_session(self) -> Optional[ManagedSession]:
+        driver = self.driver_factory()
+        if driver is None:
+            return None
+
+        with self._lock:
+            self.stats['started'] += 1
+        return ManagedSession(driver)
+
+    def _start_spare(self) -> None:
+        '''Start a session in the background for the next acquire().'''
+        def start() -> None:
+            session = None
+            try:
+                session = self._start_session()
+            except Exception as err:
+                print(err, file=sys.stderr)
+
+            with self._lock:
+                self._starting -= 1
+                if session is not None and not self._closed.is_set():
+                    self._spares.append(session)
+                    return
+
+            if session is not None:
+                quit_driver(session.driver)
+
+        with self._lock:
+            self._starting += 1
+        threading.Thread(target=start, daemon=True).start()
+
+    def acquire(self, wait: float = 60.0) -> webdriver:
+        '''Return a session for the caller's exclusive use.
+
+        Takes a pre-warmed session if one is ready (or about to be, up to wait
+        seconds), otherwise starts one.
+        '''
+        deadline = time.monotonic() + wait
+        while True:
+            with self._lock:
+                if self._spares:
+                    session = self._spares.pop()
+                    break
+                starting = self._starting > 0
+            if not starting or time.monotonic() > deadline:
+                session = self._start_session()
+                if session is None:
+                    raise RuntimeError("Not able to create webdriver object")
+                break
+            time.sleep(0.1)
+
+        with self._lock:
+            self._sessions[id(session.driver)] = session
+        return session.driver
+
+    def is_dead(self, driver: webdriver) -> bool:
+        '''Whether a session stopped answering or was killed by the watchdog.'''
+        session = self._sessions.get(id(driver))
+        return session is None or session.dead
+
+    def release(self, driver: webdriver, pages: int = 1) -> bool:
+        '''Count pages done with a session, returns False if it was recycled.
+
+        A recycled session must not be used again, acquire() a new one.
+        '''
+        session = self._sessions.get(id(driver))
+        if session is None:
+            return False
+
+        session.pages += pages
+        recycle = session.dead or session.pages >= self.max_pages
+        if not recycle and self.max_rss_mb is not None:
+            rss_mb = browser_rss_mb(driver)
+            recycle = rss_mb is not None and rss_mb > self.max_rss_mb
+
+        if recycle:
+            with self._lock:
+                self.stats['recycled'] += 1
+            self._drop(session)
+            # warm up its replacement while the caller keeps going
+            self._start_spare()
+
+        return not recycle
+
+    def discard(self, driver: Optional[webdriver]) -> None:
+        '''Quit a session after a failure, the caller gets a new one next time.'''
+        session = self._sessions.get(id(driver)) if driver is not None else None
+        if session is None:
+            if driver is not None:
+                quit_driver(driver)
+            return
+
+        if session.dead:
+            with self._lock:
+                self.stats['replaced'] += 1
+        self._drop(session)
+
+    def _drop(self, session: ManagedSession) -> None:
+        with self._lock:
+            self._sessions.pop(id(session.driver), None)
+
+        if session.dead:
+            kill_driver(session.driver)
+        quit_driver(session.driver)
+
+    def _watch(self) -> None:
+        '''Kill the browser of every session stuck on a command.'''
+        while not self._closed.wait(WATCHDOG_INTERVAL):
+            now = time.monotonic()
+            with self._lock:
+                sessions = list(self._sessions.values())
+
+            for session in sessions:
+                started = session.command_started
+                if started is None or now - started < self.command_timeout or session.dead:
+                    continue
+
+                print("WebDriver command running for {:.0f}s, killing the browser".format(
+                    now - started), file=sys.stderr)
+                session.dead = True
+                with self._lock:
+                    self.stats['hung'] += 1
+                # the blocked command fails once the browser is gone
+                kill_driver(session.driver)
+
+    def close(self) -> None:
+        '''Quit every session, handed out or spare.'''
+        self._closed.set()
+        with self._lock:
+            sessions = list(self._sessions.values()) + self._spares
+            self._sessions = {}
+            self._spares = []
+
+        for session in sessions:
+            quit_driver(session.driver)
+
+    def summary(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stats)
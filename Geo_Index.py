@@ -0,0 +1,241 @@
+# Join between the places providers serve and the census population records.
+#
+# findenergy.com lists cities as "Providence, RI" and counties as
+#  "Providence County, RI", while the census file names them "Providence city"
+#  and "Providence County" under the state's full name, with accents, "Saint"
+#  spelled out and legal suffixes (city, town, village, borough, ...) that the
+#  site mostly drops.
+#
+# PlaceIndex normalizes both sides to a (state, kind, name key) and is built
+#  once from the census DataFrame, so enriching every provider is a single
+#  pass of dict lookups instead of a search through each state's places.
+#  Census places are indexed under their full key and their key without the
+#  legal suffix ("boise city city" -> "boise city"), lookups try the full key
+#  first, so "Boise City, ID" and "Providence, RI" both match.
+#
+#   python3 Geo_Index.py                    # match report for outputs/
+#   python3 Geo_Index.py --unmatched u.json # also save the names not found
+#
+
+# Python standard libs
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import unicodedata
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+
+# 3rd party libs, pandas is only loaded by the caller building the index
+if TYPE_CHECKING:
+    from pandas import DataFrame
+
+# local module
+from Scraper_Settings import COL_HEADER_1, COL_HEADER_2, POP_KEY_1, POP_KEY_2, STATES
+from Scraper_Settings import DATASETS_DIRECTORY_PATH, OUTPUT_DIR, US_POPULATION_BY_CITY_FILE
+
+CITY = 'city'
+COUNTY = 'county'
+
+# SUMLEV of the census rows indexed for each kind of place
+SUMLEVS = { 50: COUNTY, 162: CITY }
+
+# legal suffixes of census names, longest first so "city and borough" wins over "borough"
+CITY_SUFFIXES = [
+    'consolidated government (balance)', 'metropolitan government (balance)',
+    'metro government (balance)', 'unified government (balance)', '(balance)',
+    'consolidated government', 'metropolitan government', 'metro government',
+    'unified government', 'urban county', 'city and borough', 'charter township',
+    'municipality', 'plantation', 'township', 'borough', 'village', 'city', 'town', 'cdp',
+]
+# "city" is left on counties: "Baltimore city" and "Baltimore County" are both in MD
+COUNTY_SUFFIXES = [
+    'city and borough', 'census area', 'municipality', 'borough', 'county', 'parish',
+]
+SUFFIXES = { CITY: CITY_SUFFIXES, COUNTY: COUNTY_SUFFIXES }
+
+_PUNCTUATION = re.compile(r"[.'’,]")
+_SEPARATORS = re.compile(r"[-/\s]+")
+
+
+def normalize(name: str) -> str:
+    '''Lowercase ascii name with punctuation dropped and "Saint" as "st".'''
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+    name = _SEPARATORS.sub(' ', _PUNCTUATION.sub('', name.lower())).strip()
+    if name.startswith('saint '):
+        name = 'st ' + name[len('saint '):]
+    return name
+
+def strip_suffix(key: str, kind: str) -> str:
+    '''key without its legal suffix, key itself if it has none.'''
+    for suffix in SUFFIXES[kind]:
+        if key.endswith(' ' + suffix):
+            return key[:-len(suffix) - 1]
+    return key
+
+def split_place(place: str) -> Tuple[str, Optional[str]]:
+    '''Split "Albany, NY" into ("Albany", "NY"), the state is None if missing.'''
+    name, _, state = place.rpartition(', ')
+    if name and len(state) == 2 and state.isupper():
+        return name, state
+
+    return place, None
+
+
+class PlaceIndex:
+    '''Census cities and counties keyed by (state, kind, normalized name).'''
+
+    def __init__(self):
+        self._places = {}       # (state, kind, key) -> census record
+        self.ambiguous = 0      # keys shared by two census places
+
+    def _add(self, key: Tuple[str, str, str], record: Dict) -> None:
+        current = self._places.get(key)
+        if current is None:
+            self._places[key] = record
+        elif current['name'] != record['name']:
+            self.ambiguous += 1
+            # keep the larger place, the likelier one to be meant
+            if (record[POP_KEY_2] or 0) > (current[POP_KEY_2] or 0):
+                self._places[key] = record
+
+    def add(self, state: str, kind: str, name: str, pop1: Optional[int], pop2: Optional[int]) -> None:
+        record = { 'name': name, POP_KEY_1: pop1, POP_KEY_2: pop2 }
+        key = normalize(name)
+        stripped = strip_suffix(key, kind)
+
+        # the full name is added last so it wins over another place's stripped one
+        if stripped != key:
+            self._add((state, kind, stripped), record)
+        self._places[(state, kind, key)] = record
+
+    @classmethod
+    def from_population_df(cls, df: 'DataFrame') -> 'PlaceIndex':
+        '''Index every county (SUMLEV 50) and incorporated place (SUMLEV 162).'''
+        index = cls()
+        places = df[df['SUMLEV'].isin(list(SUMLEVS))]
+
+        for sumlev, name, state_name, pop1, pop2 in zip(places['SUMLEV'], places['NAME'],
+                places['STNAME'], places[COL_HEADER_1], places[COL_HEADER_2]):
+            state = STATES.get(state_name)
+            if state is not None:
+                index.add(state, SUMLEVS[sumlev], name, _to_int(pop1), _to_int(pop2))
+
+        return index
+
+    def lookup(self, place: str, kind: str) -> Optional[Dict]:
+        '''Census record for "Name, ST", None if there is no match.'''
+        name, state = split_place(place)
+        if state is None:
+            return None
+
+        key = normalize(name)
+        record = self._places.get((state, kind, key))
+        if record is None:
+            record = self._places.get((state, kind, strip_suffix(key, kind)))
+        return record
+
+    def __len__(self) -> int:
+        return len(self._places)
+
+    def enrich_provider(self, provider_info: Dict) -> Dict[str, List[str]]:
+        '''Add the census population of the places a provider serves.
+
+        Adds 'cities-population' and 'counties-population', the totals of the
+        matched places for each census year with the number of places matched,
+        and returns the names that could not be matched by kind.
+        '''
+        unmatched = { CITY: [], COUNTY: [] }
+        places = [
+            (CITY, 'cities-population', provider_info.get('cities-served', [])),
+            (COUNTY, 'counties-population',
+                [ county['county'] for county in provider_info.get('counties-served', []) ]),
+        ]
+
+        for kind, key, names in places:
+            if not names:
+                continue
+
+            totals = { POP_KEY_1: 0, POP_KEY_2: 0, 'matched': 0 }
+            for name in names:
+                record = self.lookup(name, kind)
+                if record is None:
+                    unmatched[kind].append(name)
+                    continue
+                totals[POP_KEY_1] += record[POP_KEY_1] or 0
+                totals[POP_KEY_2] += record[POP_KEY_2] or 0
+                totals['matched'] += 1
+
+            provider_info[key] = totals
+
+        return unmatched
+
+
+def _to_int(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def iter_provider_files(directory: str = OUTPUT_DIR) -> Iterator[Tuple[str, str]]:
+    '''(state, path) of every provider file in directory.'''
+    for path in sorted(glob.glob(os.path.join(directory, '*-energy-utility-info.json'))):
+        yield os.path.basename(path).split('-')[0], path
+
+def match_report(index: PlaceIndex, directory: str = OUTPUT_DIR) -> Dict[str, Dict]:
+    '''Enrich every provider in directory (without saving) and count the matches per state.'''
+    report = {}
+
+    for state, path in iter_provider_files(directory):
+        with open(path, 'r') as rf:
+            providers = json.load(rf)
+        if isinstance(providers, dict):
+            providers = providers['electrical-providers']
+
+        counts = { 'cities': 0, 'counties': 0, 'unmatched-cities': [], 'unmatched-counties': [] }
+        for provider_info in providers:
+            unmatched = index.enrich_provider(provider_info)
+            counts['cities'] += len(provider_info.get('cities-served', []))
+            counts['counties'] += len(provider_info.get('counties-served', []))
+            counts['unmatched-cities'] += unmatched[CITY]
+            counts['unmatched-counties'] += unmatched[COUNTY]
+
+        # a city served by several providers is reported once
+        counts['unmatched-cities'] = sorted(set(counts['unmatched-cities']))
+        counts['unmatched-counties'] = sorted(set(counts['unmatched-counties']))
+        report[state] = counts
+
+    return report
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Match the cities and counties served by the "
+        "providers in {}/ with the census population records.".format(OUTPUT_DIR))
+    parser.add_argument('--unmatched', metavar='FILE',
+        help="write the names that could not be matched, by state, to a json file")
+    args = parser.parse_args(argv)
+
+    from Collect_State_Info import get_population_df
+
+    population_df = get_population_df("{}/{}".format(DATASETS_DIRECTORY_PATH, US_POPULATION_BY_CITY_FILE))
+    if population_df is None:
+        return 1
+
+    index = PlaceIndex.from_population_df(population_df)
+    report = match_report(index)
+
+    print("{:5} {:>8} {:>10} {:>9} {:>11}".format('state', 'cities', 'unmatched', 'counties', 'unmatched'))
+    for state, counts in report.items():
+        print("{:5} {:>8} {:>10} {:>9} {:>11}".format(state, counts['cities'],
+            len(counts['unmatched-cities']), counts['counties'], len(counts['unmatched-counties'])))
+
+    if args.unmatched:
+        with open(args.unmatched, 'w') as wf:
+            json.dump({ state: { 'cities': counts['unmatched-cities'],
+                'counties': counts['unmatched-counties'] } for state, counts in report.items() },
+                wf, indent=1)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
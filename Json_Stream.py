@@ -0,0 +1,218 @@
+# Incremental writers for the all-states output files.
+#
+# The output files are one JSON object keyed by state abbreviation. Instead of
+#  building that object in memory and dumping it at the end, each state is
+#  encoded and written as soon as it is ready, so only one state is held in
+#  memory at a time and whatever was finished is already on disk if a run
+#  stops early.
+#
+# JsonObjectWriter produces exactly the same bytes as json.dump(obj, indent=1),
+#  or compact JSON. JsonLinesWriter writes one {"<state>": {...}} object per
+#  line instead, a file that stays valid (line by line) however far a run got.
+#
+# orjson is optional, when installed it is used to parse and to write compact
+#  JSON.
+#
+# Every encoder here takes json_default() for the values json doesn't know,
+#  the slotted provider table rows of Provider_Record.py are written as the
+#  objects they stand for.
+#
+
+# Python standard libs
+import json
+import os
+import threading
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# 3rd party libs
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_INDENT = 1
+
+
+def json_default(value: Any) -> Any:
+    '''default= for json.dump(s) and orjson.dumps, encodes any mapping as an object.'''
+    if isinstance(value, Mapping):
+        return dict(value)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+def loads(data: Any) -> Any:
+    '''Parse JSON, with orjson when it is installed.'''
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps_compact(value: Any) -> str:
+    '''Encode value without any whitespace, with orjson when it is installed.'''
+    if orjson is not None:
+        return orjson.dumps(value, default=json_default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(value, separators=(',', ':'), default=json_default)
+
+def encode_entry(key: str, value: Any, indent: Optional[int] = JSON_INDENT) -> bytes:
+    '''Encode one key of an object the way JsonObjectWriter writes it.
+
+    indent=None encodes compact JSON.
+    '''
+    if indent is None:
+        return "{}:{}".format(json.dumps(str(key)), dumps_compact(value)).encode('utf-8')
+
+    # nested lines are indented one level deeper than in a standalone dump
+    encoded = json.dumps(value, indent=indent, default=json_default).replace('\n', '\n' + ' ' * indent)
+    return "{}{}: {}".format(' ' * indent, json.dumps(str(key)), encoded).encode('utf-8')
+
+def encode_line(key: str, value: Any) -> bytes:
+    '''Encode one key of an object the way JsonLinesWriter writes it.'''
+    return json.dumps({ str(key): value }, default=json_default).encode('utf-8')
+
+
+class JsonObjectWriter:
+    '''Write a JSON object one key at a time, same output as json.dump(obj, indent=1).
+
+    indent=None writes compact JSON instead. The byte range of every entry is
+    kept in offsets so a later merge can copy it without parsing it.
+    '''
+
+    def __init__(self, filename: str, indent: Optional[int] = JSON_INDENT):
+        self.filename = filename
+        self.indent = indent
+        self.count = 0
+        self.offsets = {}
+        self._file = open(filename, 'wb')
+        self._file.write(b'{')
+        self._position = 1
+
+    def write(self, key: str, value: Any) -> None:
+        self.write_entry(key, encode_entry(key, value, self.indent))
+
+    def write_entry(self, key: str, entry: bytes) -> None:
+        '''Write an entry already encoded with encode_entry().'''
+        if self.indent is None:
+            separator = b',' if self.count else b''
+        else:
+            separator = b',\n' if self.count else b'\n'
+
+        self._file.write(separator + entry)
+        self._file.flush()
+
+        self.offsets[str(key)] = [ self._position + len(separator), len(entry) ]
+        self._position += len(separator) + len(entry)
+        self.count += 1
+
+    def read_entry(self, entry: bytes) -> Tuple[str, Any]:
+        '''Decode an entry written by write_entry().'''
+        return next(iter(loads(b'{' + entry + b'}').items()))
+
+    def close(self) -> None:
+        self._file.write(b'\n}' if self.count and self.indent is not None else b'}')
+        self._file.close()
+
+    def __enter__(self) -> 'JsonObjectWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class JsonLinesWriter:
+    '''Write a JSON object as JSON Lines, one {key: value} object per line.'''
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.count = 0
+        self.offsets = {}
+        self._file = open(filename, 'wb')
+        self._position = 0
+
+    def write(self, key: str, value: Any) -> None:
+        self.write_entry(key, encode_line(key, value))
+
+    def write_entry(self, key: str, entry: bytes) -> None:
+        '''Write a line already encoded with encode_line().'''
+        self._file.write(entry + b'\n')
+        self._file.flush()
+
+        self.offsets[str(key)] = [ self._position, len(entry) ]
+        self._position += len(entry) + 1
+        self.count += 1
+
+    def read_entry(self, entry: bytes) -> Tuple[str, Any]:
+        '''Decode a line written by write_entry().'''
+        return next(iter(loads(entry).items()))
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> 'JsonLinesWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def open_json_writer(filename: str, lines: bool = False) -> Any:
+    '''Open filename for writing one key at a time.
+
+    With lines the file is written as JSON Lines and its extension is
+    changed to .jsonl.
+    '''
+    if lines:
+        return JsonLinesWriter("{}.jsonl".format(os.path.splitext(filename)[0]))
+
+    return JsonObjectWriter(filename)
+
+def iter_json_object(filename: str) -> Iterator[Tuple[str, Any]]:
+    '''Yield the (key, value) pairs of a file written by either writer.
+
+    JSON Lines files are read one line at a time, plain JSON files have to be
+    loaded whole.
+    '''
+    with open(filename, 'rb') as rf:
+        if filename.endswith('.jsonl'):
+            for line in rf:
+                if line.strip():
+                    yield from loads(line).items()
+        else:
+            yield from loads(rf.read()).items()
+
+
+class OrderedMergeWriter:
+    '''Merge values that arrive in any order into items written in their original order.
+
+    items yields (key, dict) pairs. add(key, value) sets dict[field] = value
+    for that key; each item is written as soon as it and every item before it
+    have their value. close() writes the rest, without field if it never
+    arrived. Safe to call add() from several threads.
+    '''
+
+    def __init__(self, writer: Any, items: Iterator[Tuple[str, Dict]], keys: List[str], field: str):
+        self.writer = writer
+        self.field = field
+
+        self._items = items
+        self._keys = list(keys)
+        self._next = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _write_next(self) -> None:
+        key, item = next(self._items)
+        if key in self._pending:
+            item[self.field] = self._pending.pop(key)
+        self.writer.write(key, item)
+        self._next += 1
+
+    def add(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._pending[key] = value
+            while self._next < len(self._keys) and self._keys[self._next] in self._pending:
+                self._write_next()
+
+    def close(self) -> None:
+        with self._lock:
+            while self._next < len(self._keys):
+                self._write_next()
+        self.writer.close()
@@ -1,30 +1,324 @@
-# This script can be used to merge multiple json files output by 
-#  the Collect_State_Info and Scrape_Electrical_Providers scripts.
-#
-
-import json
-import os
-
-
-from Collect_State_Info import *
-from Scrape_Electrical_Providers import OUTPUT_DIR
-
-out_filename = "all-states-utility-info.json"
-
-states_dict = {}
-
-with open(OUTPUT_FILE, 'r') as rf:
-    all_states_info = json.load(rf)
-
-with os.scandir(OUTPUT_DIR) as outputs:
-    for file in outputs:
-        if not file.name.startswith('.'):
-            state_abrv = file.name.split('-')[0]
-            if state_abrv in all_states_info.keys():
-                with open("{}/{}".format(OUTPUT_DIR, file.name), 'r') as rf:
-                    state_info = json.load(rf)
-                all_states_info[state_abrv]['electrical-providers'] = state_info['electrical-providers']
-
-
-with open(out_filename, 'w') as wf:
-    json.dump(all_states_info, wf, indent=1)
+# This script can be used to merge multiple json files output by
+#  the Collect_State_Info and Scrape_Electrical_Providers scripts.
+#
+# States are read, merged and written one at a time. If Collect_State_Info
+#  was run with --jsonl its output is read line by line, so only one state is
+#  held in memory at once.
+#
+# The per-state provider files are parsed and each merged state is encoded in
+#  a pool of workers (threads, or processes with --processes) while the output
+#  is written in order. The merged file can be indented JSON (the default,
+#  same as before), compact JSON, JSON Lines or a Feather table with one row
+#  per state (needs pyarrow).
+#
+# With --populations each provider also gets the census population of the
+#  cities and counties it serves (see Geo_Index.py).
+#
+# A manifest next to the output records the provider file each state was
+#  merged from and where the state is in the output. With --changed only the
+#  states whose provider file changed since are merged again; every other
+#  state is copied from the previous output as is, without parsing it.
+#
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from importlib.util import find_spec
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+# pyarrow (feather format) and pandas (--populations) are imported when used,
+#  a plain json merge doesn't load either
+from Geo_Index import PlaceIndex
+from Scraper_Settings import DATASETS_DIRECTORY_PATH, OUTPUT_DIR, OUTPUT_FILE
+from Scraper_Settings import US_POPULATION_BY_CITY_FILE
+from Json_Stream import JsonLinesWriter, JsonObjectWriter
+from Json_Stream import encode_entry, encode_line, iter_json_object, loads
+
+OUT_FILENAME = "all-states-utility-info"
+MANIFEST_SUFFIX = ".manifest.json"
+
+# output format -> file extension
+FORMATS = {
+    'json': '.json',
+    'compact': '.json',
+    'jsonl': '.jsonl',
+    'feather': '.feather',
+}
+
+# census places used to add populations to the providers, set in each worker
+PLACE_INDEX = None
+
+
+def get_input_filename() -> str:
+    '''Collect_State_Info output, its JSON Lines version if there is one.'''
+    jsonl_file = "{}.jsonl".format(os.path.splitext(OUTPUT_FILE)[0])
+    return jsonl_file if os.path.exists(jsonl_file) else OUTPUT_FILE
+
+def get_provider_files() -> Dict[str, str]:
+    '''Map each state abbreviation to its provider file in OUTPUT_DIR.'''
+    provider_files = {}
+
+    with os.scandir(OUTPUT_DIR) as outputs:
+        for file in outputs:
+            if not file.name.startswith('.'):
+                state_abrv = file.name.split('-')[0]
+                provider_files[state_abrv] = "{}/{}".format(OUTPUT_DIR, file.name)
+
+    return provider_files
+
+def file_info(filepath: Optional[str]) -> Optional[Dict]:
+    if filepath is None or not os.path.exists(filepath):
+        return None
+    stat = os.stat(filepath)
+    return { 'mtime': stat.st_mtime, 'size': stat.st_size }
+
+def read_providers(filepath: str) -> List[Dict]:
+    with open(filepath, 'rb') as rf:
+        providers = loads(rf.read())
+
+    # utility-scraper.py writes the bare list of providers
+    if isinstance(providers, dict):
+        providers = providers['electrical-providers']
+
+    return providers
+
+def set_place_index(index: Optional[PlaceIndex]) -> None:
+    '''Worker initializer, a process pool gets its own copy of the index.'''
+    global PLACE_INDEX
+    PLACE_INDEX = index
+
+def merge_state(fmt: str, key: str, state_info: Dict,
+        provider_file: Optional[str]) -> Tuple[str, Any]:
+    '''Add a state's providers to its info and encode it for fmt.
+
+    Runs in the worker pool. Returns the state and its encoded entry, or its
+    dict for the feather format.
+    '''
+    state_info.pop('electrical-providers', None)
+    if provider_file is not None:
+        state_info['electrical-providers'] = read_providers(provider_file)
+        if PLACE_INDEX is not None:
+            for provider_info in state_info['electrical-providers']:
+                PLACE_INDEX.enrich_provider(provider_info)
+
+    if fmt == 'feather':
+        return key, state_info
+    if fmt == 'jsonl':
+        return key, encode_line(key, state_info)
+    return key, encode_entry(key, state_info, None if fmt == 'compact' else 1)
+
+def completed(result: Any) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+def iter_in_order(futures: Iterator[Future], window: int) -> Iterator[Any]:
+    '''Results of futures in order, pulling at most window futures ahead.'''
+    pending = deque()
+
+    for future in futures:
+        pending.append(future)
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+#### JSON and JSON Lines ####
+
+def open_writer(fmt: str, filename: str) -> Any:
+    if fmt == 'jsonl':
+        return JsonLinesWriter(filename)
+    return JsonObjectWriter(filename, None if fmt == 'compact' else 1)
+
+def merge_text(executor: Executor, window: int, fmt: str, out_filename: str,
+        provider_files: Dict[str, str], manifest: Optional[Dict],
+        changed: Set[str]) -> Dict:
+    '''Write the merged states to out_filename, returns where each one was written.
+
+    With a manifest only the states in changed are merged again, the others
+    are copied from the previous output.
+    '''
+    tmp_path = "{}.tmp".format(out_filename)
+    writer = open_writer(fmt, tmp_path)
+
+    def all_states() -> Iterator[Future]:
+        for key, state_info in iter_json_object(get_input_filename()):
+            yield executor.submit(merge_state, fmt, key, state_info, provider_files.get(key))
+
+    def changed_states(previous) -> Iterator[Future]:
+        for key, (offset, length) in manifest['offsets'].items():
+            previous.seek(offset)
+            entry = previous.read(length)
+
+            if key not in changed:
+                yield completed((key, entry))
+                continue
+
+            _, state_info = writer.read_entry(entry)
+            yield executor.submit(merge_state, fmt, key, state_info, provider_files.get(key))
+
+    try:
+        if manifest is None:
+            for key, entry in iter_in_order(all_states(), window):
+                writer.write_entry(key, entry)
+        else:
+            with open(out_filename, 'rb') as previous:
+                for key, entry in iter_in_order(changed_states(previous), window):
+                    writer.write_entry(key, entry)
+    finally:
+        writer.close()
+
+    os.replace(tmp_path, out_filename)
+    return writer.offsets
+
+#### Feather ####
+
+def states_table(states: List[Tuple[str, Dict]]) -> Any:
+    '''Arrow table with one row per state, a column per top level key.'''
+    import pyarrow as pa
+
+    rows = [ { 'state': key, **state_info } for key, state_info in states ]
+    return pa.Table.from_struct_array(pa.array(rows))
+
+def merge_feather(executor: Executor, window: int, out_filename: str,
+        provider_files: Dict[str, str], manifest: Optional[Dict],
+        changed: Set[str]) -> Dict:
+    '''Write the merged states to a Feather file, returns the state order.
+
+    With a manifest only the states in changed are merged again and swapped
+    into the previous table.
+    '''
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.feather as feather
+
+    states = ( executor.submit(merge_state, 'feather', key, state_info, provider_files.get(key))
+        for key, state_info in iter_json_object(get_input_filename())
+        if manifest is None or key in changed )
+    table = states_table(list(iter_in_order(states, window)))
+
+    if manifest is not None:
+        previous = feather.read_table(out_filename, memory_map=True)
+        kept = previous.filter(pc.invert(pc.is_in(previous['state'], pa.array(list(changed)))))
+        table = pa.concat_tables([ kept, table ], promote_options='permissive')
+
+        position = { key: index for index, key in enumerate(manifest['offsets']) }
+        order = sorted(range(table.num_rows),
+            key=lambda row: position.get(table['state'][row].as_py(), len(position)))
+        table = table.take(order)
+
+    tmp_path = "{}.tmp".format(out_filename)
+    feather.write_feather(table, tmp_path)
+    os.replace(tmp_path, out_filename)
+
+    return { key: None for key in table['state'].to_pylist() }
+
+#### manifest ####
+
+def read_manifest(out_filename: str) -> Optional[Dict]:
+    try:
+        with open(out_filename + MANIFEST_SUFFIX, 'r') as rf:
+            return json.load(rf)
+    except (OSError, ValueError):
+        return None
+
+def write_manifest(out_filename: str, manifest: Dict) -> None:
+    with open(out_filename + MANIFEST_SUFFIX, 'w') as wf:
+        json.dump(manifest, wf)
+
+def get_changed_states(manifest: Optional[Dict], fmt: str, out_filename: str,
+        provider_files: Dict[str, str], populations: bool = False) -> Optional[Set[str]]:
+    '''States whose provider file changed since the manifest was written.
+
+    None if everything has to be merged again: no usable manifest, another
+    format or --populations setting, or Collect_State_Info's output changed.
+    '''
+    if manifest is None or manifest['format'] != fmt or not os.path.exists(out_filename):
+        return None
+    if manifest.get('populations', False) != populations:
+        return None
+
+    input_filename = get_input_filename()
+    if manifest['input'] != [ input_filename, file_info(input_filename) ]:
+        return None
+
+    return { key for key in manifest['offsets']
+        if file_info(provider_files.get(key)) != manifest['sources'].get(key) }
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Merge {} with the provider files in {}/.".format(
+        OUTPUT_FILE, OUTPUT_DIR))
+    parser.add_argument('--format', choices=list(FORMATS), default='json',
+        help="json: indented, compact: no whitespace, jsonl: one state per line, "
+            "feather: columnar, one row per state (default: %(default)s)")
+    parser.add_argument('--output', help="merged file (default: {}.<ext>)".format(OUT_FILENAME))
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+        help="parse and encode states in this many workers (default: %(default)s)")
+    parser.add_argument('--processes', action='store_true',
+        help="use processes instead of threads for the workers")
+    parser.add_argument('--changed', action='store_true',
+        help="only merge the states whose provider file changed since the last merge")
+    parser.add_argument('--populations', action='store_true',
+        help="add the census population of the cities and counties each provider serves")
+    args = parser.parse_args(argv)
+
+    if args.format == 'feather' and find_spec('pyarrow') is None:
+        print("The feather format needs pyarrow", file=sys.stderr)
+        return 1
+
+    out_filename = args.output or OUT_FILENAME + FORMATS[args.format]
+    provider_files = get_provider_files()
+
+    manifest = read_manifest(out_filename) if args.changed else None
+    changed = get_changed_states(manifest, args.format, out_filename, provider_files,
+        args.populations)
+    if changed is None:
+        manifest = None
+    elif not changed:
+        print("{} is up to date".format(out_filename))
+        return 0
+
+    start = time.perf_counter()
+
+    index = None
+    if args.populations:
+        from Collect_State_Info import get_population_df
+
+        population_df = get_population_df("{}/{}".format(DATASETS_DIRECTORY_PATH,
+            US_POPULATION_BY_CITY_FILE))
+        if population_df is None:
+            return 1
+        index = PlaceIndex.from_population_df(population_df)
+
+    pool = ProcessPoolExecutor if args.processes else ThreadPoolExecutor
+    with pool(max_workers=args.workers, initializer=set_place_index, initargs=(index,)) as executor:
+        window = 2 * args.workers
+        if args.format == 'feather':
+            offsets = merge_feather(executor, window, out_filename, provider_files,
+                manifest, changed)
+        else:
+            offsets = merge_text(executor, window, args.format, out_filename, provider_files,
+                manifest, changed)
+
+    input_filename = get_input_filename()
+    write_manifest(out_filename, {
+        'format': args.format,
+        'populations': args.populations,
+        'input': [ input_filename, file_info(input_filename) ],
+        'sources': { key: file_info(provider_files.get(key)) for key in offsets },
+        'offsets': offsets,
+    })
+
+    print("Merged {} states into {} in {:.2f}s".format(
+        len(offsets) if changed is None else len(changed), out_filename,
+        time.perf_counter() - start))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,344 @@
+# On-disk cache for findenergy.com pages and the data scraped from them.
+#
+# Page bodies and scraped records are stored once per content hash under
+# CACHE_DIR/objects and an sqlite index maps each url to its current body and
+# record along with the ETag/Last-Modified headers needed to revalidate it.
+#
+# A record is tied to the body it was scraped from. As long as a page is
+# fresh, or the site answers a conditional request with 304 or returns the
+# same bytes, the cached record is reused and the page is never opened in a
+# browser. Entries are evicted least recently used first once the cache grows
+# past max_bytes.
+#
+# Several processes can share a cache (the Scrape_Cluster.py workers): the
+# index runs in WAL mode and waits for the other writers instead of failing.
+#
+
+# Python standard libs
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional
+
+# 3rd party libs, httpx is imported where a request is made so importing
+#  this module stays cheap (see Benchmark.py)
+if TYPE_CHECKING:
+    import httpx
+
+# local module
+from Json_Stream import json_default
+from Provider_Page_Parser import fetch_page
+from Rate_Control import request_with_retry
+
+CACHE_DIR = ".cache/pages"
+CACHE_INDEX = "index.sqlite"
+BUSY_TIMEOUT = 60           # seconds to wait for another process writing the index
+
+DEFAULT_TTL = 30 * 24 * 60 * 60         # 30 days, provider data changes about once a year
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024   # 512 MB
+
+
+class CachedPage:
+    '''Body of a page returned by PageCache.fetch().
+
+    changed is False when the body is the same one the cached record (if
+    any) was scraped from.
+    '''
+
+    def __init__(self, url: str, text: str, changed: bool):
+        self.url = url
+        self.text = text
+        self.changed = changed
+
+
+class PageCache:
+    '''Url keyed, content addressed page cache with a TTL and LRU eviction.'''
+
+    def __init__(self, directory: str = CACHE_DIR, ttl: float = DEFAULT_TTL,
+            max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.stats = {
+            'hits': 0,          # fresh page served without a request
+            'revalidated': 0,   # stale page confirmed by a 304 or an identical body
+            'misses': 0,        # page downloaded
+            'record-hits': 0,
+            'record-misses': 0,
+            'evicted': 0,
+        }
+
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, CACHE_INDEX),
+            timeout=BUSY_TIMEOUT, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS pages (
+                url             TEXT PRIMARY KEY,
+                body            TEXT,
+                record          TEXT,
+                etag            TEXT,
+                last_modified   TEXT,
+                fetched         REAL NOT NULL,
+                accessed        REAL NOT NULL,
+                size            INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS stats (
+                name    TEXT PRIMARY KEY,
+                count   INTEGER NOT NULL
+            )
+        ''')
+        self._db.commit()
+
+    #### content addressed objects ####
+
+    def _object_path(self, key: str) -> str:
+        return os.path.join(self.directory, 'objects', key[:2], key)
+
+    def _read_object(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._object_path(key), 'rb') as rf:
+                return rf.read()
+        except OSError:
+            return None
+
+    def _write_object(self, content: bytes) -> str:
+        key = hashlib.sha256(content).hexdigest()
+        path = self._object_path(key)
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write to a temporary file first so a crash never leaves half an object,
+            # named after the process and thread as other processes may write it too
+            tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+            with open(tmp_path, 'wb') as wf:
+                wf.write(content)
+            os.replace(tmp_path, path)
+
+        return key
+
+    def _object_size(self, key: Optional[str]) -> int:
+        if key is None:
+            return 0
+        try:
+            return os.path.getsize(self._object_path(key))
+        except OSError:
+            return 0
+
+    def _remove_unused_objects(self, keys: list) -> None:
+        for key in keys:
+            if key is None:
+                continue
+            in_use = self._db.execute(
+                "SELECT 1 FROM pages WHERE body = ? OR record = ? LIMIT 1", (key, key)
+            ).fetchone()
+            if in_use is None:
+                try:
+                    os.remove(self._object_path(key))
+                except OSError:
+                    pass
+
+    #### index ####
+
+    def _entry(self, url: str) -> Optional[Dict]:
+        row = self._db.execute(
+            "SELECT body, record, etag, last_modified, fetched FROM pages WHERE url = ?", (url,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        return dict(zip(('body', 'record', 'etag', 'last_modified', 'fetched'), row))
+
+    def _store(self, url: str, body: Optional[str], record: Optional[str],
+            etag: Optional[str], last_modified: Optional[str], fetched: float) -> None:
+        old = self._entry(url)
+        size = self._object_size(body) + self._object_size(record)
+
+        self._db.execute('''
+            INSERT OR REPLACE INTO pages
+                (url, body, record, etag, last_modified, fetched, accessed, size)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (url, body, record, etag, last_modified, fetched, time.time(), size))
+
+        if old is not None:
+            self._remove_unused_objects([ old['body'], old['record'] ])
+
+        self._evict()
+        self._db.commit()
+
+    def _touch(self, url: str, fetched: Optional[float] = None) -> None:
+        if fetched is None:
+            self._db.execute("UPDATE pages SET accessed = ? WHERE url = ?",
+                (time.time(), url))
+        else:
+            self._db.execute("UPDATE pages SET accessed = ?, fetched = ? WHERE url = ?",
+                (time.time(), fetched, url))
+        self._db.commit()
+
+    def _evict(self) -> None:
+        '''Drop the least recently used entries until the cache fits in max_bytes.'''
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        rows = self._db.execute(
+            "SELECT url, body, record, size FROM pages ORDER BY accessed ASC").fetchall()
+        for url, body, record, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM pages WHERE url = ?", (url,))
+            self._remove_unused_objects([ body, record ])
+            total -= size
+            self.stats['evicted'] += 1
+
+    def _is_fresh(self, entry: Dict) -> bool:
+        return time.time() - entry['fetched'] < self.ttl
+
+    #### public interface ####
+
+    def fetch(self, client: 'httpx.Client', url: str) -> Optional[CachedPage]:
+        '''Return the body of a page, downloading it only when the cached copy is stale.
+
+        Stale pages are revalidated with If-None-Match/If-Modified-Since.
+        Returns None if the page could not be fetched.
+        '''
+        import httpx
+
+        with self._lock:
+            entry = self._entry(url)
+
+        cached_body = None
+        if entry is not None and entry['body'] is not None:
+            cached_body = self._read_object(entry['body'])
+
+        if cached_body is not None and self._is_fresh(entry):
+            with self._lock:
+                self.stats['hits'] += 1
+                self._touch(url)
+            return CachedPage(url, cached_body.decode('utf-8'), changed=False)
+
+        headers = {}
+        if cached_body is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            response = request_with_retry(client, url, headers)
+            if response.status_code != 304:
+                response.raise_for_status()
+        except httpx.HTTPError as err:
+            print(err, file=sys.stderr)
+            return None
+
+        now = time.time()
+
+        if response.status_code == 304 and cached_body is not None:
+            with self._lock:
+                self.stats['revalidated'] += 1
+                self._touch(url, fetched=now)
+            return CachedPage(url, cached_body.decode('utf-8'), changed=False)
+
+        text = response.text
+        body = self._write_object(text.encode('utf-8'))
+        changed = entry is None or entry['body'] != body
+
+        with self._lock:
+            if changed:
+                self.stats['misses'] += 1
+            else:
+                self.stats['revalidated'] += 1
+
+            # a new body invalidates the record that was scraped from the old one
+            record = entry['record'] if entry is not None and not changed else None
+            self._store(url, body, record, response.headers.get('ETag'),
+                response.headers.get('Last-Modified'), now)
+
+        return CachedPage(url, text, changed)
+
+    def get_record(self, url: str) -> Optional[Any]:
+        '''Return the data scraped from url if it is still valid.'''
+        with self._lock:
+            entry = self._entry(url)
+
+            if entry is None or entry['record'] is None or not self._is_fresh(entry):
+                self.stats['record-misses'] += 1
+                return None
+
+            content = self._read_object(entry['record'])
+            if content is None:
+                self.stats['record-misses'] += 1
+                return None
+
+            self.stats['record-hits'] += 1
+            self._touch(url)
+
+        return json.loads(content)
+
+    def put_record(self, url: str, record: Any) -> None:
+        '''Cache the data scraped from url alongside the page it came from.'''
+        key = self._write_object(json.dumps(record, default=json_default).encode('utf-8'))
+
+        with self._lock:
+            entry = self._entry(url)
+            if entry is None or entry['body'] is None:
+                # scraped without fetching the page, the TTL starts now
+                self._store(url, None, key, None, None, time.time())
+            else:
+                self._store(url, entry['body'], key, entry['etag'],
+                    entry['last_modified'], entry['fetched'])
+
+    def summary(self) -> str:
+        return ", ".join("{} {}".format(count, name) for name, count in self.stats.items())
+
+    def close(self) -> None:
+        '''Add this run's statistics to the totals kept in the index and close it.'''
+        with self._lock:
+            for name, count in self.stats.items():
+                self._db.execute('''
+                    INSERT INTO stats (name, count) VALUES (?, ?)
+                    ON CONFLICT(name) DO UPDATE SET count = count + excluded.count
+                ''', (name, count))
+            self._db.commit()
+            self._db.close()
+
+
+def cached_record(cache: Optional[PageCache], client: Optional['httpx.Client'], url: str,
+        build: Callable[[Optional[str]], Any], records: bool = True) -> Any:
+    '''Return the data scraped from url, calling build(html) only when needed.
+
+    html is the page fetched over plain http, or None without a client (or
+    when the request failed). Without a cache build() is always called, and
+    so it is when records is False, which only caches the page itself.
+    '''
+    if cache is None:
+        html = fetch_page(client, url) if client is not None else None
+        return build(html)
+
+    html = None
+    if client is not None:
+        page = cache.fetch(client, url)
+        if page is not None:
+            html = page.text
+
+    if not records:
+        return build(html)
+
+    record = cache.get_record(url)
+    if record is not None:
+        return record
+
+    record = build(html)
+    cache.put_record(url, record)
+
+    return record
@@ -0,0 +1,410 @@
+# Browser-free extractor for findenergy.com provider pages.
+#
+# Provider pages are rendered on the server, so the company overview, the
+# SALES & CUSTOMERS / ENERGY PRODUCTION facts and the city list are all in the
+# html returned by a plain GET request. The page is parsed with the same CSS
+# selectors used by get_provider_info() in Scrape_Electrical_Providers.py and
+# produces the same dictionary.
+#
+# Only the first page of the paginated county and state tables is part of the
+# html. When a table holds more rows than were rendered the page is reported
+# as incomplete (None) and the caller falls back to the Selenium scraper,
+# unless the rows needed (row_limit, see set_field_profile() in
+# Scrape_Electrical_Providers.py) are all on the first page.
+#
+# fixtures/ holds findenergy.com pages along with what the parsers should
+#  return for them, the checks run offline:
+#
+#   python3 Provider_Page_Parser.py
+#
+
+# Python standard libs
+import json
+import os
+import sys
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+from urllib.parse import urljoin
+
+# 3rd party libs, imported where a page is fetched or parsed so importing
+#  this module stays cheap (see Benchmark.py)
+if TYPE_CHECKING:
+    import httpx
+    from bs4 import BeautifulSoup
+
+# local module
+from Rate_Control import request_with_retry
+
+HTTP_TIMEOUT = 30
+HTTP_MAX_CONNECTIONS = 10
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64; rv:105.0) Gecko/20100101 Firefox/105.0"
+
+# raised by the parsers when the markup isn't what they expect
+PARSE_ERRORS = ( AttributeError, IndexError, ValueError )
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+FIXTURE_CASES = "cases.json"
+
+
+def get_http_client(max_connections: int = HTTP_MAX_CONNECTIONS) -> 'httpx.Client':
+    '''Create an http client that keeps connections to the site open between requests.'''
+    import httpx
+
+    limits = httpx.Limits(max_connections=max_connections,
+        max_keepalive_connections=max_connections)
+
+    return httpx.Client(headers={'User-Agent': USER_AGENT}, limits=limits,
+        timeout=HTTP_TIMEOUT, follow_redirects=True)
+
+def fetch_page(client: 'httpx.Client', url: str) -> Optional[str]:
+    '''Fetch the html for a page, returns None if the request failed after its retries.'''
+    import httpx
+
+    try:
+        response = request_with_retry(client, url)
+        response.raise_for_status()
+    except httpx.HTTPError as err:
+        print(err, file=sys.stderr)
+        return None
+
+    return response.text
+
+def _soup(html: str) -> 'BeautifulSoup':
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(html, "html.parser")
+
+def _text(element: Any) -> str:
+    '''Text of an element with whitespace collapsed like WebElement.text.'''
+    return " ".join(element.get_text().split())
+
+def parse_number(text: str) -> float:
+    '''Parse a number written with thousands separators ("1,234.5").'''
+    return float(text.replace(',', ''))
+
+def parse_count(text: str) -> int:
+    '''Parse a whole number written with thousands separators ("1,234").'''
+    return int(text.replace(',', ''))
+
+def table_count(section: Any) -> Optional[int]:
+    '''Number of rows in a paginated table from its footer (e.g. "25 items").'''
+    footer = section.select_one(".table-footer__data.svelte-x63klk")
+    if footer is None:
+        return None
+
+    return parse_count(_text(footer).split(' ')[0])
+
+def parse_table(section: Any, page_url: str, is_link: bool, key1: str, key2: str,
+        max_items: Optional[int] = None) -> Optional[List[Dict]]:
+    '''Parse the rows of a table section (see scrape_table()).
+
+    Returns None if the section holds more rows than are in the html, only
+    the first max_items rows are needed when it is given.
+    '''
+    num_items = table_count(section)
+    if num_items is None:
+        return None
+    if max_items is not None:
+        num_items = min(num_items, max_items)
+
+    item_list = []
+    for row in section.select(".table.sortable-table.svelte-x63klk tbody tr.svelte-x63klk"):
+        columns = row.select("td.svelte-x63klk")
+        item = {}
+
+        if is_link:
+            link = columns[0].select_one("a")
+            # split url by '/' and get 3rd from last item which is the state abbreviation
+            state = urljoin(page_url, link.get("href")).split('/')[-3].upper()
+            item[key1] = "{}, {}".format(_text(link), state)
+        else:
+            item[key1] = _text(columns[0])
+
+        item[key2] = parse_count(_text(columns[1]))
+        item_list.append(item)
+
+        if len(item_list) == num_items and max_items is not None:
+            break
+
+    if len(item_list) != num_items:
+        return None
+
+    return item_list
+
+def parse_provider_overview(soup: 'BeautifulSoup', url: str) -> Optional[Dict]:
+    '''Parse everything on a provider page but the county and state tables.
+
+    Returns None when any of the content is missing from the html.
+    '''
+    provider_info = {}
+
+    title = soup.select_one(".overview__title.svelte-1f6rrn3")
+    if title is None:
+        return None
+    provider_info['company'] = _text(title)
+
+    company_overview_sections = soup.select("section#overview .col-lg-5")
+    if len(company_overview_sections) < 2:
+        return None
+
+    type_spans = company_overview_sections[0].select("li.svelte-1f6rrn3 span.svelte-1f6rrn3")
+    if len(type_spans) < 2:
+        return None
+    provider_info['company-type'] = _text(type_spans[1])
+
+    company_website = ''
+    info_lists = company_overview_sections[0].select(
+        "ul.list-unstyled.company-info__list.svelte-1f6rrn3")
+    if len(info_lists) > 1:
+        website = info_lists[1].select_one("li.svelte-1f6rrn3 a")
+        if website is not None and website.get("href") is not None:
+            company_website = urljoin(url, website.get("href"))
+    provider_info['website'] = company_website
+
+    # get provider types (residential, commercial, industrial)
+    tab_nav = soup.select_one(".tab-nav.tab-nav--underlined.svelte-9ar7ba")
+    if tab_nav is None:
+        return None
+    provider_info['service-types'] = [ _text(item) for item in tab_nav.select(".tab-nav__link") ]
+
+    # collect customers by type
+    sidebar = soup.select_one(".sidebar-widget")
+    if sidebar is None:
+        return None
+    stats_sections = sidebar.select(".facts-item.svelte-3uw1eb")
+    if len(stats_sections) < 2:
+        return None
+
+    section_title = stats_sections[0].select_one("h3.facts-item__title.svelte-3uw1eb")
+    if section_title is not None and _text(section_title) == "SALES & CUSTOMERS":
+        total_customers = 0
+        for section in stats_sections[0].select(".facts-item__li.svelte-3uw1eb"):
+            # Replace spaces with '-' for key
+            text = _text(section.select_one(
+                "h4.facts-item__label.svelte-3uw1eb")).replace(' ', '-')
+            stat = _text(section.select_one(
+                "p.facts-item__data.svelte-3uw1eb strong")).strip('$')
+
+            amount = parse_number(stat)
+
+            if "Customers" in text:
+                total_customers += amount
+            else:
+                text = "{}-($)".format(text)
+
+            provider_info[text] = amount
+
+        provider_info['Total-Customers'] = total_customers
+
+    # collect energy production
+    section_title = stats_sections[1].select_one("h3.facts-item__title.svelte-3uw1eb")
+    if section_title is not None and _text(section_title) == "ENERGY PRODUCTION":
+        for section in stats_sections[1].select(".facts-item__li.svelte-3uw1eb"):
+            text = _text(section.select_one(
+                ".facts-item__label.svelte-3uw1eb")).replace(' ', '-')
+            stat = _text(section.select_one(".facts-item__data.svelte-3uw1eb strong"))
+            units = _text(section.select_one(".text-muted"))
+            text = "{}-{}".format(text, units)
+
+            provider_info[text] = parse_number(stat)
+
+    # scrape_state() sorts providers on this key
+    if 'Total-Customers' not in provider_info:
+        return None
+
+    #### COLLECT CITIES SERVED ####
+    city_section = soup.select_one("#city-coverage")
+    if city_section is not None:
+        city_elements = city_section.select("li.svelte-1f6rrn3")
+    else:
+        # no city-coverage section at the bottom of the page, grab cities from top of page
+        city_section = company_overview_sections[1].select_one(
+            "ul.list-unstyled.company-info__list.svelte-1f6rrn3:nth-child(3) > li:nth-child(3)")
+        if city_section is None:
+            return None
+        city_elements = city_section.select("ul.list-unstyled li")
+
+    provider_info["cities-served"] = [ _text(city) for city in city_elements ]
+
+    return provider_info
+
+def parse_provider_page(html: str, url: str, row_limit: Optional[int] = None) -> Optional[Dict]:
+    '''Parse a provider page into the dictionary built by get_provider_info().
+
+    Returns None when any of the content is missing from the html. With a
+    row_limit only that many rows of the county and state tables are read
+    (none for 0) and the full size of each table is added to the record.
+    '''
+    soup = _soup(html)
+
+    provider_info = parse_provider_overview(soup, url)
+    if provider_info is None:
+        return None
+
+    #### Collect counties served ####
+    county_section = soup.select_one("#county-coverage")
+    if county_section is not None and row_limit is not None:
+        provider_info['counties-count'] = table_count(county_section)
+        if provider_info['counties-count'] is None:
+            return None
+
+    if county_section is not None and row_limit != 0:
+        counties = parse_table(county_section, url,
+            is_link=True, key1="county", key2="population", max_items=row_limit)
+        if counties is None:
+            return None
+
+        provider_info['counties-served'] = sorted(counties, reverse=True,
+            key= lambda county: county['population'])
+
+    #### Collect states served ####
+    states_section = soup.select_one("#state-coverage")
+    if states_section is None:
+        return None
+
+    if row_limit is not None:
+        provider_info['states-count'] = table_count(states_section)
+        if provider_info['states-count'] is None:
+            return None
+
+    if row_limit != 0:
+        states = parse_table(states_section, url,
+            is_link=False, key1="state", key2="customers", max_items=row_limit)
+        if states is None:
+            return None
+
+        provider_info["states-served"] = sorted(states, reverse=True,
+            key= lambda state: state['customers'])
+
+    return provider_info
+
+def parse_provider_summary(html: str, url: str) -> Optional[Dict]:
+    '''Parse the overview of a provider page along with the size of its tables.
+
+    Works for pages whose tables span several pages, the number of rows of
+    each table is returned as 'counties-count' and 'states-count' (None when
+    the page has no such table).
+    '''
+    soup = _soup(html)
+
+    provider_info = parse_provider_overview(soup, url)
+    if provider_info is None:
+        return None
+
+    county_section = soup.select_one("#county-coverage")
+    states_section = soup.select_one("#state-coverage")
+    provider_info['counties-count'] = table_count(county_section) if county_section else None
+    provider_info['states-count'] = table_count(states_section) if states_section else None
+
+    return provider_info
+
+def parse_state_page(html: str, url: str) -> Optional[Dict]:
+    '''Parse the providers table of a state's homepage (e.g. https://findenergy.com/ak).
+
+    Returns the number of providers in the table ('count') and the links on
+    its first page ('urls'), None if the table is missing.
+    '''
+    soup = _soup(html)
+
+    provider_section = soup.select_one("#electricity-providers")
+    if provider_section is None:
+        return None
+
+    count = table_count(provider_section)
+    if count is None:
+        return None
+
+    urls = []
+    for link in provider_section.select(
+            ".table.sortable-table.svelte-x63klk tbody tr.svelte-x63klk td.svelte-x63klk a"):
+        if link.get("href") is not None:
+            urls.append(urljoin(url, link.get("href")))
+
+    return { 'count': count, 'urls': urls }
+
+def read_provider_page(html: str, url: str, row_limit: Optional[int] = None) -> Optional[Dict]:
+    '''parse_provider_page() that also returns None when the markup is unexpected.'''
+    try:
+        provider_info = parse_provider_page(html, url, row_limit)
+    except PARSE_ERRORS as err:
+        # markup didn't match what the parser expects
+        print("Unable to parse {}: {}".format(url, err), file=sys.stderr)
+        return None
+
+    if provider_info is not None:
+        print("Scraped {} over http".format(provider_info['company']))
+
+    return provider_info
+
+def read_provider_summary(html: str, url: str) -> Optional[Dict]:
+    '''parse_provider_summary() that also returns None when the markup is unexpected.'''
+    try:
+        return parse_provider_summary(html, url)
+    except PARSE_ERRORS as err:
+        print("Unable to parse {}: {}".format(url, err), file=sys.stderr)
+        return None
+
+def read_state_page(html: str, url: str) -> Optional[Dict]:
+    '''parse_state_page() that also returns None when the markup is unexpected.'''
+    try:
+        return parse_state_page(html, url)
+    except PARSE_ERRORS as err:
+        print("Unable to parse {}: {}".format(url, err), file=sys.stderr)
+        return None
+
+def get_provider_info_http(client: 'httpx.Client', url: str) -> Optional[Dict]:
+    '''Fetch and parse a provider page without a browser.
+
+    Returns None when the page could not be fetched or is missing content,
+    in which case get_provider_info() should be used instead.
+    '''
+    html = fetch_page(client, url)
+    if html is None:
+        return None
+
+    return read_provider_page(html, url)
+
+#### saved pages ####
+
+def check_fixtures(directory: str = FIXTURES_DIR) -> List[str]:
+    '''Parse the pages listed in directory/cases.json, returns the ones that didn't parse as expected.
+
+    Each case names the page, the url it was saved from, the parser
+    ('provider' or 'state'), an optional row-limit and the file holding the
+    expected result (null when the page must be reported as incomplete).
+    '''
+    with open(os.path.join(directory, FIXTURE_CASES), 'r') as rf:
+        cases = json.load(rf)
+
+    failed = []
+    for case in cases:
+        with open(os.path.join(directory, case['page']), 'r', encoding='utf-8') as rf:
+            html = rf.read()
+
+        if case['parser'] == 'state':
+            result = parse_state_page(html, case['url'])
+        else:
+            result = parse_provider_page(html, case['url'], case.get('row-limit'))
+
+        expected = None
+        if case['expected'] is not None:
+            with open(os.path.join(directory, case['expected']), 'r') as rf:
+                expected = json.load(rf)
+
+        name = case['page'] if 'row-limit' not in case else "{} (row limit {})".format(
+            case['page'], case['row-limit'])
+        if result != expected:
+            print("{}: expected {}, got {}".format(name, expected, result), file=sys.stderr)
+            failed.append(name)
+
+    return failed
+
+def main() -> int:
+    failed = check_fixtures()
+    if failed:
+        print("Pages not parsed as expected: {}".format(", ".join(failed)), file=sys.stderr)
+        return 1
+
+    print("All saved pages parsed as expected")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
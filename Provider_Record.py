@@ -0,0 +1,104 @@
+# Compact in-memory form of the scraped provider records.
+#
+# A provider is a dict whose keys are built from the page ("Residential-Sales-($)",
+#  "Net-Generation-MWh", ...) plus a row for every county and state it serves.
+#  Large utilities serve hundreds of counties, so a full run holds tens of
+#  thousands of two key row dicts, each with its own copy of its strings.
+#
+# compact_provider() keeps the provider a dict but:
+#
+#   - turns the county and state rows into CountyServed and StateServed, slotted
+#     read-only mappings a third of the size of a dict
+#   - interns the keys and the repeated values (county, city and state names,
+#     company and service types), so each distinct string is held once
+#
+# The rows read like the dicts they replace (row['county'], row.get(...),
+#  == with a dict) and json_default() in Json_Stream.py encodes them the same,
+#  so the output files don't change.
+#
+
+# Python standard libs
+import sys
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, List
+
+# provider keys whose value is a string or list of strings repeated across providers
+INTERNED_VALUES = [ 'company-type', 'service-types', 'cities-served' ]
+
+
+class ServedRow(Mapping):
+    '''A row of a provider's county or state table, a read-only mapping of its slots.'''
+    __slots__ = ()
+
+    def __init__(self, *values: Any):
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    @classmethod
+    def from_mapping(cls, row: Mapping) -> 'ServedRow':
+        if isinstance(row, cls):
+            return row
+        return cls(*[ row[name] for name in cls.__slots__ ])
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.__slots__)
+
+    def __len__(self) -> int:
+        return len(self.__slots__)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("{} is read-only".format(type(self).__name__))
+
+    def __reduce__(self):
+        return (type(self), tuple(getattr(self, name) for name in self.__slots__))
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+class CountyServed(ServedRow):
+    '''{'county': "Albany County, NY", 'population': 314848}'''
+    __slots__ = ('county', 'population')
+
+    def __init__(self, county: str, population: int):
+        super().__init__(sys.intern(county), population)
+
+
+class StateServed(ServedRow):
+    '''{'state': "New York", 'customers': 1700000}'''
+    __slots__ = ('state', 'customers')
+
+    def __init__(self, state: str, customers: int):
+        super().__init__(sys.intern(state), customers)
+
+
+# provider key -> row class of its table
+SERVED_ROWS = { 'counties-served': CountyServed, 'states-served': StateServed }
+
+
+def _intern_value(value: Any) -> Any:
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, list):
+        return [ sys.intern(item) if isinstance(item, str) else item for item in value ]
+    return value
+
+def compact_rows(rows: List[Mapping], row_class: type) -> List[ServedRow]:
+    return [ row_class.from_mapping(row) for row in rows ]
+
+def compact_provider(provider_info: Dict) -> Dict:
+    '''The provider record with interned keys and values and slotted table rows.'''
+    compact = {}
+    for key, value in provider_info.items():
+        if key in SERVED_ROWS:
+            value = compact_rows(value, SERVED_ROWS[key])
+        elif key in INTERNED_VALUES:
+            value = _intern_value(value)
+        compact[sys.intern(key)] = value
+
+    return compact
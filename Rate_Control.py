@@ -0,0 +1,416 @@
+# Adaptive request rate and retries for findenergy.com.
+#
+# A RateController paces the requests to one host and caps how many of them
+#  are in flight. Both limits follow what the site tolerates, AIMD style like
+#  TCP congestion control: every quick response raises them a little (the
+#  rate by about RATE_STEP requests a second each second, the window by one
+#  request each round trip) and a throttled (429/503) or slow response, or a
+#  run of failed ones, cuts them by DECREASE_FACTOR. Until the first cut the
+#  limits grow by SLOW_START_STEP a response instead, so a run finds the
+#  site's pace quickly. Cuts are at most one per cooldown, so a burst of
+#  errors from requests that were already in flight counts once. A
+#  Retry-After header pauses the host for as long as the site asks.
+#
+# request_with_retry() classifies each failure: throttling and transient
+#  errors (timeouts, dropped connections, 500/502/504) are retried with
+#  jittered exponential backoff, anything else (404, ...) is handed back at
+#  once. retry_call() does the same for browser pages.
+#
+# check_rate_control() drives a controller against a Stand_In_Server.py that
+#  throttles and fails requests, and checks that it backs off, retries and
+#  recovers once the site has room again. It runs offline:
+#
+#   python3 Rate_Control.py
+#
+
+# Python standard libs
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple, TypeVar
+from urllib.parse import urlsplit
+
+# 3rd party libs, httpx is imported where a request is made so importing
+#  this module stays cheap (see Benchmark.py)
+if TYPE_CHECKING:
+    import httpx
+
+# local module
+from Scrape_Trace import sleep
+
+DEFAULT_RATE = 4.0          # requests per second per host to start with
+DEFAULT_MIN_RATE = 0.25
+DEFAULT_MAX_RATE = 32.0
+DEFAULT_WINDOW = 4          # requests in flight per host to start with
+DEFAULT_MAX_WINDOW = 16
+
+RATE_STEP = 0.5             # requests per second added per second of quick responses
+SLOW_START_STEP = 0.5       # requests per second added per quick response before the first cut
+DECREASE_FACTOR = 0.5
+DECREASE_COOLDOWN = 1.0     # seconds, or the smoothed latency when that is longer
+LATENCY_SMOOTHING = 0.2
+LATENCY_TOLERANCE = 2.0     # smoothed latency over the baseline that counts as slow
+LATENCY_FLOOR = 0.05        # seconds, keeps jitter on fast links from counting as slow
+BASELINE_DRIFT = 0.01       # lets the baseline follow a site that got slower for good
+ERROR_SMOOTHING = 0.1
+ERROR_TOLERANCE = 0.25      # smoothed share of failed requests that counts as a run
+
+DEFAULT_RETRIES = 4
+BACKOFF_BASE = 0.5          # seconds, doubled on every retry
+BACKOFF_MAX = 30.0
+RETRY_AFTER_MAX = 300.0
+
+# how a request ended
+OK = 'ok'
+THROTTLED = 'throttled'     # the site asked us to slow down, retry later
+TRANSIENT = 'transient'     # timeout, dropped connection or server error, retry
+FATAL = 'fatal'             # retrying won't help (404, ...)
+
+# check_rate_control(): a stand-in site answering CHECK_CAPACITY requests a
+#  second, hit with CHECK_THREADS threads and a controller starting well over it
+CHECK_STATES = [ 'AK' ]
+CHECK_CAPACITY = 20
+CHECK_ERROR_RATE = 0.05
+CHECK_THREADS = 8
+CHECK_ROUNDS = 2            # times every provider page is fetched per phase
+CHECK_THROTTLED_SHARE = 0.1 # most requests throttled once the controller backed off
+
+THROTTLE_STATUS = { 429, 503 }
+TRANSIENT_STATUS = { 500, 502, 504 }
+
+T = TypeVar('T')
+
+
+def transient_errors() -> Tuple[type, ...]:
+    '''httpx errors worth retrying: timeouts, dropped connections.'''
+    import httpx
+    return ( httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError )
+
+def classify(response: Optional['httpx.Response'], error: Optional[Exception] = None) -> str:
+    '''Outcome of a request from its response, or the error raised instead.'''
+    if error is not None:
+        return TRANSIENT if isinstance(error, transient_errors()) else FATAL
+
+    if response.status_code in THROTTLE_STATUS:
+        return THROTTLED
+    if response.status_code in TRANSIENT_STATUS:
+        return TRANSIENT
+    if response.status_code >= 400:
+        return FATAL
+    return OK
+
+def retry_after(response: 'httpx.Response') -> Optional[float]:
+    '''Seconds to wait from a Retry-After header (seconds or an http date), None without one.'''
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+
+    return min(max(seconds, 0.0), RETRY_AFTER_MAX)
+
+def backoff_delay(attempt: int) -> float:
+    '''Seconds before retry number attempt (from 0), full jitter so retries don't line up.'''
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class RateController:
+    '''AIMD limits on the rate and concurrency of the requests to one host.
+
+    Safe to share between threads. Call start() before every request, sleep
+    for the seconds it returns, and finish() with how the request went.
+    '''
+
+    def __init__(self, rate: float = DEFAULT_RATE, min_rate: float = DEFAULT_MIN_RATE,
+            max_rate: float = DEFAULT_MAX_RATE, window: int = DEFAULT_WINDOW,
+            max_window: int = DEFAULT_MAX_WINDOW):
+        self.min_rate = min_rate
+        self.max_rate = max(max_rate, min_rate)
+        self.rate = min(max(rate, min_rate), self.max_rate)
+        self.max_window = max(max_window, 1)
+        self.window = float(min(max(window, 1), self.max_window))
+        self.in_flight = 0
+        self.latency = None         # smoothed seconds per request
+        self.baseline = None        # latency of the site when it isn't loaded
+        self.errors = 0.0           # smoothed share of requests that failed
+        self.stats = {
+            'requests': 0,
+            THROTTLED: 0,
+            TRANSIENT: 0,
+            FATAL: 0,
+            'slow': 0,
+            'retries': 0,
+            'decreases': 0,
+        }
+
+        self._next_send = 0.0
+        self._paused_until = 0.0
+        self._last_decrease = float('-inf')
+        self._slow_start = True
+        self._slot = threading.Condition()
+
+    def can_start(self) -> bool:
+        '''Whether the window has room for another request.'''
+        return self.in_flight < int(self.window)
+
+    def start(self) -> float:
+        '''Wait for room in the window, returns the seconds to wait before sending.'''
+        with self._slot:
+            self._slot.wait_for(self.can_start)
+            return self._reserve()
+
+    def try_start(self) -> Optional[float]:
+        '''start() without waiting, None when the window is full (for the event loop).'''
+        with self._slot:
+            if not self.can_start():
+                return None
+            return self._reserve()
+
+    def _reserve(self) -> float:
+        self.in_flight += 1
+        self.stats['requests'] += 1
+
+        now = time.monotonic()
+        send = max(now, self._next_send, self._paused_until)
+        self._next_send = send + 1 / self.rate
+        return send - now
+
+    def finish(self, latency: Optional[float], outcome: Optional[str],
+            pause: Optional[float] = None) -> None:
+        '''Record how a request went and adjust the limits.
+
+        outcome None gives the slot back without a verdict (the request was
+        cancelled), pause is the Retry-After of a throttled response.
+        '''
+        with self._slot:
+            self.in_flight -= 1
+            now = time.monotonic()
+
+            if outcome == THROTTLED:
+                self.stats[THROTTLED] += 1
+                self._decrease(now)
+                if pause:
+                    self._paused_until = max(self._paused_until, now + pause)
+            elif outcome == TRANSIENT:
+                self.stats[TRANSIENT] += 1
+                # the odd failure is noise, only a run of them means the site is struggling
+                self.errors += ERROR_SMOOTHING * (1 - self.errors)
+                if self.errors > ERROR_TOLERANCE:
+                    self._decrease(now)
+            elif outcome is not None:
+                if outcome == FATAL:
+                    self.stats[FATAL] += 1
+                # the site answered, whatever the answer, so the latency counts
+                self._response(now, latency)
+
+            self._slot.notify_all()
+
+    def retrying(self) -> None:
+        with self._slot:
+            self.stats['retries'] += 1
+
+    def _response(self, now: float, latency: Optional[float]) -> None:
+        self.errors -= ERROR_SMOOTHING * self.errors
+        if latency is not None:
+            if self.latency is None:
+                self.latency = self.baseline = latency
+            else:
+                self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+                if latency < self.baseline:
+                    self.baseline = latency
+                else:
+                    self.baseline += BASELINE_DRIFT * (latency - self.baseline)
+
+            if self.latency > LATENCY_TOLERANCE * max(self.baseline, LATENCY_FLOOR):
+                if self._decrease(now):
+                    self.stats['slow'] += 1
+                return
+
+        if self._slow_start:
+            self.rate = min(self.max_rate, self.rate + SLOW_START_STEP)
+            self.window = min(self.max_window, self.window + 1)
+        else:
+            self.rate = min(self.max_rate, self.rate + RATE_STEP / self.rate)
+            self.window = min(self.max_window, self.window + 1 / self.window)
+
+    def _decrease(self, now: float) -> bool:
+        if now - self._last_decrease < max(DECREASE_COOLDOWN, self.latency or 0.0):
+            return False
+
+        self._last_decrease = now
+        self._slow_start = False
+        self.rate = max(self.min_rate, self.rate * DECREASE_FACTOR)
+        self.window = max(1.0, self.window * DECREASE_FACTOR)
+        self.stats['decreases'] += 1
+        return True
+
+    def summary(self) -> Dict:
+        with self._slot:
+            return dict(self.stats,
+                rate=round(self.rate, 2),
+                window=int(self.window),
+                latency=round(self.latency or 0.0, 3),
+                errors=round(self.errors, 3),
+                baseline=round(self.baseline or 0.0, 3))
+
+
+#### controllers shared by the http clients of a run ####
+
+# keyword arguments of the controllers created by host_controller(), see configure()
+CONTROL_SETTINGS = {}
+
+_CONTROLLERS = {}
+_CONTROLLERS_LOCK = threading.Lock()
+
+def configure(**settings) -> None:
+    '''Set the RateController arguments used for the hosts not requested yet.'''
+    CONTROL_SETTINGS.update(settings)
+
+def host_controller(url: str) -> RateController:
+    '''The controller shared by every request to the host of url.'''
+    host = urlsplit(url).netloc
+    with _CONTROLLERS_LOCK:
+        if host not in _CONTROLLERS:
+            _CONTROLLERS[host] = RateController(**CONTROL_SETTINGS)
+        return _CONTROLLERS[host]
+
+def controllers_summary() -> Dict[str, Dict]:
+    '''summary() of the controller of every host requested so far.'''
+    with _CONTROLLERS_LOCK:
+        controllers = dict(_CONTROLLERS)
+
+    return { host: control.summary() for host, control in controllers.items() }
+
+
+#### requests ####
+
+def request_with_retry(client: 'httpx.Client', url: str, headers: Optional[Dict] = None,
+        retries: int = DEFAULT_RETRIES, control: Optional[RateController] = None) -> 'httpx.Response':
+    '''GET url paced by its host's controller, retrying throttled and transient failures.
+
+    Returns the last response, whatever its status, or raises the last
+    error once the retries are used up.
+    '''
+    import httpx
+
+    if control is None:
+        control = host_controller(url)
+
+    attempt = 0
+    while True:
+        wait = control.start()
+
+        response, error = None, None
+        try:
+            sleep(wait, 'rate pacing')
+            started = time.monotonic()
+            response = client.get(url, headers=headers)
+        except httpx.HTTPError as err:
+            error = err
+        except BaseException:
+            control.finish(None, None)
+            raise
+
+        outcome = classify(response, error)
+        pause = retry_after(response) if outcome == THROTTLED else None
+        control.finish(time.monotonic() - started, outcome, pause)
+
+        if outcome in (OK, FATAL) or attempt >= retries:
+            if error is not None:
+                raise error
+            return response
+
+        delay = backoff_delay(attempt)
+        print("{}: {}, retry {} in {:.1f}s".format(url,
+            error or response.status_code, attempt + 1, delay), file=sys.stderr)
+        control.retrying()
+        sleep(delay, 'retry backoff')
+        attempt += 1
+
+def retry_call(function: Callable[[], T], retryable: Tuple[type, ...],
+        retries: int = DEFAULT_RETRIES, what: str = '') -> T:
+    '''Call function, calling it again with jittered backoff when it raises one of retryable.'''
+    for attempt in range(retries):
+        try:
+            return function()
+        except retryable as err:
+            delay = backoff_delay(attempt)
+            print("{}: {!r}, retry {} in {:.1f}s".format(what or function, err,
+                attempt + 1, delay), file=sys.stderr)
+            sleep(delay, 'retry backoff')
+
+    return function()
+
+
+#### checks ####
+
+def check_rate_control(states: List[str] = CHECK_STATES) -> List[str]:
+    '''Run a controller against a throttling and failing stand-in site, returns the checks that failed.'''
+    # only needed here, Stand_In_Server serves the records in OUTPUT_DIR
+    from Provider_Page_Parser import get_http_client
+    from Stand_In_Server import StandInServer
+
+    start_rate = CHECK_CAPACITY * 4
+    control = RateController(rate=start_rate, max_rate=start_rate * 2, window=CHECK_THREADS,
+        max_window=CHECK_THREADS)
+    failed = []
+
+    def check(name: str, passed: bool, details: str) -> None:
+        print("{}: {} ({})".format(name, "ok" if passed else "FAILED", details))
+        if not passed:
+            failed.append(name)
+
+    with StandInServer(states, capacity=CHECK_CAPACITY, error_rate=CHECK_ERROR_RATE) as server, \
+            get_http_client(CHECK_THREADS) as client, ThreadPoolExecutor(CHECK_THREADS) as pool:
+        urls = server.provider_urls() * CHECK_ROUNDS
+
+        def fetch_all() -> List[int]:
+            return list(pool.map(lambda url: request_with_retry(client, url,
+                control=control).status_code, urls))
+
+        # starts at 4 times the capacity, has to back off and retry to get every page
+        statuses = fetch_all()
+        check('throttled pages retried', all(status == 200 for status in statuses),
+            "{} of {} pages".format(statuses.count(200), len(statuses)))
+        check('backed off', control.stats['decreases'] > 0 and control.rate < start_rate,
+            "{} cuts, {:.1f} requests a second".format(control.stats['decreases'], control.rate))
+        check('transient errors retried', control.stats[TRANSIENT] > 0 and control.stats['retries'] > 0,
+            "{} errors, {} retries".format(control.stats[TRANSIENT], control.stats['retries']))
+
+        # once backed off the site is hardly throttling anymore
+        requests, throttled = server.requests, server.throttled
+        statuses = fetch_all()
+        share = (server.throttled - throttled) / max(server.requests - requests, 1)
+        check('paced under capacity', all(status == 200 for status in statuses)
+            and share < CHECK_THROTTLED_SHARE, "{:.0%} of requests throttled".format(share))
+
+        # the site has room again, the rate goes back up
+        server.capacity = None
+        server.error_rate = 0.0
+        backed_off = control.rate
+        statuses = fetch_all()
+        check('recovered', all(status == 200 for status in statuses) and control.rate > backed_off,
+            "{:.1f} -> {:.1f} requests a second".format(backed_off, control.rate))
+
+    print("Rate control: {}".format(control.summary()))
+    return failed
+
+def main() -> int:
+    failed = check_rate_control()
+    if failed:
+        print("Rate control checks failed: {}".format(", ".join(failed)), file=sys.stderr)
+        return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,393 @@
+# Scrape with workers spread over several processes or hosts.
+#
+# The coordinator lists the provider pages of every state into a WorkQueue
+#  (see Work_Queue.py) and writes each state to OUTPUT_DIR, in the same format
+#  as Scrape_Electrical_Providers.py, as soon as all of its pages are done.
+#  Workers claim provider pages from the queue, scrape them (over plain http
+#  when possible, in their own browser otherwise) and store the records back.
+#
+#   python3 Scrape_Cluster.py coordinate              # every state
+#   python3 Scrape_Cluster.py coordinate AK HI        # just these states
+#   python3 Scrape_Cluster.py work                    # run as many as wanted
+#   python3 Scrape_Cluster.py status
+#   python3 Scrape_Cluster.py check                   # offline, see check_lease_reclaim()
+#
+# The queue survives restarts: a coordinator started again carries on with
+#  the states it hasn't listed or written yet, and the pages of a worker that
+#  was stopped (or lost) are queued again once their lease runs out.
+#
+# The coordinator records its --fields profile in the queue. Workers wait for
+#  it and refuse to start with a different one, so a state file never mixes
+#  full and cut down provider records.
+#
+
+# Python standard libs
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from typing import Callable, Dict, List, Optional
+
+# 3rd party libs
+import httpx
+from selenium import webdriver
+
+# local module
+from Driver_Manager import DriverManager
+from Json_Stream import json_default
+from Page_Cache import PageCache
+from Provider_Page_Parser import fetch_page, get_http_client, read_state_page
+from Rate_Control import DEFAULT_MAX_RATE, DEFAULT_RATE, configure, controllers_summary
+from Scrape_Electrical_Providers import FIELD_PROFILES, DEFAULT_TOP_ROWS, field_profile
+from Scrape_Electrical_Providers import get_driver, get_state_provider_urls, read_provider
+from Scrape_Electrical_Providers import set_field_profile, sort_providers, write_state_providers
+from Scraper_Settings import BASE_URL, FIREFOX_PATH, OUTPUT_DIR, STATES
+from Work_Queue import DEFAULT_LEASE, QUEUE_FILE, WorkQueue
+
+DEFAULT_POLL = 2.0          # seconds between looks at the queue when there's nothing to do
+FIELDS_SETTING = 'fields'   # queue setting holding the coordinator's field profile
+
+# check_lease_reclaim(): stand-in tables on a single page so no page needs the browser
+CHECK_STATES = [ 'AK', 'HI' ]
+CHECK_PAGE_SIZE = 1000
+CHECK_LEASE = 1.0
+CHECK_POLL = 0.2
+
+
+def list_provider_urls(get_driver: Callable[[], webdriver], client: Optional[httpx.Client],
+        url: str, state: str) -> List[str]:
+    '''Provider urls of a state, read over http when they all fit on the first page of its table.'''
+    if client is not None:
+        html = fetch_page(client, url)
+        state_page = read_state_page(html, url) if html is not None else None
+        if state_page is not None and state_page['count'] == len(state_page['urls']):
+            return state_page['urls']
+
+    return list(get_state_provider_urls(get_driver(), url, state))
+
+def coordinate(work_queue: WorkQueue, state_urls: Dict[str, str],
+        get_driver: Callable[[], webdriver], client: Optional[httpx.Client],
+        on_state_done: Callable[[str, List[Dict]], None], poll: float = DEFAULT_POLL) -> List[str]:
+    '''List every state's provider pages into the queue and hand back each finished state.
+
+    on_state_done is called with the state and its sorted providers. Returns
+    the states left out because one of their pages failed.
+    '''
+    failed_states = []
+
+    def finish_states() -> None:
+        for state, providers in work_queue.finished_states():
+            if providers is None:
+                print("{}: a provider page failed, not written".format(state), file=sys.stderr)
+                failed_states.append(state)
+            else:
+                on_state_done(state, sort_providers(providers))
+                print("{}: {} providers written".format(state, len(providers)))
+            work_queue.mark_finished(state)
+
+    for state, url in state_urls.items():
+        work_queue.add_state(state, url)
+
+    listed = set(work_queue.listed_states())
+    for state, url in state_urls.items():
+        if state in listed:
+            continue
+        provider_urls = list_provider_urls(get_driver, client, url, state)
+        added = work_queue.add_providers(state, provider_urls)
+        print("{}: {} provider pages, {} new in the queue".format(state, len(provider_urls), added))
+        # states whose pages were all scraped for an earlier state are done already
+        finish_states()
+
+    last_counts = None
+    while not work_queue.is_complete():
+        requeued = work_queue.requeue_expired()
+        if requeued:
+            print("{} expired leases queued again".format(requeued), file=sys.stderr)
+
+        finish_states()
+
+        counts = work_queue.counts()
+        if counts != last_counts:
+            print("Queue: {}".format(", ".join("{} {}".format(count, status)
+                for status, count in counts.items())))
+            last_counts = counts
+        time.sleep(poll)
+
+    finish_states()
+    return failed_states
+
+def queue_field_profile(work_queue: WorkQueue, poll: float = DEFAULT_POLL) -> str:
+    '''Field profile recorded by the coordinator, waiting for it to start if it hasn't yet.'''
+    profile = work_queue.setting(FIELDS_SETTING)
+    if profile is None:
+        print("Waiting for the coordinator to record its field profile")
+    while profile is None:
+        time.sleep(poll)
+        profile = work_queue.setting(FIELDS_SETTING)
+
+    return profile
+
+def work(work_queue: WorkQueue, worker: str, drivers: DriverManager,
+        client: Optional[httpx.Client], cache: Optional[PageCache] = None,
+        poll: float = DEFAULT_POLL) -> int:
+    '''Scrape provider pages from the queue until every state is finished.
+
+    Returns the number of pages scraped by this worker.
+    '''
+    driver = None
+    used = False
+
+    def get_session() -> webdriver:
+        nonlocal driver, used
+        if driver is None:
+            driver = drivers.acquire()
+        used = True
+        return driver
+
+    pages = 0
+    while True:
+        task = work_queue.claim(worker)
+        if task is None:
+            if work_queue.is_complete():
+                break
+            time.sleep(poll)
+            continue
+
+        # keep the lease while the page is scraped, a browser page can take minutes
+        done = threading.Event()
+        def renew_lease() -> None:
+            while not done.wait(work_queue.lease_seconds / 3):
+                if not work_queue.renew(task, worker):
+                    return
+        renewer = threading.Thread(target=renew_lease, daemon=True)
+        renewer.start()
+
+        try:
+            provider_info = read_provider(get_session, task.url, client, cache)
+        except Exception as err:
+            done.set()
+            print("Failed {} (attempt {})".format(task.url, task.attempts), file=sys.stderr)
+            traceback.print_exc()
+            work_queue.fail(task, worker, repr(err))
+            # the session may be left on a half loaded page or be dead
+            drivers.discard(driver)
+            driver, used = None, False
+            continue
+        finally:
+            done.set()
+            renewer.join()
+
+        if not work_queue.complete(task, worker, provider_info):
+            print("Lease of {} was lost, result dropped".format(task.url), file=sys.stderr)
+        pages += 1
+
+        if used:
+            used = False
+            if not drivers.release(driver):
+                driver = None
+
+    if driver is not None:
+        drivers.discard(driver)
+    return pages
+
+def check_lease_reclaim(states: List[str] = CHECK_STATES) -> List[str]:
+    '''Run a coordinator and a worker against a stand-in site while another worker is lost.
+
+    The lost worker claims a page and never hands it back. Its lease has to
+    run out and the page go to the live worker, every state has to be
+    written as served and the lost worker's late result refused. Returns
+    the checks that failed.
+    '''
+    # only needed here, Stand_In_Server serves the records in OUTPUT_DIR
+    from Stand_In_Server import StandInServer
+
+    failed = []
+
+    def check(name: str, passed: bool, details: str) -> None:
+        print("{}: {} ({})".format(name, "ok" if passed else "FAILED", details))
+        if not passed:
+            failed.append(name)
+
+    def no_browser() -> webdriver:
+        raise RuntimeError("no browser in the check")
+
+    with StandInServer(states, page_size=CHECK_PAGE_SIZE) as server, get_http_client() as client, \
+            tempfile.TemporaryDirectory() as directory:
+        queue_file = os.path.join(directory, QUEUE_FILE)
+        coordinator_queue = WorkQueue(queue_file, lease_seconds=CHECK_LEASE)
+        state_urls = { state: server.state_url(state) for state in states }
+
+        # list the states up front so the lost worker has something to claim
+        expected = {}
+        for state, url in state_urls.items():
+            provider_urls = list_provider_urls(no_browser, client, url, state)
+            coordinator_queue.add_state(state, url)
+            coordinator_queue.add_providers(state, provider_urls)
+            expected[state] = sort_providers([ server.record(url) for url in provider_urls ])
+
+        lost_queue = WorkQueue(queue_file, lease_seconds=CHECK_LEASE)
+        lost_task = lost_queue.claim('lost')
+
+        worker_queue = WorkQueue(queue_file, lease_seconds=CHECK_LEASE)
+        drivers = DriverManager(no_browser)
+        pages = []
+        worker = threading.Thread(target=lambda: pages.append(
+            work(worker_queue, 'live', drivers, client, poll=CHECK_POLL)))
+        worker.start()
+
+        written = {}
+        failed_states = coordinate(coordinator_queue, state_urls, no_browser, client,
+            lambda state, providers: written.update({ state: providers }), CHECK_POLL)
+        worker.join()
+        drivers.close()
+
+        counts = coordinator_queue.counts()
+        check('lease reclaimed', not failed_states and counts['done'] == pages[0] > 0,
+            "{} pages done, {} by the live worker".format(counts['done'], pages[0]))
+
+        mismatched = [ state for state in states if state not in written
+            or json.loads(json.dumps(written[state], default=json_default)) != expected[state] ]
+        check('states written as served', not mismatched,
+            "{} written, {} not as served".format(len(written), len(mismatched)))
+
+        check('late result refused', not lost_queue.complete(lost_task, 'lost', {}),
+            lost_task.url)
+
+        for work_queue in (coordinator_queue, lost_queue, worker_queue):
+            work_queue.close()
+
+    return failed
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Scrape with a coordinator and any number of "
+        "workers sharing a work queue.")
+    parser.add_argument('--queue', default=QUEUE_FILE,
+        help="sqlite file of the work queue (default: %(default)s)")
+    parser.add_argument('--poll', type=float, default=DEFAULT_POLL,
+        help="seconds between looks at the queue when idle (default: %(default)s)")
+    parser.add_argument('--browser-only', action='store_true',
+        help="always use the browser instead of trying plain http first")
+    parser.add_argument('--full-pages', action='store_true',
+        help="don't use the lightweight browser profile")
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE,
+        help="requests per second to start with in this process, adjusted to what the site "
+            "tolerates (default: %(default)s)")
+    parser.add_argument('--max-rate', type=float, default=DEFAULT_MAX_RATE,
+        help="most requests per second in this process (default: %(default)s)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    coordinator = commands.add_parser('coordinate',
+        help="list the provider pages of each state and write the states as they finish")
+    coordinator.add_argument('states', nargs='*', default=list(STATES.values()),
+        help="state abbreviations to scrape (default: all)")
+    coordinator.add_argument('--base-url', default=BASE_URL,
+        help="site the state pages are read from (default: %(default)s)")
+    coordinator.add_argument('--retry-failed', action='store_true',
+        help="queue the pages that failed in an earlier run again")
+    coordinator.add_argument('--fields', choices=FIELD_PROFILES, default='full',
+        help="how much of each provider page to scrape, see Scrape_Electrical_Providers.py, "
+            "recorded in the queue for the workers (default: %(default)s)")
+    coordinator.add_argument('--top-rows', type=int, default=DEFAULT_TOP_ROWS,
+        help="counties and states kept per provider with --fields top (default: %(default)s)")
+
+    worker = commands.add_parser('work', help="scrape provider pages from the queue")
+    worker.add_argument('--name', default="{}:{}".format(socket.gethostname(), os.getpid()),
+        help="worker name recorded with its leases (default: host:pid)")
+    worker.add_argument('--lease', type=float, default=DEFAULT_LEASE,
+        help="seconds a page stays leased without a renewal (default: %(default)s)")
+    worker.add_argument('--no-cache', action='store_true',
+        help="don't use the page cache")
+    worker.add_argument('--fields', choices=FIELD_PROFILES, default='full',
+        help="how much of each provider page to scrape, has to match the coordinator's "
+            "(default: %(default)s)")
+    worker.add_argument('--top-rows', type=int, default=DEFAULT_TOP_ROWS,
+        help="counties and states kept per provider with --fields top (default: %(default)s)")
+
+    commands.add_parser('status', help="print the tasks by status and the failed pages")
+    commands.add_parser('check', help="run a coordinator and a worker against a local "
+        "stand-in site while another worker is lost, exit with 1 if its pages aren't reclaimed")
+    args = parser.parse_args(argv)
+
+    if args.command == 'check':
+        failed = check_lease_reclaim()
+        if failed:
+            print("Work queue checks failed: {}".format(", ".join(failed)), file=sys.stderr)
+            return 1
+        return 0
+
+    if args.command == 'status':
+        work_queue = WorkQueue(args.queue)
+        print(", ".join("{} {}".format(count, status)
+            for status, count in work_queue.counts().items()))
+        for url, error in work_queue.failures():
+            print("failed {}: {}".format(url, error))
+        work_queue.close()
+        return 0
+
+    def driver_factory() -> webdriver:
+        return get_driver('Firefox', FIREFOX_PATH, ['--headless', '--no-sandbox' ],
+            lightweight=not args.full_pages)
+
+    set_field_profile(args.fields, args.top_rows)
+    if args.command == 'coordinate':
+        work_queue = WorkQueue(args.queue)
+        recorded = work_queue.set_setting(FIELDS_SETTING, field_profile())
+    else:
+        work_queue = WorkQueue(args.queue, lease_seconds=args.lease)
+        recorded = queue_field_profile(work_queue, args.poll)
+
+    if recorded != field_profile():
+        print("{} was started with the {} field profile, not {}".format(args.queue, recorded,
+            field_profile()), file=sys.stderr)
+        work_queue.close()
+        return 1
+
+    configure(rate=args.rate, max_rate=args.max_rate)
+    client = None if args.browser_only else get_http_client()
+    drivers = DriverManager(driver_factory)
+
+    try:
+        if args.command == 'coordinate':
+            if args.retry_failed:
+                print("{} failed pages queued again".format(work_queue.retry_failed()))
+
+            os.makedirs(OUTPUT_DIR, exist_ok=True)
+            state_urls = { state.upper(): "{}{}".format(args.base_url, state.upper())
+                for state in args.states }
+
+            driver = None
+            def get_session() -> webdriver:
+                nonlocal driver
+                if driver is None:
+                    driver = drivers.acquire()
+                return driver
+
+            failed_states = coordinate(work_queue, state_urls, get_session, client,
+                write_state_providers, args.poll)
+            if failed_states:
+                print("Failed states: {}, run again with --retry-failed".format(
+                    ", ".join(failed_states)), file=sys.stderr)
+                return 1
+        else:
+            cache = None if args.no_cache else PageCache()
+            pages = work(work_queue, args.name, drivers, client, cache, args.poll)
+            print("{}: scraped {} provider pages".format(args.name, pages))
+            if cache is not None:
+                cache.close()
+        work_queue.close()
+    finally:
+        drivers.close()
+        if client is not None:
+            client.close()
+        for host, summary in controllers_summary().items():
+            print("Rate control {}: {}".format(host, summary))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,20 @@
 
 # Python standard libs
+import argparse
+import asyncio
 import json
+import os
 import sys, time
-from time import sleep
-from typing import Any, Dict, List, Set
+import threading
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Set
 
-# 3rd party libs
+# 3rd party libs, httpx only comes in with the http client (see get_http_client())
+if TYPE_CHECKING:
+    import httpx
 from selenium import webdriver
 from selenium.common.exceptions import TimeoutException
 from selenium.common.exceptions import NoSuchElementException
+from selenium.common.exceptions import StaleElementReferenceException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.firefox.service import Service as FirefoxService
 from selenium.webdriver.chrome.service import Service as ChromeService
@@ -16,51 +22,267 @@ from selenium.webdriver.support.ui import WebDriverWait as WDW
 from selenium.webdriver.support import expected_conditions as EC
 
 # local module
-from Collect_State_Info import STATES
-
-# Used by webdriver_manager if not supplying path to driver
-# from webdriver_manager.firefox import GeckoDriverManager
-# webdriver_manager info:
-#
-# https://github.com/SergeyPirogov/webdriver_manager#use-with-chrome
-# This option can be used with minor adjustments to the get_driver() function
-# 
-#
-# Or to download the browser driver:
-#   https://www.selenium.dev/documentation/webdriver/getting_started/install_drivers/
-#
-FIREFOX_PATH = "./geckodriver" # replace with path to driver for your OS
-
-BASE_URL = "https://findenergy.com/"
-OUTPUT_DIR = 'outputs'
+from Browser_Profile import block_chrome_requests, chrome_options, firefox_options
+from Json_Stream import json_default
+from Page_Cache import CACHE_DIR, DEFAULT_TTL, PageCache, cached_record
+from Provider_Page_Parser import parse_count, parse_number, read_provider_page
+from Provider_Record import compact_provider
+from Rate_Control import retry_call
+from Scrape_Trace import instant, instrument_driver, span, start_trace, stop_trace
+from Scraper_Settings import BASE_URL, FIREFOX_PATH, OUTPUT_DIR, STATES
+
+
+# How long to wait for a table to show the next page after a click. The
+#   timeout follows the recent page change times (PAGE_WAIT_FACTOR times the
+#   running average) and stays between PAGE_WAIT_MIN and PAGE_WAIT_MAX seconds.
+PAGE_WAIT_MIN = 2
+PAGE_WAIT_MAX = 20
+PAGE_WAIT_FACTOR = 5
+PAGE_WAIT_SMOOTHING = 0.2
+
+# Pages are loaded eagerly (see Browser_Profile.py), so driver.get() can return
+#   before the tables are there. Wait up to READY_TIMEOUT seconds for these.
+READY_TIMEOUT = 20
+PROVIDER_READY_SELECTOR = "#state-coverage .table-footer__data.svelte-x63klk"
+STATE_READY_SELECTOR = "#electricity-providers .table-footer__data.svelte-x63klk"
+
+# Which fields of a provider page are scraped, see set_field_profile().
+#   full reads every row of the county and state tables, top only the first
+#   rows of each and totals skips them and only records their sizes.
+FIELD_PROFILES = [ 'full', 'top', 'totals' ]
+DEFAULT_TOP_ROWS = 25
+# rows read from each table, None for all of them
+TABLE_ROW_LIMIT = None
+FIELD_PROFILE = 'full'
+
+# A provider page that timed out or changed under the scraper is loaded again
+#   up to BROWSER_RETRIES times with jittered backoff (see Rate_Control.py),
+#   other errors fail the page right away.
+BROWSER_RETRIES = 2
+BROWSER_RETRYABLE = ( TimeoutException, StaleElementReferenceException )
+
+
+class AdaptiveTimeout:
+    '''Timeout that adjusts to the observed time it takes a page to update.'''
+
+    def __init__(self, minimum: float, maximum: float, factor: float, smoothing: float):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.smoothing = smoothing
+        self.average = None
+        self._lock = threading.Lock()
+
+    def timeout(self) -> float:
+        with self._lock:
+            if self.average is None:
+                return self.maximum
+            return min(self.maximum, max(self.minimum, self.factor * self.average))
+
+    def record(self, seconds: float) -> None:
+        '''Add the time a page change took to the running average.'''
+        with self._lock:
+            if self.average is None:
+                self.average = seconds
+            else:
+                self.average += self.smoothing * (seconds - self.average)
+
+    def record_timeout(self) -> None:
+        '''A wait timed out, allow more time for the next ones.'''
+        self.record(self.maximum / self.factor)
+
+PAGE_WAIT = AdaptiveTimeout(PAGE_WAIT_MIN, PAGE_WAIT_MAX, PAGE_WAIT_FACTOR, PAGE_WAIT_SMOOTHING)
+
+# Read a whole table page or provider page with a single execute_script call
+#   instead of one driver command per element. Set to False to fall back to
+#   reading every element with find_element(s).
+BULK_EXTRACT = True
+
+# Returns {text, link, href, value} for every row of the table in arguments[0]
+TABLE_ROWS_SCRIPT = """
+const rows = arguments[0].querySelectorAll(
+    ".table.sortable-table.svelte-x63klk tbody tr.svelte-x63klk");
+
+return Array.from(rows, row => {
+    const columns = row.querySelectorAll("td.svelte-x63klk");
+    const link = row.querySelector("td.svelte-x63klk a");
+
+    return {
+        text: columns.length > 0 ? columns[0].innerText.trim() : "",
+        link: link ? link.innerText.trim() : "",
+        href: link ? link.href : "",
+        value: columns.length > 1 ? columns[1].innerText.trim() : ""
+    };
+});
+"""
+
+# Returns the overview, facts and cities of a provider page, see provider_info_from_page()
+PROVIDER_PAGE_SCRIPT = """
+function find(node, selector) {
+    const element = node.querySelector(selector);
+    if (element === null) {
+        throw new Error("Unable to locate element: " + selector);
+    }
+    return element;
+}
+function text(element) {
+    return element ? element.innerText.trim() : "";
+}
+
+const overview = document.querySelectorAll("section#overview .col-lg-5");
+if (overview.length < 2) {
+    throw new Error("Unable to locate element: section#overview .col-lg-5");
+}
+
+const typeSpans = overview[0].querySelectorAll("li.svelte-1f6rrn3 span.svelte-1f6rrn3");
+if (typeSpans.length < 2) {
+    throw new Error("Unable to locate company type");
+}
+
+let website = "";
+const infoLists = overview[0].querySelectorAll("ul.list-unstyled.company-info__list.svelte-1f6rrn3");
+if (infoLists.length > 1) {
+    const link = infoLists[1].querySelector("li.svelte-1f6rrn3 a");
+    website = link ? link.href : "";
+}
+
+const facts = Array.from(
+    find(document, ".sidebar-widget").querySelectorAll(".facts-item.svelte-3uw1eb"),
+    section => ({
+        title: text(section.querySelector("h3.facts-item__title.svelte-3uw1eb")),
+        items: Array.from(section.querySelectorAll(".facts-item__li.svelte-3uw1eb"), item => ({
+            label: text(item.querySelector(".facts-item__label.svelte-3uw1eb")),
+            data: text(item.querySelector(".facts-item__data.svelte-3uw1eb strong")),
+            units: text(item.querySelector(".text-muted"))
+        }))
+    })
+);
+
+let cities;
+const citySection = document.querySelector("#city-coverage");
+if (citySection !== null) {
+    cities = citySection.querySelectorAll("li.svelte-1f6rrn3");
+} else {
+    cities = find(overview[1],
+        "ul.list-unstyled.company-info__list.svelte-1f6rrn3:nth-child(3) > li:nth-child(3)"
+    ).querySelectorAll("ul.list-unstyled li");
+}
+
+return {
+    company: text(find(document, ".overview__title.svelte-1f6rrn3")),
+    companyType: text(typeSpans[1]),
+    website: website,
+    serviceTypes: Array.from(
+        find(document, ".tab-nav.tab-nav--underlined.svelte-9ar7ba").querySelectorAll(".tab-nav__link"),
+        text),
+    facts: facts,
+    cities: Array.from(cities, text)
+};
+"""
+
+
+def wait_until_ready(driver: webdriver, selector: str) -> None:
+    '''Wait for the element the scraper starts from after loading a page.
+
+    A page that never shows it is left to fail on the scraper's own lookup.
+    '''
+    try:
+        with span('wait until ready', 'wait'):
+            WDW(driver, READY_TIMEOUT, poll_frequency=0.05).until(
+                EC.presence_of_element_located((By.CSS_SELECTOR, selector)))
+    except TimeoutException:
+        print("Timed out waiting for {}".format(selector), file=sys.stderr)
+
+def set_field_profile(profile: str, top_rows: int = DEFAULT_TOP_ROWS) -> None:
+    '''Choose which fields get scraped from each provider page.
+
+    With the top and totals profiles the number of rows of the county and
+    state tables is added to each record as 'counties-count' and
+    'states-count', since the lists are cut short. Most pages then don't need
+    a browser at all, as the rows needed are on the table's first page.
+    '''
+    global TABLE_ROW_LIMIT, FIELD_PROFILE
+    TABLE_ROW_LIMIT = { 'full': None, 'top': top_rows, 'totals': 0 }[profile]
+    FIELD_PROFILE = profile if profile != 'top' else "top-{}".format(top_rows)
+
+def field_profile() -> str:
+    '''Name of the field profile in use, with the row count for top ("top-25").'''
+    return FIELD_PROFILE
+
+def table_row_limit() -> Optional[int]:
+    '''Rows read from each county and state table, None for all of them.'''
+    return TABLE_ROW_LIMIT
+
+def get_active_page(buttonList: Any) -> str:
+    '''Returns the label of the highlighted button in a pagination list.'''
+    try:
+        return buttonList.find_element(By.CSS_SELECTOR, "li.active").text
+    except (NoSuchElementException, StaleElementReferenceException):
+        return ''
+
+def wait_for_page_change(driver: webdriver, section: Any, active_page: str, first_row: Any) -> bool:
+    '''Wait until a table has moved off of the page that was showing before a click.
+
+    The page has changed once the highlighted pagination button is different
+    or the first row of the table has been removed from the DOM.
+    '''
+    def page_changed(_) -> bool:
+        if first_row is not None and EC.staleness_of(first_row)(_):
+            return True
+        try:
+            buttonList = section.find_element(By.CSS_SELECTOR, "ul.pagination.svelte-x63klk")
+        except (NoSuchElementException, StaleElementReferenceException):
+            return False
+        return get_active_page(buttonList) != active_page
 
-CLICK_DELAY = 2
+    start = time.perf_counter()
+    try:
+        with span('wait for page change', 'wait'):
+            WDW(driver, PAGE_WAIT.timeout(), poll_frequency=0.05).until(page_changed)
+    except TimeoutException:
+        print("Timed out waiting for the next page", file=sys.stderr)
+        instant('page change timeout', 'retry')
+        PAGE_WAIT.record_timeout()
+        return False
 
+    PAGE_WAIT.record(time.perf_counter() - start)
+    return True
 
 def button_click(driver: webdriver, section: Any) -> bool:
-    '''Click a button on the page found by the XPATH in the formatString argument.'''
+    '''Click the next page button of the paginated table in section.
+
+    Returns True once there are no more pages, otherwise waits for the table
+    to show the next page before returning False.
+    '''
     
     try:
         # This try except block is need because the buttons used to traverse
         #   the paginated table appear/disappear from the DOM as you move 
         #   through the list. If an exception is raised, then we have reached the end
         buttonList = section.find_element(By.CSS_SELECTOR, "ul.pagination.svelte-x63klk")
-        button = WDW(buttonList, 3).until(
-            EC.element_to_be_clickable((
-                By.CSS_SELECTOR, "li.active + li"
-            ))
-        )
+        if not buttonList.find_elements(By.CSS_SELECTOR, "li.active + li"):
+            # no more buttons
+            return True
+
+        with span('wait for next button', 'wait'):
+            button = WDW(buttonList, 3).until(
+                EC.element_to_be_clickable((
+                    By.CSS_SELECTOR, "li.active + li"
+                ))
+            )
     except (NoSuchElementException, TimeoutException):
         # no more buttons
         return True
-    
-    driver.execute_script("arguments[0].scrollIntoView();", button)
-    # adding a delay so the page fully loads before clicking
-    time.sleep(CLICK_DELAY)
 
+    active_page = get_active_page(buttonList)
+    rows = get_table_rows(section)
+    first_row = rows[0] if rows else None
+
+    driver.execute_script("arguments[0].scrollIntoView();", button)
     button.click()
-    # adding a delay so the page fully loads after clicking
-    time.sleep(CLICK_DELAY)
+
+    # wait for the table to update instead of sleeping for a fixed time
+    wait_for_page_change(driver, section, active_page, first_row)
 
     return False
 
@@ -72,37 +294,63 @@ def get_table_rows(section: Any) -> Any:
 
     return table_rows
 
+def read_table_rows(driver: webdriver, section: Any, is_link: bool, with_value: bool) -> List[Dict]:
+    '''Returns {text, link, href, value} for each row of the table in the section.
+
+    text is the first column, link and href are from the a tag in the row
+    (only read when is_link is set) and value is the second column (only read
+    when with_value is set).
+    '''
+    if BULK_EXTRACT:
+        return driver.execute_script(TABLE_ROWS_SCRIPT, section)
+
+    rows = []
+    for row in get_table_rows(section):
+        columns = row.find_elements(By.CSS_SELECTOR, "td.svelte-x63klk")
+        item = { 'text': '', 'link': '', 'href': '', 'value': '' }
+
+        if is_link:
+            link = row.find_element(By.CSS_SELECTOR, "td.svelte-x63klk a")
+            item['link'] = link.text
+            item['href'] = link.get_attribute("href")
+        else:
+            item['text'] = columns[0].text
+
+        if with_value:
+            item['value'] = columns[1].text
+
+        rows.append(item)
+
+    return rows
+
 def scrape_table(driver: webdriver, section: Any, numItems: int, is_link: bool, key1: str, key2: str) -> List[Dict]:
     current_page = 1
     item_list = []
     
-    while len(item_list) != numItems:
+    while len(item_list) < numItems:
         repeat = False
 
         print("start page {}".format(current_page))
 
-        tableRows = get_table_rows(section)
+        tableRows = read_table_rows(driver, section, is_link, with_value=True)
 
         # iterate over items in the table to get href tag for a elements
         for row in tableRows:
-            columns = row.find_elements(By.CSS_SELECTOR, "td.svelte-x63klk")
             item = {}
             
-            # print(providerElement.text)
             if is_link:
-                link = columns[0].find_element(By.CSS_SELECTOR, "a")
-                county = link.text
                 # split url by '/' and get 3rd from last item which is the state abbreviation
-                state = link.get_attribute("href").split('/')[-3].upper()
-                item[key1] = "{}, {}".format(county, state)
+                state = row['href'].split('/')[-3].upper()
+                item[key1] = "{}, {}".format(row['link'], state)
             else:
-                item[key1] = columns[0].text
+                item[key1] = row['text']
 
-            item[key2] = int("".join(columns[1].text.split(',')))
+            item[key2] = parse_count(row['value'])
 
             if item in item_list:
                 repeat = True
                 print("Repeat item. Trying again.")
+                instant('repeat item', 'retry', table=key1, page=current_page)
                 break
             print(item)
             item_list.append(item)
@@ -111,16 +359,56 @@ def scrape_table(driver: webdriver, section: Any, numItems: int, is_link: bool,
             print("done page {}".format(current_page))
             current_page += 1
 
-        if button_click(driver, section):
+        if len(item_list) >= numItems or button_click(driver, section):
             break
 
-    return item_list
+    # the last page read can hold more rows than asked for
+    return item_list[:numItems]
 
-def get_provider_info(driver: webdriver, url: str) -> Dict:
+def provider_info_from_page(page: Dict) -> Dict:
+    '''Build the provider dictionary from the result of PROVIDER_PAGE_SCRIPT.'''
     provider_info = {}
 
-    # fetch page
-    driver.get(url)
+    provider_info['company'] = page['company']
+    print("Scraping {}".format(page['company']))
+
+    provider_info['company-type'] = page['companyType']
+    provider_info['website'] = page['website']
+    provider_info['service-types'] = page['serviceTypes']
+
+    stats_sections = page['facts']
+
+    # collect customers by type
+    if stats_sections[0]['title'] == "SALES & CUSTOMERS":
+        total_customers = 0
+        for section in stats_sections[0]['items']:
+            # Replace spaces with '-' for key
+            text = section['label'].replace(' ', '-')
+            amount = parse_number(section['data'].strip('$'))
+
+            if "Customers" in text:
+                total_customers += amount
+            else:
+                text = "{}-($)".format(text)
+
+            provider_info[text] = amount
+
+        provider_info['Total-Customers'] = total_customers
+        print("Total customers: ", total_customers)
+
+    # collect energy production
+    if stats_sections[1]['title'] == "ENERGY PRODUCTION":
+        for section in stats_sections[1]['items']:
+            text = "{}-{}".format(section['label'].replace(' ', '-'), section['units'])
+            provider_info[text] = parse_number(section['data'])
+
+    provider_info["cities-served"] = page['cities']
+
+    return provider_info
+
+def read_provider_overview(driver: webdriver) -> Dict:
+    '''Read the overview, facts and cities of the loaded provider page one element at a time.'''
+    provider_info = {}
 
     # Scrape Company Name
     company_name = driver.find_element(By.CSS_SELECTOR, 
@@ -144,7 +432,8 @@ def get_provider_info(driver: webdriver, url: str) -> Dict:
             "ul.list-unstyled.company-info__list.svelte-1f6rrn3")[1].find_element(By.CSS_SELECTOR,
                 "li.svelte-1f6rrn3 a"
             ).get_attribute("href")
-    except:
+    except (IndexError, NoSuchElementException):
+        # no website listed
         company_website = ''
     finally:
         # print("\twebsite: {}".format(company_website))
@@ -184,7 +473,7 @@ def get_provider_info(driver: webdriver, url: str) -> Dict:
             stat = section.find_element(By.CSS_SELECTOR,
                 "p.facts-item__data.svelte-3uw1eb strong").text.strip('$')
 
-            amount = float("".join(stat.split(',')))
+            amount = parse_number(stat)
 
             if "Customers" in text:
                 total_customers += amount
@@ -214,13 +503,12 @@ def get_provider_info(driver: webdriver, url: str) -> Dict:
                 ".text-muted").text.strip()
             text = "{}-{}".format(text, units)
             
-            provider_info[text] = float("".join(stat.split(',')))
+            provider_info[text] = parse_number(stat)
             # print(text, provider_info[text])
 
     #### COLLECT CITIES SERVED ####
     print("Scraping cities")
 
-    provider_info["cities-served"] = []
     city_elements = None
     try:
         # try to grab city-coverage section from bottom of page
@@ -228,50 +516,73 @@ def get_provider_info(driver: webdriver, url: str) -> Dict:
             "#city-coverage")
         city_elements = city_section.find_elements(By.CSS_SELECTOR,
             "li.svelte-1f6rrn3")
-    except:
-        # if NoSuchElement Exception is thrown, then grab cities from top of page
+    except NoSuchElementException:
+        # no city-coverage section, grab cities from top of page
         city_section = company_overview_sections[1].find_element(By.CSS_SELECTOR,
             "ul.list-unstyled.company-info__list.svelte-1f6rrn3:nth-child(3) > li:nth-child(3)")
         city_elements = city_section.find_elements(By.CSS_SELECTOR, "ul.list-unstyled li")
         
-    for city in city_elements:
-        try:
-            provider_info["cities-served"].append(city.get_element(
-                By.CSS_SELECTOR, "a").text)
-        except:
-            provider_info["cities-served"].append(city.text)
+    # the text of a linked city is the text of its link
+    provider_info["cities-served"] = [ city.text for city in city_elements ]
     #### END CITIES SERVED ####
 
+    return provider_info
+
+def get_provider_info(driver: webdriver, url: str) -> Dict:
+    # fetch page
+    driver.get(url)
+    wait_until_ready(driver, PROVIDER_READY_SELECTOR)
+
+    if BULK_EXTRACT:
+        provider_info = provider_info_from_page(driver.execute_script(PROVIDER_PAGE_SCRIPT))
+    else:
+        provider_info = read_provider_overview(driver)
+
     #### Collect counties served ####
     
-    # grab section for County table and use as starting node
+    # grab section for County table and use as starting node, pages
+    #   without one have no counties-served, any other error fails the page
+    #   instead of dropping its counties
     try:
         county_section = driver.find_element(By.CSS_SELECTOR,
             "#county-coverage")
+    except NoSuchElementException:
+        county_section = None
 
-        num_counties = int(county_section.find_element(By.CSS_SELECTOR,
+    if county_section is not None:
+        num_counties = parse_count(county_section.find_element(By.CSS_SELECTOR,
             ".table-footer__data.svelte-x63klk").text.split(' ')[0])
-        print("Scraping {} counties".format(num_counties))
-        counties = scrape_table(driver, county_section, num_counties, 
-                        is_link=True, key1="county", key2="population")
+        if TABLE_ROW_LIMIT is not None:
+            provider_info['counties-count'] = num_counties
+            num_counties = min(num_counties, TABLE_ROW_LIMIT)
 
-        provider_info['counties-served'] = sorted(counties, reverse=True, key= lambda county: county['population'])
-    except:
-        pass
+        if TABLE_ROW_LIMIT != 0:
+            print("Scraping {} counties".format(num_counties))
+            with span('county table', items=num_counties):
+                counties = scrape_table(driver, county_section, num_counties, 
+                                is_link=True, key1="county", key2="population")
+
+            provider_info['counties-served'] = sorted(counties, reverse=True, key= lambda county: county['population'])
     #### End counties ####
 
     #### Collect states served ####
     states_section = driver.find_element(By.CSS_SELECTOR,
         "#state-coverage")
     
-    numStates = int(states_section.find_element(By.CSS_SELECTOR,
+    numStates = parse_count(states_section.find_element(By.CSS_SELECTOR,
         ".table-footer__data.svelte-x63klk").text.split(' ')[0])
-    print("Scraping {} states".format(numStates))
+    if TABLE_ROW_LIMIT is not None:
+        provider_info['states-count'] = numStates
+        numStates = min(numStates, TABLE_ROW_LIMIT)
 
-    states = scrape_table(driver, states_section, numStates,
-                    is_link=False, key1="state", key2="customers")
-    
-    provider_info["states-served"] = sorted(states, reverse=True, key= lambda state: state['customers'])
+    if TABLE_ROW_LIMIT != 0:
+        print("Scraping {} states".format(numStates))
+
+        with span('state table', items=numStates):
+            states = scrape_table(driver, states_section, numStates,
+                            is_link=False, key1="state", key2="customers")
+        
+        provider_info["states-served"] = sorted(states, reverse=True, key= lambda state: state['customers'])
     #### End states ####
 
     return provider_info
@@ -282,30 +593,29 @@ def get_electrical_providers(driver: webdriver) -> Set[Dict]:
     providers = set()   # set of links to provider pages
     current_page = 1    # current page from Electricity providers table
 
-    num_providers = driver.find_element(By.CSS_SELECTOR, 
-        ".table-footer__data.svelte-x63klk.svelte-x63klk").text.split(' ')[0]
+    num_providers = parse_count(driver.find_element(By.CSS_SELECTOR, 
+        ".table-footer__data.svelte-x63klk.svelte-x63klk").text.split(' ')[0])
 
     print("Number of providers: {}".format(str(num_providers)))
     
-    while len(providers) != int(num_providers):
+    while len(providers) != num_providers:
         repeat = False
         print("start providers page {}".format(current_page))
         # grab table of Electrical Providers and use as starting node
         provider_section = driver.find_element(By.CSS_SELECTOR, "#electricity-providers")
 
-        table = provider_section.find_element(By.CSS_SELECTOR, ".table.sortable-table.svelte-x63klk tbody")
-        table_rows = table.find_elements(By.CSS_SELECTOR, "tr.svelte-x63klk")
+        table_rows = read_table_rows(driver, provider_section, is_link=True, with_value=False)
 
         # iterate over items in the table to get href tag for a elements
 
         for row in table_rows:
-            provider_element = row.find_element(By.CSS_SELECTOR, "td.svelte-x63klk a")
-            link = provider_element.get_attribute("href")
+            link = row['href']
             if link in providers:
                 repeat = True
                 print("Repeat item. Trying again")
+                instant('repeat item', 'retry', table='providers', page=current_page)
                 break
-            print(provider_element.text)
+            print(row['link'])
             providers.add(link)
 
         if not repeat:
@@ -319,26 +629,117 @@ def get_electrical_providers(driver: webdriver) -> Set[Dict]:
     return providers
 
 
-def scrape_state(driver: webdriver, url: str, state: str) -> List[Dict]:
-    driver.get(url)
-    driver.maximize_window()
-    print("Scraping {}".format(state))
-    state_info = []
+def get_state_provider_urls(driver: webdriver, url: str, state: str) -> Set[str]:
+    '''Load a state's homepage and return the links to its provider pages.'''
+    with span('state page', state=state):
+        driver.get(url)
+        driver.maximize_window()
+        wait_until_ready(driver, STATE_READY_SELECTOR)
+        print("Scraping {}".format(state))
+
+        return get_electrical_providers(driver)
+
+class ProviderRegistry:
+    '''Provider records scraped during a run, keyed by provider url.
+
+    Multi-state utilities show up on several state pages, the registry lets
+    every state after the first reuse the record instead of scraping it again.
+    '''
+
+    def __init__(self):
+        self._providers = {}
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> Optional[Dict]:
+        with self._lock:
+            return self._providers.get(url)
+
+    def add(self, url: str, provider_info: Dict) -> None:
+        with self._lock:
+            self._providers[url] = provider_info
+
+    def __len__(self) -> int:
+        return len(self._providers)
+
+def get_provider_info_retrying(get_driver: Callable[[], webdriver], url: str) -> Dict:
+    '''get_provider_info() loading the page again after a timeout or a stale element.'''
+    return retry_call(lambda: get_provider_info(get_driver(), url), BROWSER_RETRYABLE,
+        BROWSER_RETRIES, url)
+
+def read_state_provider_urls(get_driver: Callable[[], webdriver], url: str, state: str,
+        http_client: Optional['httpx.Client'] = None, cache: Optional[PageCache] = None) -> List[str]:
+    '''get_state_provider_urls() going through the page cache when one is given.
+
+    get_driver is only called when the state page has to be opened in the browser.
+    '''
+    if cache is None:
+        return list(get_state_provider_urls(get_driver(), url, state))
+
+    return cached_record(cache, http_client, url,
+        lambda html: list(get_state_provider_urls(get_driver(), url, state)))
+
+def read_provider(get_driver: Callable[[], webdriver], url: str,
+        http_client: Optional['httpx.Client'] = None, cache: Optional[PageCache] = None,
+        html: Optional[str] = None) -> Dict:
+    '''Scrape a provider page, using the page cache and plain http when possible.
+
+    get_driver is only called when the page has to be opened in the browser.
+    html is the page when the caller fetched it already, it is parsed as is
+    instead of going through the client and the cache.
+    '''
+    def build(html: Optional[str]) -> Dict:
+        provider_info = None
+        if html is not None:
+            with span('parse provider page'):
+                provider_info = read_provider_page(html, url, TABLE_ROW_LIMIT)
+        if provider_info is None:
+            with span('provider page in browser'):
+                provider_info = get_provider_info_retrying(get_driver, url)
+        return provider_info
+
+    with span('provider', 'provider', url=url):
+        if html is not None:
+            provider_info = build(html)
+        else:
+            # cached records are full ones, cut down records aren't cached
+            provider_info = cached_record(cache, http_client, url, build,
+                records=TABLE_ROW_LIMIT is None)
+
+    # a full run holds every provider until its state is written
+    return compact_provider(provider_info)
+
+def sort_providers(providers_info: List[Dict]) -> List[Dict]:
+    '''Sort providers by total customers served (descending).'''
+    return sorted(providers_info, 
+        key=lambda provider: provider["Total-Customers"], reverse=True)
 
-    provider_urls = get_electrical_providers(driver)
+def scrape_state(driver: webdriver, url: str, state: str,
+        http_client: Optional['httpx.Client'] = None, cache: Optional[PageCache] = None,
+        registry: Optional[ProviderRegistry] = None) -> List[Dict]:
+    with span('state', 'state', state=state):
+        provider_urls = read_state_provider_urls(lambda: driver, url, state, http_client, cache)
 
-    providers_info = []
-    for providerURL in provider_urls:
-        providers_info.append(get_provider_info(driver, providerURL))
+        providers_info = []
+        for providerURL in provider_urls:
+            provider_info = registry.get(providerURL) if registry is not None else None
+            if provider_info is None:
+                provider_info = read_provider(lambda: driver, providerURL, http_client, cache)
+                if registry is not None:
+                    registry.add(providerURL, provider_info)
+
+            providers_info.append(provider_info)
 
     # sort providers by total customers served
-    state_info = sorted(providers_info, 
-        key=lambda provider: provider["Total-Customers"], reverse=True)
+    return sort_providers(providers_info)
 
-    return state_info
+def get_driver(browser: str, driver_path: str, options_list: List[str],
+        lightweight: bool = True) -> webdriver:
+    '''Create webdriver object using path to driver and list of options.
 
-def get_driver(browser: str, driver_path: str, options_list: List[str], ) -> webdriver:
-    '''Create webdriver object using path to driver and list of options.'''
+    With lightweight the session uses the scraping profile from
+    Browser_Profile.py: eager page loads, no images, fonts or media and
+    analytics and ad domains blocked.
+    '''
     driver = None
 
     if browser.lower() == 'firefox':
@@ -346,6 +747,8 @@ def get_driver(browser: str, driver_path: str, options_list: List[str], ) -> web
 
         for option in options_list:
             options.add_argument(option)
+        if lightweight:
+            firefox_options(options)
 
         try:
             driver = webdriver.Firefox(service=FirefoxService(executable_path=driver_path), 
@@ -358,32 +761,134 @@ def get_driver(browser: str, driver_path: str, options_list: List[str], ) -> web
 
         for option in options_list:
             options.add_argument(option)        
+        if lightweight:
+            chrome_options(options)
 
         try:
             driver = webdriver.Chrome(service=ChromeService(executable_path=driver_path), 
                 options=options)
+            if lightweight:
+                block_chrome_requests(driver)
         except Exception as er:
             print(er, file=sys.stderr)
 
     return driver
 
-def main():
+def write_state_providers(state_abrv: str, providers: List[Dict]) -> None:
+    '''Write the providers for a state to its file in OUTPUT_DIR.'''
+    with open('{}/{}-energy-utility-info.json'.format(OUTPUT_DIR, state_abrv), 'w') as wf:
+        json.dump({'electrical-providers': providers}, wf, indent=1, default=json_default)
+
+def add_scrape_arguments(parser: argparse.ArgumentParser) -> None:
+    '''Add the scraping options shared by main() and utility-scraper.py.'''
+    from Async_Scraper import DEFAULT_CONCURRENCY
+    from Rate_Control import DEFAULT_MAX_RATE, DEFAULT_RATE
+    from Driver_Manager import DEFAULT_COMMAND_TIMEOUT, DEFAULT_MAX_PAGES, DEFAULT_MAX_RSS_MB
+    from Scraper_Pool import DEFAULT_WORKERS
+    from Scrape_Journal import JOURNAL_DIR
+
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+        help="number of browser sessions to scrape with (default: %(default)s)")
+    parser.add_argument('--engine', choices=['pool', 'async'], default='pool',
+        help="pool: one browser per worker, async: provider pages fetched concurrently "
+            "over http with asyncio (default: %(default)s)")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+        help="requests in flight with the async engine (default: %(default)s)")
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE,
+        help="requests per second per host to start with, raised while the site answers "
+            "quickly and cut when it throttles or fails (default: %(default)s)")
+    parser.add_argument('--max-rate', type=float, default=DEFAULT_MAX_RATE,
+        help="most requests per second per host (default: %(default)s)")
+    parser.add_argument('--browser-only', action='store_true',
+        help="always scrape provider pages with the browser instead of trying plain http first")
+    parser.add_argument('--no-cache', action='store_true',
+        help="scrape every page again instead of reusing the page cache in {}".format(CACHE_DIR))
+    parser.add_argument('--cache-ttl', type=float, default=DEFAULT_TTL / (24 * 60 * 60),
+        help="days before a cached page is revalidated (default: %(default)s)")
+    parser.add_argument('--resume', action='store_true',
+        help="continue an interrupted run, skipping pages already recorded in {}".format(JOURNAL_DIR))
+    parser.add_argument('--trace', metavar='FILE',
+        help="time every WebDriver command, sleep and page and write a Chrome trace to FILE")
+    parser.add_argument('--prewarm', type=int, default=0,
+        help="browser sessions to start before the first page needs them (default: %(default)s)")
+    parser.add_argument('--recycle-pages', type=int, default=DEFAULT_MAX_PAGES,
+        help="restart a browser after this many pages (default: %(default)s)")
+    parser.add_argument('--recycle-mb', type=float, default=DEFAULT_MAX_RSS_MB,
+        help="restart a browser once it uses this much memory, needs psutil (default: %(default)s)")
+    parser.add_argument('--command-timeout', type=float, default=DEFAULT_COMMAND_TIMEOUT,
+        help="seconds before a hung WebDriver command gets its browser killed and the page "
+            "retried (default: %(default)s)")
+    parser.add_argument('--full-pages', action='store_true',
+        help="load every image, font and script of a page and wait for it to finish loading, "
+            "instead of using the lightweight browser profile")
+    parser.add_argument('--fields', choices=FIELD_PROFILES, default='full',
+        help="full: every county and state served, top: only the first --top-rows of each, "
+            "totals: only the number of counties and states served (default: %(default)s)")
+    parser.add_argument('--top-rows', type=int, default=DEFAULT_TOP_ROWS,
+        help="counties and states kept per provider with --fields top (default: %(default)s)")
+    parser.add_argument('--fresh', action='store_true',
+        help="start over even if {} holds an unfinished run, which is moved aside".format(JOURNAL_DIR))
+
+def main(argv: Optional[List[str]] = None) -> int:
     # info = get_provider_info(driver, 'https://findenergy.com/providers/reliant-energy/')
+    from Async_Scraper import scrape_states_async
+    from Driver_Manager import DriverManager
+    from Provider_Page_Parser import get_http_client
+    from Rate_Control import configure, controllers_summary
+    from Scraper_Pool import scrape_states
+    from Scrape_Journal import JournalError, ScrapeJournal
+
+    parser = argparse.ArgumentParser(description="Scrape electrical providers for every state.")
+    add_scrape_arguments(parser)
+    args = parser.parse_args(argv)
+
+    def driver_factory() -> webdriver:
+        return instrument_driver(get_driver('Firefox', FIREFOX_PATH, ['--headless', '--no-sandbox' ],
+            lightweight=not args.full_pages))
 
-    driver = get_driver('Firefox', FIREFOX_PATH, ['--headless', '--no-sandbox' ])
-    if driver is None:
-        print("Not able to create webdriver object")
+    set_field_profile(args.fields, args.top_rows)
+    configure(rate=args.rate, max_rate=args.max_rate)
+
+    try:
+        journal = ScrapeJournal(resume=args.resume, fresh=args.fresh, fields=field_profile())
+    except JournalError as err:
+        print(err, file=sys.stderr)
         return 1
 
-    info = {}
-    for state, state_abrv in STATES.items():
-        url_query = "{}{}".format(BASE_URL, state_abrv)
-        info[state_abrv]['electrical-providers'] = scrape_state(driver, url_query, state_abrv)
+    if args.trace:
+        start_trace()
 
-        with open('{}/{}-energy-utility-info.json'.format(OUTPUT_DIR, state_abrv), 'w') as wf:
-            json.dump(info[state_abrv], wf, indent=1)
+    # create directory for outputs if not already there
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-    driver.close()
+    state_urls = {}
+    for state, state_abrv in STATES.items():
+        state_urls[state_abrv] = "{}{}".format(BASE_URL, state_abrv)
+
+    http_client = None if args.browser_only else get_http_client()
+    cache = None if args.no_cache else PageCache(ttl=args.cache_ttl * 24 * 60 * 60)
+    drivers = DriverManager(driver_factory, args.recycle_pages, args.recycle_mb,
+        args.command_timeout, args.prewarm)
+
+    if args.engine == 'async':
+        asyncio.run(scrape_states_async(driver_factory, state_urls, args.concurrency, args.rate,
+            on_state_done=write_state_providers, http_client=http_client, cache=cache,
+            journal=journal, drivers=drivers, max_rate=args.max_rate))
+    else:
+        scrape_states(driver_factory, state_urls, args.workers,
+            on_state_done=write_state_providers, http_client=http_client, cache=cache,
+            journal=journal, drivers=drivers)
+
+    for host, summary in controllers_summary().items():
+        print("Rate control {}: {}".format(host, summary))
+    if cache is not None:
+        print("Page cache: {}".format(cache.summary()))
+        cache.close()
+    journal.record_run_complete(state_urls)
+    journal.close()
+
+    if args.trace:
+        stop_trace(args.trace)
     
     return 0
     
@@ -0,0 +1,200 @@
+# Append-only journal of the work finished during a scrape.
+#
+# Every state page read and every provider page scraped is recorded as one
+#  JSON line in JOURNAL_DIR/journal.jsonl. Provider records are written to
+#  their own file under JOURNAL_DIR/providers before the journal line that
+#  points at them, so a crash at any point leaves either a complete record or
+#  no record at all. With --resume a rerun reads the journal back and only
+#  scrapes the pages that weren't finished (or failed) the last time.
+#
+# A run that finishes every state marks its journal complete. A new run
+#  without --resume refuses to start over a journal that isn't, unless it is
+#  given --fresh, and moves the old one aside to JOURNAL_DIR.prev instead of
+#  deleting it. The --fields profile is recorded too, so a resumed run can't
+#  mix full and cut down provider records.
+#
+
+# Python standard libs
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+# local module
+from Json_Stream import json_default
+from Provider_Record import compact_provider
+
+JOURNAL_DIR = "checkpoints"
+JOURNAL_FILE = "journal.jsonl"
+PROVIDERS_DIR = "providers"
+PREVIOUS_SUFFIX = ".prev"
+
+
+class JournalError(RuntimeError):
+    '''The journal left behind can't be used (or dropped) as asked.'''
+
+
+def write_json_atomic(filepath: str, content: object) -> None:
+    '''Write content to a json file without ever leaving a partial file behind.'''
+    tmp_path = "{}.tmp".format(filepath)
+
+    with open(tmp_path, 'w') as wf:
+        json.dump(content, wf, default=json_default)
+        wf.flush()
+        os.fsync(wf.fileno())
+
+    os.replace(tmp_path, filepath)
+
+
+class ScrapeJournal:
+    '''Journal of finished states and provider pages for resuming a scrape.'''
+
+    def __init__(self, directory: str = JOURNAL_DIR, resume: bool = False, fresh: bool = False,
+            fields: Optional[str] = None):
+        '''Open the journal in directory.
+
+        resume reads back the journal of an earlier run, otherwise a new one
+        is started (see the top of the file). fields names the --fields
+        profile of the run, checked against the journal's on resume.
+        Raises JournalError when neither can be done.
+        '''
+        self.directory = directory
+        self.journal_path = os.path.join(directory, JOURNAL_FILE)
+        self.providers_dir = os.path.join(directory, PROVIDERS_DIR)
+
+        self.fields = None          # --fields profile the journal was written with
+        self.complete = False
+        self.state_urls = {}        # state -> provider urls from its homepage
+        self.providers = {}         # provider url -> record file
+        self.failed = {}            # provider url -> last error
+        self.states_done = set()
+
+        if resume:
+            self._load()
+            if fields is not None and self.fields is not None and fields != self.fields:
+                raise JournalError("{} was written with --fields {}, resume with the same "
+                    "profile or start over with --fresh".format(directory, self.fields))
+        else:
+            self._start_over(fresh)
+
+        os.makedirs(self.providers_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._journal = open(self.journal_path, 'a')
+
+        if self.fields is None and fields is not None:
+            self.fields = fields
+            self._append({ 'event': 'run', 'fields': fields })
+
+    def _start_over(self, fresh: bool) -> None:
+        if not os.path.exists(self.journal_path):
+            shutil.rmtree(self.directory, ignore_errors=True)
+            return
+
+        self._load(quiet=True)
+        if not (self.state_urls or self.providers):
+            # nothing was scraped, nothing worth keeping
+            shutil.rmtree(self.directory, ignore_errors=True)
+        elif not self.complete and not fresh:
+            raise JournalError("{} holds an unfinished run ({} states done), continue it with "
+                "--resume or start over with --fresh".format(self.directory, len(self.states_done)))
+        else:
+            # keep the last run's checkpoints around rather than deleting them
+            previous = self.directory.rstrip(os.sep) + PREVIOUS_SUFFIX
+            shutil.rmtree(previous, ignore_errors=True)
+            os.replace(self.directory, previous)
+            print("Moved the previous journal to {}".format(previous))
+
+        self.fields = None
+        self.complete = False
+        self.state_urls, self.providers, self.failed = {}, {}, {}
+        self.states_done = set()
+
+    def _load(self, quiet: bool = False) -> None:
+        if not os.path.exists(self.journal_path):
+            return
+
+        with open(self.journal_path, 'r') as rf:
+            for line in rf:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # last line of a run that crashed mid-write
+                    continue
+
+                event = entry['event']
+                if event == 'run':
+                    self.fields = entry['fields']
+                elif event == 'state-urls':
+                    self.state_urls[entry['state']] = entry['urls']
+                elif event == 'provider':
+                    self.providers[entry['url']] = entry['file']
+                    self.failed.pop(entry['url'], None)
+                elif event == 'provider-failed':
+                    self.failed[entry['url']] = entry['error']
+                elif event == 'state-done':
+                    self.states_done.add(entry['state'])
+                elif event == 'run-complete':
+                    self.complete = True
+
+        if not quiet:
+            print("Resuming: {} states and {} provider pages already scraped, {} failed".format(
+                len(self.states_done), len(self.providers), len(self.failed)))
+
+    def _append(self, entry: Dict) -> None:
+        entry['time'] = time.time()
+        with self._lock:
+            self._journal.write(json.dumps(entry) + '\n')
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+
+    def get_state_urls(self, state: str) -> Optional[List[str]]:
+        return self.state_urls.get(state)
+
+    def record_state_urls(self, state: str, urls: List[str]) -> None:
+        self.state_urls[state] = urls
+        self._append({ 'event': 'state-urls', 'state': state, 'urls': urls })
+
+    def load_provider(self, url: str) -> Optional[Dict]:
+        '''Return the record saved for a provider page, None if it wasn't finished.'''
+        filename = self.providers.get(url)
+        if filename is None:
+            return None
+
+        try:
+            with open(os.path.join(self.providers_dir, filename), 'r') as rf:
+                return compact_provider(json.load(rf))
+        except (OSError, ValueError) as err:
+            print(err, file=sys.stderr)
+            return None
+
+    def record_provider(self, url: str, provider_info: Dict) -> None:
+        filename = "{}.json".format(hashlib.sha1(url.encode('utf-8')).hexdigest())
+        write_json_atomic(os.path.join(self.providers_dir, filename), provider_info)
+
+        self.providers[url] = filename
+        self._append({ 'event': 'provider', 'url': url, 'file': filename })
+
+    def record_failure(self, url: str, error: str) -> None:
+        self.failed[url] = error
+        self._append({ 'event': 'provider-failed', 'url': url, 'error': error })
+
+    def record_state_done(self, state: str) -> None:
+        self.states_done.add(state)
+        self._append({ 'event': 'state-done', 'state': state })
+
+    def record_run_complete(self, states: Iterable[str]) -> bool:
+        '''Mark the run complete if every one of states is done, returns whether it was.'''
+        if not set(states) <= self.states_done:
+            return False
+
+        self.complete = True
+        self._append({ 'event': 'run-complete' })
+        return True
+
+    def close(self) -> None:
+        self._journal.close()
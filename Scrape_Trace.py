@@ -0,0 +1,220 @@
+# Timing and WebDriver call instrumentation for scrape runs.
+#
+# While a trace is running (start_trace(), --trace FILE on the command line)
+#  every WebDriver command sent by an instrumented driver and every span
+#  marked in the scraper (state pages, provider pages, table pages, the
+#  WebDriverWait waits) is recorded with its start time and duration, and
+#  retries ("Repeat item") are recorded as instant events. The scraper's own
+#  sleeps (backoff, pacing) go through sleep(), which records them too.
+#  time.sleep itself is left alone, it is shared with every other thread.
+#
+# stop_trace() writes the events in the Chrome trace format, which can be
+#  opened in chrome://tracing or https://ui.perfetto.dev, and prints a summary:
+#  count and time per command/span and the slowest states and providers.
+#
+# Without a running trace span() and instant() do nothing.
+#
+
+# Python standard libs
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+# the trace of the current run, None when not tracing
+TRACER = None
+
+SLOWEST_COUNT = 10
+
+
+class Tracer:
+    '''Chrome trace events and per-name totals of one run.'''
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.events = []
+        self.totals = {}        # (category, name) -> [count, seconds, max seconds]
+        self.tracks = {}        # track label -> tid
+        self._lock = threading.Lock()
+
+    def _microseconds(self, seconds: float) -> float:
+        return round((seconds - self.started) * 1e6, 1)
+
+    def _tid(self, track: Optional[str]) -> int:
+        '''Thread id to show an event under, a named track of its own if given.
+
+        Things that overlap on one thread (states waiting on the pool, asyncio
+        tasks) need their own track to show up properly in the trace viewer.
+        '''
+        if track is None:
+            return threading.get_ident()
+
+        if track not in self.tracks:
+            self.tracks[track] = len(self.tracks) + 1
+            self.events.append({ 'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                'tid': self.tracks[track], 'args': { 'name': track } })
+        return self.tracks[track]
+
+    def complete(self, name: str, category: str, start: float, end: float,
+            args: Optional[Dict] = None, track: Optional[str] = None) -> None:
+        '''Record something that ran from start to end (time.perf_counter() values).'''
+        event = {
+            'name': name, 'cat': category, 'ph': 'X',
+            'ts': self._microseconds(start), 'dur': round((end - start) * 1e6, 1),
+            'pid': os.getpid(),
+        }
+        if args:
+            event['args'] = args
+
+        with self._lock:
+            event['tid'] = self._tid(track)
+            self.events.append(event)
+            total = self.totals.setdefault((category, name), [0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += end - start
+            total[2] = max(total[2], end - start)
+
+    def instant(self, name: str, category: str, args: Optional[Dict] = None) -> None:
+        event = {
+            'name': name, 'cat': category, 'ph': 'i', 's': 't',
+            'ts': self._microseconds(time.perf_counter()),
+            'pid': os.getpid(), 'tid': threading.get_ident(),
+        }
+        if args:
+            event['args'] = args
+
+        with self._lock:
+            self.events.append(event)
+            self.totals.setdefault((category, name), [0, 0.0, 0.0])[0] += 1
+
+    def seconds_in(self, *categories: str) -> float:
+        '''Total time of the events recorded in categories.'''
+        with self._lock:
+            return sum(seconds for (category, _), (_, seconds, _) in self.totals.items()
+                if category in categories)
+
+    def slowest(self, category: str, key: str) -> List[Dict]:
+        with self._lock:
+            spans = [ event for event in self.events
+                if event['ph'] == 'X' and event['cat'] == category ]
+        spans.sort(key=lambda event: event['dur'], reverse=True)
+
+        return [ { key: event.get('args', {}).get(key), 'seconds': round(event['dur'] / 1e6, 3) }
+            for event in spans[:SLOWEST_COUNT] ]
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            totals = sorted(self.totals.items(), key=lambda item: item[1][1], reverse=True)
+
+        return {
+            'seconds': round(time.perf_counter() - self.started, 3),
+            'totals': [ {
+                'category': category, 'name': name, 'count': count,
+                'seconds': round(seconds, 3), 'max': round(longest, 3),
+            } for (category, name), (count, seconds, longest) in totals ],
+            'slowest-states': self.slowest('state', 'state'),
+            'slowest-providers': self.slowest('provider', 'url'),
+        }
+
+    def format_summary(self, summary: Dict[str, Any]) -> str:
+        lines = [ "Trace of {}s:".format(summary['seconds']),
+            "  {:10} {:34} {:>8} {:>10} {:>8}".format('category', 'name', 'count', 'seconds', 'max') ]
+        for total in summary['totals']:
+            lines.append("  {category:10} {name:34} {count:>8} {seconds:>10} {max:>8}".format(**total))
+
+        for title, key in (('states', 'state'), ('providers', 'url')):
+            lines.append("Slowest {}:".format(title))
+            for item in summary['slowest-{}'.format(title)]:
+                lines.append("  {:>8}s  {}".format(item['seconds'], item[key]))
+
+        return "\n".join(lines)
+
+    def write(self, filename: str, summary: Dict[str, Any]) -> None:
+        with self._lock:
+            events = list(self.events)
+
+        with open(filename, 'w') as wf:
+            json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': summary }, wf)
+
+
+def start_trace() -> Tracer:
+    '''Start recording, instrument_driver() has to be called on each driver.'''
+    global TRACER
+    TRACER = Tracer()
+    return TRACER
+
+def stop_trace(filename: Optional[str] = None, quiet: bool = False) -> Optional[Dict[str, Any]]:
+    '''Stop recording, write the trace to filename and print its summary unless quiet.'''
+    global TRACER
+    tracer, TRACER = TRACER, None
+    if tracer is None:
+        return None
+
+    summary = tracer.summary()
+    if filename is not None:
+        tracer.write(filename, summary)
+        print("Wrote trace to {}".format(filename))
+
+    if not quiet:
+        print(tracer.format_summary(summary))
+    return summary
+
+def span(name: str, category: str = 'scrape', track: Optional[str] = None, **args) -> Any:
+    '''Context manager recording how long its block takes.'''
+    if TRACER is None:
+        return contextlib.nullcontext()
+    return _span(TRACER, name, category, track, args)
+
+@contextlib.contextmanager
+def _span(tracer: Tracer, name: str, category: str, track: Optional[str], args: Dict) -> Any:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        tracer.complete(name, category, start, time.perf_counter(), args, track)
+
+def complete(name: str, category: str, start: float, track: Optional[str] = None, **args) -> None:
+    '''Record something that started at start (time.perf_counter()) and just finished.'''
+    if TRACER is not None:
+        TRACER.complete(name, category, start, time.perf_counter(), args, track)
+
+def sleep(seconds: float, name: str = 'sleep') -> None:
+    '''time.sleep() recorded in the 'sleep' category while a trace is running.'''
+    start = time.perf_counter()
+    try:
+        time.sleep(seconds)
+    finally:
+        complete(name, 'sleep', start)
+
+def instant(name: str, category: str = 'scrape', **args) -> None:
+    '''Record that something happened, e.g. a retry.'''
+    if TRACER is not None:
+        TRACER.instant(name, category, args)
+
+def instrument_driver(driver: Optional[Any]) -> Optional[Any]:
+    '''Time every command driver sends while a trace is running.
+
+    Element methods (click, get_attribute, ...) go through driver.execute()
+    as well, so they are included.
+    '''
+    if driver is None:
+        return None
+
+    execute = driver.execute
+
+    def traced_execute(driver_command: str, params: Optional[Dict] = None) -> Dict:
+        tracer = TRACER
+        if tracer is None:
+            return execute(driver_command, params)
+
+        start = time.perf_counter()
+        try:
+            return execute(driver_command, params)
+        finally:
+            tracer.complete(driver_command, 'webdriver', start, time.perf_counter())
+
+    driver.execute = traced_execute
+    return driver
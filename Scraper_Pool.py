@@ -0,0 +1,343 @@
+# Worker pool used to scrape several states at the same time.
+#
+# Each worker thread owns its own webdriver session and pulls tasks from a
+#  shared queue. A state task loads the state's homepage and queues one task
+#  per provider url found there, so large states are spread across every
+#  worker instead of being pinned to a single browser.
+#
+# Utilities serving several states are listed on each of those state pages.
+#  Their provider page is only scraped once per run and the same record is
+#  used in the output of every state that lists it.
+#
+# Sessions come from a DriverManager (see Driver_Manager.py) which recycles
+#  them as they age. A task whose session died or hung is retried with a new
+#  session instead of failing its states.
+#
+
+# Python standard libs
+import itertools
+import queue
+import sys
+import threading
+import time
+import traceback
+from typing import Callable, Dict, List, Optional, Tuple
+
+# 3rd party libs
+import httpx
+from selenium import webdriver
+
+# local module
+from Driver_Manager import DriverManager
+from Page_Cache import PageCache
+from Scrape_Electrical_Providers import ProviderRegistry
+from Scrape_Electrical_Providers import read_state_provider_urls
+from Scrape_Electrical_Providers import read_provider
+from Scrape_Electrical_Providers import sort_providers
+from Scrape_Journal import ScrapeJournal
+from Scrape_Trace import complete
+
+# provider tasks are handed out before state tasks so states finish (and
+#  get written out) one after another instead of all at the very end
+PROVIDER_PRIORITY = 0
+STATE_PRIORITY = 1
+
+DEFAULT_WORKERS = 4
+# times a task is retried after its session died
+DRIVER_RETRIES = 2
+
+
+class StateProgress:
+    '''Collects provider results for a state until every provider is done.'''
+
+    def __init__(self, state: str, provider_urls: List[str], started: float):
+        self.state = state
+        self.started = started      # time.perf_counter() when the state task started
+        self.provider_urls = provider_urls
+        self.results = [None] * len(provider_urls)
+        self.remaining = len(provider_urls)
+        self.failed = False
+
+
+class ScraperPool:
+    '''Scrape states with several webdriver sessions sharing a work queue.
+
+    driver_factory is called once per worker (and again whenever a worker
+    has to replace a driver after a failure) and should return a webdriver
+    object or None. on_state_done is called with the state abbreviation and
+    the sorted list of providers as soon as every provider of a state has
+    been scraped.
+
+    When an http_client is given provider pages are first read over plain
+    http (see Provider_Page_Parser.py) and a browser is only started for
+    pages that can't be read that way. With a cache, pages that haven't
+    changed since the last run aren't scraped again (see Page_Cache.py).
+    With a journal, finished pages are recorded as they complete and pages
+    already recorded by an interrupted run are not scraped again (see
+    Scrape_Journal.py). Sessions are handed out by drivers, a DriverManager
+    using driver_factory with its default limits if none is given, which is
+    closed at the end of run().
+    '''
+
+    def __init__(self, driver_factory: Callable[[], webdriver],
+            num_workers: int = DEFAULT_WORKERS,
+            on_state_done: Optional[Callable[[str, List[Dict]], None]] = None,
+            http_client: Optional[httpx.Client] = None,
+            cache: Optional[PageCache] = None,
+            journal: Optional[ScrapeJournal] = None,
+            drivers: Optional[DriverManager] = None):
+        if num_workers < 1:
+            raise ValueError("num_workers must be at least 1")
+
+        self.driver_factory = driver_factory
+        self.drivers = drivers if drivers is not None else DriverManager(driver_factory)
+        self.num_workers = num_workers
+        self.on_state_done = on_state_done
+        self.http_client = http_client
+        self.cache = cache
+        self.journal = journal
+
+        self._tasks = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        # each worker thread keeps its webdriver here
+        self._local = threading.local()
+        self._states = {}
+        # provider url -> [ (state, index) ] of every state waiting on that page
+        self._waiting = {}
+        # task -> times it was retried after its session died
+        self._retries = {}
+        self.registry = ProviderRegistry()
+        self.results = {}
+        self.failed_states = []
+
+    def _put(self, priority: int, task: Tuple) -> None:
+        # the counter keeps tasks with the same priority in FIFO order
+        self._tasks.put((priority, next(self._counter), task))
+
+    def add_state(self, state: str, url: str) -> None:
+        '''Queue a state homepage (e.g. https://findenergy.com/ak).'''
+        self._put(STATE_PRIORITY, ('state', state, url))
+
+    def _get_driver(self) -> webdriver:
+        '''Return this worker's webdriver, getting one from the manager if needed.'''
+        if getattr(self._local, 'driver', None) is None:
+            self._local.driver = self.drivers.acquire()
+        self._local.used = True
+
+        return self._local.driver
+
+    def _release_driver(self) -> None:
+        '''Count the page just scraped against this worker's session.'''
+        if not getattr(self._local, 'used', False):
+            return
+        self._local.used = False
+        if not self.drivers.release(self._local.driver):
+            # recycled, the next page gets a fresh session
+            self._local.driver = None
+
+    def _quit_driver(self) -> None:
+        driver = getattr(self._local, 'driver', None)
+        self._local.driver = None
+        self._local.used = False
+        if driver is not None:
+            self.drivers.discard(driver)
+
+    def _retry_task(self, task: Tuple) -> bool:
+        '''Queue a task again if it failed because its session died.'''
+        driver = getattr(self._local, 'driver', None)
+        if driver is None or not self.drivers.is_dead(driver):
+            return False
+
+        with self._lock:
+            retries = self._retries.get(task, 0)
+            if retries >= DRIVER_RETRIES:
+                return False
+            self._retries[task] = retries + 1
+
+        print("Session died during {}, retrying with a new one".format(task), file=sys.stderr)
+        self._put(STATE_PRIORITY if task[0] == 'state' else PROVIDER_PRIORITY, task)
+        return True
+
+    def _state_task(self, state: str, url: str) -> None:
+        started = time.perf_counter()
+        provider_urls = None
+        if self.journal is not None:
+            provider_urls = self.journal.get_state_urls(state)
+
+        if provider_urls is None:
+            provider_urls = read_state_provider_urls(self._get_driver, url, state,
+                self.http_client, self.cache)
+            if self.journal is not None:
+                self.journal.record_state_urls(state, provider_urls)
+
+        # records finished by an earlier run that was interrupted
+        saved = {}
+        if self.journal is not None:
+            for provider_url in provider_urls:
+                if self.registry.get(provider_url) is None:
+                    info = self.journal.load_provider(provider_url)
+                    if info is not None:
+                        saved[provider_url] = info
+
+        progress = StateProgress(state, provider_urls, started)
+
+        finished = []
+        with self._lock:
+            self._states[state] = progress
+
+            for index, provider_url in enumerate(provider_urls):
+                if provider_url in saved:
+                    self.registry.add(provider_url, saved[provider_url])
+
+                info = self.registry.get(provider_url)
+                if info is not None:
+                    # already scraped for another state
+                    progress.results[index] = info
+                    progress.remaining -= 1
+                elif provider_url in self._waiting:
+                    # being scraped for another state right now
+                    self._waiting[provider_url].append((state, index))
+                else:
+                    self._waiting[provider_url] = [ (state, index) ]
+                    self._put(PROVIDER_PRIORITY, ('provider', provider_url))
+
+            if progress.remaining == 0:
+                finished.append(progress)
+
+        for progress in finished:
+            self._finish_state(progress)
+
+    def _provider_task(self, url: str) -> None:
+        info = read_provider(self._get_driver, url, self.http_client, self.cache)
+        if self.journal is not None:
+            self.journal.record_provider(url, info)
+
+        finished = []
+        with self._lock:
+            self.registry.add(url, info)
+
+            # hand the record to every state that lists this provider
+            for state, index in self._waiting.pop(url):
+                progress = self._states[state]
+                progress.results[index] = info
+                progress.remaining -= 1
+                if progress.remaining == 0 and not progress.failed:
+                    finished.append(progress)
+
+        for progress in finished:
+            self._finish_state(progress)
+
+    def _finish_state(self, progress: StateProgress) -> None:
+        state_info = sort_providers(progress.results)
+
+        with self._lock:
+            self.results[progress.state] = state_info
+
+        if self.on_state_done is not None:
+            self.on_state_done(progress.state, state_info)
+
+        if self.journal is not None:
+            self.journal.record_state_done(progress.state)
+
+        # from the state page being read to its last provider, on a track of
+        #  its own since states overlap
+        complete('state', 'state', progress.started, track='state {}'.format(progress.state),
+            state=progress.state, providers=len(progress.results))
+
+    def _fail_task(self, task: Tuple, error: Exception) -> None:
+        if task[0] == 'provider' and self.journal is not None:
+            self.journal.record_failure(task[1], repr(error))
+
+        with self._lock:
+            if task[0] == 'state':
+                states = [ task[1] ]
+            else:
+                states = [ state for state, _ in self._waiting.pop(task[1], []) ]
+
+            for state in states:
+                if state not in self.failed_states:
+                    self.failed_states.append(state)
+                if state in self._states:
+                    self._states[state].failed = True
+
+    def _worker(self) -> None:
+        try:
+            while True:
+                _, _, task = self._tasks.get()
+                try:
+                    if task is None:
+                        return
+                    if self._stop.is_set():
+                        # run() was interrupted, drain the queue
+                        continue
+
+                    if task[0] == 'state':
+                        self._state_task(*task[1:])
+                    else:
+                        self._provider_task(*task[1:])
+                    self._release_driver()
+                except Exception as err:
+                    if not self._retry_task(task):
+                        print("Failed {}".format(task), file=sys.stderr)
+                        traceback.print_exc()
+                        self._fail_task(task, err)
+                    # the session may be left on a half loaded page or be
+                    #   dead altogether, so start the next task with a new one
+                    self._quit_driver()
+                finally:
+                    self._tasks.task_done()
+        finally:
+            self._quit_driver()
+
+    def run(self) -> Dict[str, List[Dict]]:
+        '''Run the queued work and return the providers found for each state.
+
+        States with a failed task are left out of the results and listed in
+        failed_states instead.
+        '''
+        workers = [ threading.Thread(target=self._worker, daemon=True)
+            for _ in range(self.num_workers) ]
+
+        for worker in workers:
+            worker.start()
+
+        try:
+            self._tasks.join()
+        finally:
+            self._stop.set()
+            # sentinels sort after every real task
+            for _ in workers:
+                self._put(sys.maxsize, None)
+            for worker in workers:
+                worker.join()
+            self.drivers.close()
+
+        return self.results
+
+
+def scrape_states(driver_factory: Callable[[], webdriver], states: Dict[str, str],
+        num_workers: int = DEFAULT_WORKERS,
+        on_state_done: Optional[Callable[[str, List[Dict]], None]] = None,
+        http_client: Optional[httpx.Client] = None,
+        cache: Optional[PageCache] = None,
+        journal: Optional[ScrapeJournal] = None,
+        drivers: Optional[DriverManager] = None) -> Dict[str, List[Dict]]:
+    '''Scrape every state in states ({abbreviation: url}) using a worker pool.'''
+    pool = ScraperPool(driver_factory, num_workers, on_state_done, http_client, cache, journal,
+        drivers)
+
+    for state, url in states.items():
+        pool.add_state(state, url)
+
+    results = pool.run()
+
+    print("Scraped {} provider pages for {} states".format(len(pool.registry), len(results)))
+
+    print("Browser sessions: {}".format(pool.drivers.summary()))
+
+    if pool.failed_states:
+        print("Failed states: {}".format(", ".join(pool.failed_states)), file=sys.stderr)
+
+    return results
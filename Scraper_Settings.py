@@ -0,0 +1,96 @@
+# Settings shared by the scripts: file locations, the site and the states.
+#
+# Only constants live here, no imports, so the scripts that just need a path
+#  or the list of states (Merge_Json.py, Utility_Store.py, the utility-scraper.py
+#  command line) don't load pandas or selenium with them. The modules that
+#  used to define these still export them under the same names.
+#
+
+# Used by webdriver_manager if not supplying path to driver
+# from webdriver_manager.firefox import GeckoDriverManager
+# webdriver_manager info:
+#
+# https://github.com/SergeyPirogov/webdriver_manager#use-with-chrome
+# This option can be used with minor adjustments to the get_driver() function
+# 
+#
+# Or to download the browser driver:
+#   https://www.selenium.dev/documentation/webdriver/getting_started/install_drivers/
+#
+FIREFOX_PATH = "./geckodriver" # replace with path to driver for your OS
+
+BASE_URL = "https://findenergy.com/"
+OUTPUT_DIR = 'outputs'
+
+STATES = {
+    'Alaska': 'AK',
+    'Alabama': 'AL',
+    'Arkansas': 'AR',
+    'Arizona': 'AZ',
+    'California': 'CA',
+    'Colorado': 'CO',
+    'Connecticut': 'CT',
+    'Delaware': 'DE',
+    'Florida': 'FL',
+    'Georgia': 'GA',
+    'Hawaii': 'HI',
+    'Iowa': 'IA',
+    'Idaho': 'ID',
+    'Illinois': 'IL',
+    'Indiana': 'IN',
+    'Kansas': 'KS',
+    'Kentucky': 'KY',
+    'Louisiana': 'LA',
+    'Massachusetts': 'MA',
+    'Maryland': 'MD',
+    'Maine': 'ME',
+    'Michigan': 'MI',
+    'Minnesota': 'MN',
+    'Missouri': 'MO',
+    'Mississippi': 'MS',
+    'Montana': 'MT',
+    'North Carolina': 'NC',
+    'North Dakota': 'ND',
+    'Nebraska': 'NE',
+    'New Hampshire': 'NH',
+    'New Jersey': 'NJ',
+    'New Mexico': 'NM',
+    'Nevada': 'NV',
+    'New York': 'NY',
+    'Ohio': 'OH',
+    'Oklahoma': 'OK',
+    'Oregon': 'OR',
+    'Pennsylvania': 'PA',
+    'Rhode Island': 'RI',
+    'South Carolina': 'SC',
+    'South Dakota': 'SD',
+    'Tennessee': 'TN',
+    'Texas': 'TX',
+    'Utah': 'UT',
+    'Virginia': 'VA',
+    'Vermont': 'VT',
+    'Washington': 'WA',
+    'Wisconsin': 'WI',
+    'West Virginia': 'WV',
+    'Wyoming': 'WY'
+}
+
+#### FILE INFO ####
+DATASETS_DIRECTORY_PATH             = "datasets" 
+US_ENERGY_PRODUCTION_BY_STATE_FILE  = "annual_generation_state.xls"
+US_POPULATION_BY_CITY_FILE          = "sub-est2021_all.csv"
+US_WATER_PROVIDERS_BY_STATE_FILE    = "Water System Detail.csv"
+
+OUTPUT_FILE = "all-states-water-population-info.json"
+
+#### CSV/XLS HEADER NAMES ####
+# These strings are from the files shown above and are consistent
+#   between the census.gov datasets. 
+# The year should be adjusted as needed
+COL_HEADER_1 = 'POPESTIMATE2020'
+COL_HEADER_2 = 'POPESTIMATE2021'
+
+# These specify the dictionary key for annual population
+#   Adjust accordingly
+POP_KEY_1 = 'estimate-2020'
+POP_KEY_2 = 'estimate-2021'
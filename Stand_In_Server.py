@@ -0,0 +1,370 @@
+# Local stand-in for findenergy.com, for benchmarking the scraper offline.
+#
+# State and provider pages are rendered from the provider records already
+#  scraped into OUTPUT_DIR, with the same markup the scraper reads: the
+#  svelte-x63klk tables, their "N items" footers and the pagination list whose
+#  "li.active + li" button shows the next page. Every table holds its rows as
+#  JSON and a small script redraws the rows and the pagination buttons on
+#  click, like the Svelte tables on the site, so button_click() and the page
+#  change waits behave the same. Only the first page of each table is in the
+#  html itself, as it is on the site.
+#
+# Scraping a stand-in page gives back the record it was rendered from.
+#
+# To try the scraper against a site under strain the server can slow down as
+#  requests pile up (load_latency), answer 429 with a Retry-After once more
+#  than `capacity` requests arrive in a second, and fail a share of requests
+#  (error_rate) with a 500.
+#
+#   python3 Stand_In_Server.py --port 8000 AK HI
+#   (then scrape http://127.0.0.1:8000/AK)
+#   python3 Stand_In_Server.py --capacity 10 --error-rate 0.05 --load-latency 0.05
+#
+
+# Python standard libs
+import argparse
+import html
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+# local module
+from Scraper_Settings import OUTPUT_DIR
+
+PAGE_SIZE = 10
+RETRY_AFTER = 1     # seconds asked for in the 429 answered over capacity
+
+TABLE_SCRIPT = """
+<script>
+document.querySelectorAll("section[data-table]").forEach(section => {
+    const rows = JSON.parse(section.querySelector("script.table-rows").textContent);
+    const pages = Math.ceil(rows.length / %(page_size)d);
+    const tbody = section.querySelector("tbody");
+    const pagination = section.querySelector("ul.pagination");
+
+    function show(page) {
+        tbody.innerHTML = rows.slice(page * %(page_size)d, (page + 1) * %(page_size)d).join("");
+
+        // like the site, only the buttons next to the current page are in the DOM
+        pagination.innerHTML = "";
+        for (let i = Math.max(0, page - 2); i < Math.min(pages, page + 3); i++) {
+            const button = document.createElement("li");
+            button.className = (i == page ? "active " : "") + "svelte-x63klk";
+            button.innerHTML = '<a href="javascript:void(0)" class="svelte-x63klk">' + (i + 1) + "</a>";
+            button.onclick = () => setTimeout(() => show(i), %(render_delay)d);
+            pagination.appendChild(button);
+        }
+    }
+
+    show(0);
+});
+</script>
+"""
+
+
+def slug(name: str) -> str:
+    return re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-')
+
+def format_number(value: float) -> str:
+    return "{:,}".format(int(value)) if float(value).is_integer() else "{:,}".format(value)
+
+#### rendering ####
+
+def render_table(section_id: str, rows: List[str], page_size: int) -> str:
+    '''A svelte-x63klk table showing the first page of rows, with the rest kept for the script.'''
+    # json inside a script tag must not end it early
+    rows_json = json.dumps(rows).replace('</', '<\\/')
+
+    return ''.join([
+        '<section id="{}" data-table>'.format(section_id),
+        '<table class="table sortable-table svelte-x63klk"><tbody>',
+        ''.join(rows[:page_size]),
+        '</tbody></table>',
+        '<div class="table-footer svelte-x63klk">',
+        '<span class="table-footer__data svelte-x63klk">{} items</span>'.format(format_number(len(rows))),
+        '<ul class="pagination svelte-x63klk"></ul>',
+        '</div>',
+        '<script type="application/json" class="table-rows">{}</script>'.format(rows_json),
+        '</section>',
+    ])
+
+def table_row(first: str, second: str) -> str:
+    return '<tr class="svelte-x63klk"><td class="svelte-x63klk">{}</td><td class="svelte-x63klk">{}</td></tr>'.format(
+        first, second)
+
+def facts_section(title: str, items: List[str]) -> str:
+    return ''.join([
+        '<div class="facts-item svelte-3uw1eb">',
+        '<h3 class="facts-item__title svelte-3uw1eb">{}</h3>'.format(html.escape(title)),
+        '<ul>{}</ul>'.format(''.join(items)),
+        '</div>',
+    ])
+
+def fact_item(label: str, data: str, units: str = '') -> str:
+    units_html = ' <span class="text-muted">{}</span>'.format(html.escape(units)) if units else ''
+    return ''.join([
+        '<li class="facts-item__li svelte-3uw1eb">',
+        '<h4 class="facts-item__label svelte-3uw1eb">{}</h4>'.format(html.escape(label)),
+        '<p class="facts-item__data svelte-3uw1eb"><strong>{}</strong>{}</p>'.format(
+            html.escape(data), units_html),
+        '</li>',
+    ])
+
+def render_page(title: str, body: str, page_size: int, render_delay: int) -> str:
+    script = TABLE_SCRIPT % { 'page_size': page_size, 'render_delay': render_delay }
+    return '<!DOCTYPE html><html><head><title>{}</title></head><body>{}{}</body></html>'.format(
+        html.escape(title), body, script)
+
+def render_provider_page(provider_info: Dict, page_size: int = PAGE_SIZE,
+        render_delay: int = 0) -> str:
+    '''Provider page that scrapes back to provider_info.'''
+    sales = []
+    production = []
+    for key, value in provider_info.items():
+        if key.endswith('-($)'):
+            sales.append(fact_item(key[:-len('-($)')].replace('-', ' '), '$' + format_number(value)))
+        elif key.endswith('-Customers') and key != 'Total-Customers':
+            sales.append(fact_item(key.replace('-', ' '), format_number(value)))
+        elif key.endswith('-MWh') or key.endswith('-MW'):
+            label, units = key.rsplit('-', 1)
+            production.append(fact_item(label.replace('-', ' '), format_number(value), units))
+
+    website = ''
+    if provider_info.get('website'):
+        website = ('<ul class="list-unstyled company-info__list svelte-1f6rrn3">'
+            '<li class="svelte-1f6rrn3"><a href="{}">Website</a></li></ul>').format(
+                html.escape(provider_info['website']))
+
+    body = [
+        '<section id="overview"><div class="row">',
+        '<div class="col-lg-5">',
+        '<h1 class="overview__title svelte-1f6rrn3">{}</h1>'.format(html.escape(provider_info['company'])),
+        '<ul class="list-unstyled company-info__list svelte-1f6rrn3"><li class="svelte-1f6rrn3">'
+            '<span class="svelte-1f6rrn3">Type</span> <span class="svelte-1f6rrn3">{}</span></li></ul>'.format(
+                html.escape(provider_info.get('company-type', ''))),
+        website,
+        '</div><div class="col-lg-5"></div>',
+        '</div></section>',
+        '<div class="tab-nav tab-nav--underlined svelte-9ar7ba">{}</div>'.format(''.join(
+            '<a class="tab-nav__link">{}</a>'.format(html.escape(service))
+            for service in provider_info.get('service-types', []))),
+        '<div class="sidebar-widget">',
+        facts_section("SALES & CUSTOMERS", sales),
+        facts_section("ENERGY PRODUCTION", production),
+        '</div>',
+        '<section id="city-coverage"><ul>{}</ul></section>'.format(''.join(
+            '<li class="svelte-1f6rrn3"><a href="#">{}</a></li>'.format(html.escape(city))
+            for city in provider_info.get('cities-served', []))),
+    ]
+
+    if 'counties-served' in provider_info:
+        rows = []
+        for county in provider_info['counties-served']:
+            name, state = county['county'].rsplit(', ', 1)
+            link = '<a href="/{}/{}/">{}</a>'.format(state.lower(), slug(name), html.escape(name))
+            rows.append(table_row(link, format_number(county['population'])))
+        body.append(render_table('county-coverage', rows, page_size))
+
+    rows = [ table_row(html.escape(state['state']), format_number(state['customers']))
+        for state in provider_info.get('states-served', []) ]
+    body.append(render_table('state-coverage', rows, page_size))
+
+    return render_page(provider_info['company'], ''.join(body), page_size, render_delay)
+
+def render_state_page(state: str, provider_links: List[Dict], page_size: int = PAGE_SIZE,
+        render_delay: int = 0) -> str:
+    '''State homepage listing provider_links ({'company', 'path'}).'''
+    rows = [ table_row('<a href="{}">{}</a>'.format(link['path'], html.escape(link['company'])), '')
+        for link in provider_links ]
+
+    body = '<h1>Electricity providers in {}</h1>{}'.format(state,
+        render_table('electricity-providers', rows, page_size))
+
+    return render_page(state, body, page_size, render_delay)
+
+#### server ####
+
+def read_state_providers(state: str, directory: str = OUTPUT_DIR) -> List[Dict]:
+    with open('{}/{}-energy-utility-info.json'.format(directory, state), 'r') as rf:
+        providers = json.load(rf)
+
+    return providers['electrical-providers'] if isinstance(providers, dict) else providers
+
+def available_states(directory: str = OUTPUT_DIR) -> List[str]:
+    return sorted(name.split('-')[0] for name in os.listdir(directory)
+        if name.endswith('-energy-utility-info.json'))
+
+
+class StandInServer:
+    '''Serve stand-in state and provider pages on 127.0.0.1 from a background thread.
+
+    latency is added to every response (seconds) and render_delay to every
+    table redraw (milliseconds) to mimic the network and the site's scripts.
+    load_latency is added once more for every other request in flight,
+    requests over capacity a second get a 429 and error_rate of them a 500.
+    '''
+
+    def __init__(self, states: Optional[List[str]] = None, directory: str = OUTPUT_DIR,
+            port: int = 0, page_size: int = PAGE_SIZE, latency: float = 0.0,
+            render_delay: int = 0, load_latency: float = 0.0, capacity: Optional[float] = None,
+            error_rate: float = 0.0):
+        self.latency = latency
+        self.load_latency = load_latency
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.pages = {}         # path -> html
+        self.records = {}       # provider path -> record the page was rendered from
+        self.requests = 0
+        self.throttled = 0
+        self.failed = 0
+        self.in_flight = 0
+        self._served = deque()  # times of the requests served in the last second
+        self._lock = threading.Lock()
+
+        for state in states or available_states(directory):
+            links = []
+            for provider_info in read_state_providers(state, directory):
+                path = '/providers/{}/'.format(slug(provider_info['company']))
+                if path not in self.pages:
+                    self.pages[path] = render_provider_page(provider_info, page_size, render_delay)
+                    # older records have no website when the page had none
+                    self.records[path] = dict(provider_info, website=provider_info.get('website', ''))
+                links.append({ 'company': provider_info['company'], 'path': path })
+
+            self.pages['/{}'.format(state)] = render_state_page(state, links, page_size, render_delay)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self._thread = None
+
+    def _handler(self) -> type:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+                    server.in_flight += 1
+                    delay = server.latency + server.load_latency * (server.in_flight - 1)
+                    throttled = server._over_capacity()
+                    failed = not throttled and random.random() < server.error_rate
+                    if throttled:
+                        server.throttled += 1
+                    elif failed:
+                        server.failed += 1
+
+                try:
+                    if delay:
+                        time.sleep(delay)
+                    self.respond(throttled, failed)
+                finally:
+                    with server._lock:
+                        server.in_flight -= 1
+
+            def respond(self, throttled: bool, failed: bool) -> None:
+                if throttled:
+                    self.send_response(429)
+                    self.send_header('Retry-After', str(RETRY_AFTER))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if failed:
+                    self.send_error(500)
+                    return
+
+                page = server.pages.get(self.path.split('?')[0])
+                if page is None:
+                    self.send_error(404)
+                    return
+
+                body = page.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def _over_capacity(self) -> bool:
+        '''Whether a request arriving now is over capacity, counts it when it isn't.'''
+        if self.capacity is None:
+            return False
+
+        now = time.monotonic()
+        while self._served and now - self._served[0] >= 1:
+            self._served.popleft()
+        if len(self._served) >= self.capacity:
+            return True
+
+        self._served.append(now)
+        return False
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:{}/'.format(self._server.server_address[1])
+
+    def state_url(self, state: str) -> str:
+        return '{}{}'.format(self.url, state)
+
+    def provider_urls(self) -> List[str]:
+        return [ '{}{}'.format(self.url.rstrip('/'), path) for path in self.records ]
+
+    def record(self, url: str) -> Optional[Dict]:
+        '''Record a provider page was rendered from.'''
+        return self.records.get('/' + url.split('/', 3)[-1])
+
+    def start(self) -> 'StandInServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> 'StandInServer':
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Serve stand-in findenergy.com pages "
+        "rendered from {}/.".format(OUTPUT_DIR))
+    parser.add_argument('states', nargs='*', help="states to serve (default: all in {})".format(OUTPUT_DIR))
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0,
+        help="seconds added to every response (default: %(default)s)")
+    parser.add_argument('--load-latency', type=float, default=0.0,
+        help="seconds added to a response for every other request in flight (default: %(default)s)")
+    parser.add_argument('--capacity', type=float,
+        help="requests served a second, the ones over it get a 429 (default: no limit)")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+        help="share of the requests answered with a 500 (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    server = StandInServer([ state.upper() for state in args.states ], port=args.port,
+        latency=args.latency, load_latency=args.load_latency, capacity=args.capacity,
+        error_rate=args.error_rate)
+    print("Serving {} pages on {}".format(len(server.pages), server.url))
+
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,384 @@
+# Queryable SQLite store of the collected and scraped data.
+#
+# The merged JSON holds every state's populations, energy production, water
+#  systems and electrical providers in nested lists, so answering "which
+#  providers serve this city" means parsing and scanning all of it. This
+#  module loads the same data (the Collect_State_Info output and the provider
+#  files in OUTPUT_DIR) into normalized, indexed tables once, and UtilityStore
+#  answers lookups from the database in milliseconds.
+#
+#   python3 Utility_Store.py                          # (re)build the database
+#   python3 Utility_Store.py --city Albany --state NY
+#   python3 Utility_Store.py --county "Erie County" --state NY
+#   python3 Utility_Store.py --water-systems MA
+#
+# The EPA water system data has no county, water systems can be looked up by
+#  state, PWS ID or name.
+#
+# Some companies are listed in several states with a different record in each
+#  state's file (Kentucky Utilities in KY and VA, ...), so providers are keyed
+#  by a hash of their record and every state is linked to the record its own
+#  file held.
+#
+
+# Python standard libs
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+# local module
+from Scraper_Settings import STATES
+from Geo_Index import split_place
+from Json_Stream import iter_json_object
+from Merge_Json import get_input_filename, get_provider_files, read_providers
+
+STORE_FILE = "utility-info.sqlite"
+
+STATE_NAMES = { abrv: name for name, abrv in STATES.items() }
+
+# provider record keys that aren't numeric facts
+PROVIDER_FIELDS = ('company', 'company-type', 'website', 'service-types',
+    'cities-served', 'counties-served', 'states-served')
+
+SCHEMA = '''
+    CREATE TABLE states (
+        state           TEXT PRIMARY KEY,
+        name            TEXT NOT NULL,
+        estimate_2020   INTEGER,
+        estimate_2021   INTEGER
+    );
+    CREATE TABLE counties (
+        state           TEXT NOT NULL,
+        county          TEXT NOT NULL COLLATE NOCASE,
+        estimate_2020   INTEGER,
+        estimate_2021   INTEGER
+    );
+    CREATE TABLE cities (
+        state           TEXT NOT NULL,
+        city            TEXT NOT NULL COLLATE NOCASE,
+        estimate_2020   INTEGER,
+        estimate_2021   INTEGER
+    );
+    CREATE TABLE energy_production (
+        state           TEXT NOT NULL,
+        year            INTEGER NOT NULL,
+        source          TEXT NOT NULL,
+        mwh             REAL
+    );
+    CREATE TABLE water_systems (
+        pws_id          TEXT NOT NULL,
+        state           TEXT NOT NULL,
+        name            TEXT COLLATE NOCASE,
+        type            TEXT,
+        owner_type      TEXT,
+        primary_source  TEXT,
+        population_served INTEGER
+    );
+    CREATE TABLE providers (
+        provider_id     INTEGER PRIMARY KEY,
+        record_hash     TEXT NOT NULL UNIQUE,
+        company         TEXT NOT NULL COLLATE NOCASE,
+        company_type    TEXT,
+        website         TEXT,
+        service_types   TEXT,
+        record          TEXT NOT NULL
+    );
+    CREATE TABLE provider_facts (
+        provider_id     INTEGER NOT NULL REFERENCES providers,
+        fact            TEXT NOT NULL,
+        value           REAL
+    );
+    CREATE TABLE provider_states (
+        provider_id     INTEGER NOT NULL REFERENCES providers,
+        state           TEXT NOT NULL,
+        PRIMARY KEY (provider_id, state)
+    );
+    CREATE TABLE provider_states_served (
+        provider_id     INTEGER NOT NULL REFERENCES providers,
+        state           TEXT NOT NULL,
+        customers       INTEGER
+    );
+    CREATE TABLE provider_cities (
+        provider_id     INTEGER NOT NULL REFERENCES providers,
+        city            TEXT NOT NULL COLLATE NOCASE,
+        state           TEXT
+    );
+    CREATE TABLE provider_counties (
+        provider_id     INTEGER NOT NULL REFERENCES providers,
+        county          TEXT NOT NULL COLLATE NOCASE,
+        state           TEXT,
+        population      INTEGER
+    );
+'''
+
+# created after loading, building them once is faster than updating them per row
+INDEXES = '''
+    CREATE INDEX counties_state ON counties (state, county);
+    CREATE INDEX counties_county ON counties (county);
+    CREATE INDEX cities_state ON cities (state, city);
+    CREATE INDEX cities_city ON cities (city);
+    CREATE INDEX energy_production_state ON energy_production (state, year);
+    CREATE INDEX water_systems_state ON water_systems (state);
+    CREATE INDEX water_systems_pws_id ON water_systems (pws_id);
+    CREATE INDEX water_systems_name ON water_systems (name);
+    CREATE INDEX providers_company ON providers (company);
+    CREATE INDEX provider_facts_provider ON provider_facts (provider_id);
+    CREATE INDEX provider_states_state ON provider_states (state);
+    CREATE INDEX provider_states_served_provider ON provider_states_served (provider_id);
+    CREATE INDEX provider_cities_city ON provider_cities (city, state);
+    CREATE INDEX provider_cities_provider ON provider_cities (provider_id);
+    CREATE INDEX provider_counties_county ON provider_counties (county, state);
+    CREATE INDEX provider_counties_provider ON provider_counties (provider_id);
+'''
+
+
+#### building ####
+
+def insert_state(db: sqlite3.Connection, state: str, state_info: Dict) -> None:
+    '''Insert the Collect_State_Info data of one state.'''
+    population = state_info.get('population', {})
+    total = population.get('total', {})
+
+    db.execute("INSERT INTO states VALUES (?, ?, ?, ?)",
+        (state, STATE_NAMES.get(state, state), total.get('estimate-2020'),
+            total.get('estimate-2021')))
+
+    db.executemany("INSERT INTO counties VALUES (?, ?, ?, ?)",
+        [ (state, county['county'], county.get('estimate-2020'), county.get('estimate-2021'))
+            for county in population.get('counties', []) ])
+    db.executemany("INSERT INTO cities VALUES (?, ?, ?, ?)",
+        [ (state, city['name'], city.get('estimate-2020'), city.get('estimate-2021'))
+            for city in population.get('cities', []) ])
+
+    annual = state_info.get('energy-production', {}).get('annual', {})
+    db.executemany("INSERT INTO energy_production VALUES (?, ?, ?, ?)",
+        [ (state, int(year), source, mwh)
+            for year, production in annual.items() for source, mwh in production.items() ])
+
+    db.executemany("INSERT INTO water_systems VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [ (system['PWS-ID'], state, system['PWS-Name'], system['PWS-Type'],
+            system['Owner-Type'], system['Primary-Source'], system['Population-Served'])
+            for system in state_info.get('water-providers', []) ])
+
+def record_hash(provider_info: Dict) -> str:
+    '''Hash of a provider record, the same for equal records whatever their key order.'''
+    record = json.dumps(provider_info, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(record.encode('utf-8')).hexdigest()
+
+def insert_provider(db: sqlite3.Connection, state: str, provider_info: Dict) -> None:
+    '''Insert a provider listed on a state's page, once per distinct record however many states list it.'''
+    key = record_hash(provider_info)
+    row = db.execute("SELECT provider_id FROM providers WHERE record_hash = ?", (key,)).fetchone()
+
+    if row is None:
+        provider_id = db.execute('''
+            INSERT INTO providers (record_hash, company, company_type, website, service_types, record)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (key, provider_info['company'], provider_info.get('company-type'),
+            provider_info.get('website'), ", ".join(provider_info.get('service-types', [])),
+            json.dumps(provider_info))).lastrowid
+
+        db.executemany("INSERT INTO provider_facts VALUES (?, ?, ?)",
+            [ (provider_id, fact, value) for fact, value in provider_info.items()
+                if fact not in PROVIDER_FIELDS ])
+
+        states_served = provider_info.get('states-served', [])
+        db.executemany("INSERT INTO provider_states_served VALUES (?, ?, ?)",
+            [ (provider_id, STATES.get(served['state'], served['state']),
+                served.get('customers')) for served in states_served ])
+
+        # places without ", ST" belong to the state the provider serves, if only one
+        only_state = STATES.get(states_served[0]['state']) \
+            if len(states_served) == 1 else None
+
+        cities = []
+        for place in provider_info.get('cities-served', []):
+            city, city_state = split_place(place)
+            cities.append((provider_id, city, city_state or only_state))
+        db.executemany("INSERT INTO provider_cities VALUES (?, ?, ?)", cities)
+
+        counties = []
+        for county in provider_info.get('counties-served', []):
+            name, county_state = split_place(county['county'])
+            counties.append((provider_id, name, county_state or only_state,
+                county.get('population')))
+        db.executemany("INSERT INTO provider_counties VALUES (?, ?, ?, ?)", counties)
+    else:
+        provider_id = row[0]
+
+    db.execute("INSERT OR IGNORE INTO provider_states VALUES (?, ?)", (provider_id, state))
+
+def build_store(filename: str = STORE_FILE) -> int:
+    '''(Re)build the database from the collected data and OUTPUT_DIR.
+
+    Returns the number of states loaded.
+    '''
+    tmp_path = "{}.tmp".format(filename)
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    db = sqlite3.connect(tmp_path)
+    # nothing to recover if the build fails, the old database stays in place
+    db.execute("PRAGMA journal_mode = OFF")
+    db.execute("PRAGMA synchronous = OFF")
+    db.executescript(SCHEMA)
+
+    provider_files = get_provider_files()
+    count = 0
+
+    with db:
+        for state, state_info in iter_json_object(get_input_filename()):
+            insert_state(db, state, state_info)
+            if state in provider_files:
+                for provider_info in read_providers(provider_files[state]):
+                    insert_provider(db, state, provider_info)
+            count += 1
+
+        db.executescript(INDEXES)
+
+    db.execute("ANALYZE")
+    db.close()
+    os.replace(tmp_path, filename)
+
+    return count
+
+#### queries ####
+
+class UtilityStore:
+    '''Read only lookups in a database made by build_store().
+
+    Names are matched case insensitively, states are abbreviations.
+    '''
+
+    def __init__(self, filename: str = STORE_FILE):
+        self._db = sqlite3.connect("file:{}?mode=ro".format(filename), uri=True)
+        self._db.row_factory = sqlite3.Row
+
+    def _rows(self, query: str, params: Tuple = ()) -> List[Dict]:
+        return [ dict(row) for row in self._db.execute(query, params) ]
+
+    def provider(self, company: str, state: Optional[str] = None) -> List[Dict]:
+        '''The full scraped records of a provider, only the one in state's file with a state.
+
+        A company listed in several states can have a different record in each.
+        '''
+        rows = self._db.execute('''
+            SELECT p.record FROM providers p
+            WHERE p.company = ? AND (? IS NULL OR EXISTS (SELECT 1 FROM provider_states s
+                WHERE s.provider_id = p.provider_id AND s.state = ?))
+            ORDER BY p.provider_id
+        ''', (company, state, state))
+        return [ json.loads(row['record']) for row in rows ]
+
+    def providers_in_state(self, state: str) -> List[Dict]:
+        '''Providers listed on a state's page.'''
+        return self._rows('''
+            SELECT p.company, p.company_type, p.website, p.service_types
+            FROM provider_states s JOIN providers p USING (provider_id)
+            WHERE s.state = ? ORDER BY p.company
+        ''', (state,))
+
+    def providers_for_city(self, city: str, state: Optional[str] = None) -> List[Dict]:
+        '''Providers whose page lists city (e.g. "Albany" or "Adams CDP").'''
+        return self._rows('''
+            SELECT DISTINCT p.company, p.company_type, p.website, c.state
+            FROM provider_cities c JOIN providers p USING (provider_id)
+            WHERE c.city = ? AND (? IS NULL OR c.state = ?) ORDER BY p.company
+        ''', (city, state, state))
+
+    def providers_for_county(self, county: str, state: Optional[str] = None) -> List[Dict]:
+        '''Providers whose page lists county (e.g. "Erie County").'''
+        return self._rows('''
+            SELECT DISTINCT p.company, p.company_type, p.website, c.state, c.population
+            FROM provider_counties c JOIN providers p USING (provider_id)
+            WHERE c.county = ? AND (? IS NULL OR c.state = ?) ORDER BY p.company
+        ''', (county, state, state))
+
+    def cities_served(self, company: str, state: Optional[str] = None) -> List[Dict]:
+        '''Cities on the provider's page, the one listed in state's file with a state.'''
+        return self._rows('''
+            SELECT DISTINCT c.city, c.state FROM provider_cities c JOIN providers p USING (provider_id)
+            WHERE p.company = ? AND (? IS NULL OR EXISTS (SELECT 1 FROM provider_states s
+                WHERE s.provider_id = p.provider_id AND s.state = ?))
+        ''', (company, state, state))
+
+    def water_systems(self, state: str) -> List[Dict]:
+        '''Water systems of a state, largest population served first.'''
+        return self._rows('''
+            SELECT * FROM water_systems WHERE state = ? ORDER BY population_served DESC
+        ''', (state,))
+
+    def water_system(self, pws_id: str) -> List[Dict]:
+        return self._rows("SELECT * FROM water_systems WHERE pws_id = ?", (pws_id,))
+
+    def water_systems_named(self, name: str) -> List[Dict]:
+        return self._rows("SELECT * FROM water_systems WHERE name = ?", (name,))
+
+    def city_population(self, city: str, state: Optional[str] = None) -> List[Dict]:
+        '''Census estimates of cities (e.g. "Albany city") named city.'''
+        return self._rows('''
+            SELECT * FROM cities WHERE city = ? AND (? IS NULL OR state = ?)
+        ''', (city, state, state))
+
+    def county_population(self, county: str, state: Optional[str] = None) -> List[Dict]:
+        return self._rows('''
+            SELECT * FROM counties WHERE county = ? AND (? IS NULL OR state = ?)
+        ''', (county, state, state))
+
+    def energy_production(self, state: str, year: int) -> Dict[str, float]:
+        '''{energy source: MWh generated} of a state in year.'''
+        return { row['source']: row['mwh'] for row in self._db.execute('''
+            SELECT source, mwh FROM energy_production WHERE state = ? AND year = ?
+        ''', (state, year)) }
+
+    def close(self) -> None:
+        self._db.close()
+
+    def __enter__(self) -> 'UtilityStore':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Build or query {}.".format(STORE_FILE))
+    parser.add_argument('--database', default=STORE_FILE,
+        help="database file (default: %(default)s)")
+    parser.add_argument('--city', help="list the providers serving a city")
+    parser.add_argument('--county', help="list the providers serving a county")
+    parser.add_argument('--state', help="state abbreviation to narrow --city/--county down")
+    parser.add_argument('--water-systems', metavar='STATE', help="list a state's water systems")
+    args = parser.parse_args(argv)
+
+    if args.city is None and args.county is None and args.water_systems is None:
+        start = time.perf_counter()
+        count = build_store(args.database)
+        print("Loaded {} states into {} in {:.2f}s".format(count, args.database,
+            time.perf_counter() - start))
+        return 0
+
+    if not os.path.exists(args.database):
+        print("{} doesn't exist, build it first".format(args.database), file=sys.stderr)
+        return 1
+
+    with UtilityStore(args.database) as store:
+        if args.city is not None:
+            rows = store.providers_for_city(args.city, args.state)
+        elif args.county is not None:
+            rows = store.providers_for_county(args.county, args.state)
+        else:
+            rows = store.water_systems(args.water_systems.upper())
+
+    for row in rows:
+        print(json.dumps(row))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
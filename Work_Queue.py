@@ -0,0 +1,323 @@
+# Durable work queue for scraping with workers in several processes or hosts.
+#
+# The queue is a single sqlite file. The coordinator adds the states and the
+#  provider pages listed on each state page (see Scrape_Cluster.py), workers
+#  claim provider tasks and hand back the scraped records.
+#
+# A claimed task is leased to its worker for lease_seconds. The worker renews
+#  the lease while it is still busy with the page, if it dies (or its host
+#  does) the lease runs out and the task is queued again for the next claim.
+#  A result is only accepted from the worker holding the lease, so a worker
+#  that was too slow can't overwrite the record of the one that took over.
+#
+# Every change is a single transaction, sqlite's locking serializes the
+#  workers. Processes on one machine can share the file as is; workers on
+#  other hosts need it on a file system with working locks (not NFS), or run
+#  their processes on the machine holding the queue.
+#
+# The queue also records the settings every worker has to share, such as the
+#  field profile the coordinator was started with, so that one run can't
+#  mix full and cut down provider records in a state file.
+#
+
+# Python standard libs
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# local module
+from Json_Stream import json_default
+
+QUEUE_FILE = "work-queue.sqlite"
+
+DEFAULT_LEASE = 300         # seconds a worker holds a task before it is queued again
+DEFAULT_MAX_ATTEMPTS = 3    # claims of a task before it is marked failed
+
+# task status
+QUEUED = 'queued'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class LeasedTask:
+    '''A task claimed by a worker, see WorkQueue.claim().'''
+
+    def __init__(self, task_id: int, url: str, attempts: int, lease_expires: float):
+        self.id = task_id
+        self.url = url
+        self.attempts = attempts
+        self.lease_expires = lease_expires
+
+
+class WorkQueue:
+    '''Provider pages to scrape, leased to workers and collected per state.'''
+
+    def __init__(self, filepath: str = QUEUE_FILE, lease_seconds: float = DEFAULT_LEASE,
+            max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        self.filepath = filepath
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        directory = os.path.dirname(filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # autocommit, every change below runs in its own BEGIN IMMEDIATE transaction
+        self._db = sqlite3.connect(filepath, timeout=60, isolation_level=None,
+            check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS states (
+                state       TEXT PRIMARY KEY,
+                url         TEXT NOT NULL,
+                listed      INTEGER NOT NULL DEFAULT 0,
+                finished    INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS state_providers (
+                state       TEXT NOT NULL,
+                position    INTEGER NOT NULL,
+                url         TEXT NOT NULL,
+                PRIMARY KEY (state, position)
+            );
+            CREATE TABLE IF NOT EXISTS tasks (
+                id              INTEGER PRIMARY KEY,
+                url             TEXT NOT NULL UNIQUE,
+                status          TEXT NOT NULL,
+                worker          TEXT,
+                lease_expires   REAL,
+                attempts        INTEGER NOT NULL DEFAULT 0,
+                result          TEXT,
+                error           TEXT,
+                updated         REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS settings (
+                name        TEXT PRIMARY KEY,
+                value       TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, id);
+            CREATE INDEX IF NOT EXISTS state_providers_url ON state_providers (url);
+        ''')
+
+    def _transaction(self):
+        return _Transaction(self._db, self._lock)
+
+    #### settings ####
+
+    def set_setting(self, name: str, value: str) -> str:
+        '''Record a setting of the run, returns the value already recorded if there is one.'''
+        with self._transaction() as db:
+            db.execute("INSERT OR IGNORE INTO settings (name, value) VALUES (?, ?)", (name, value))
+            return db.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()[0]
+
+    def setting(self, name: str) -> Optional[str]:
+        '''A setting recorded by set_setting(), None if it wasn't yet.'''
+        with self._lock:
+            row = self._db.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
+
+        return row[0] if row is not None else None
+
+    #### coordinator ####
+
+    def add_state(self, state: str, url: str) -> None:
+        '''Add a state to collect, kept as is if it is already in the queue.'''
+        with self._transaction() as db:
+            db.execute("INSERT OR IGNORE INTO states (state, url) VALUES (?, ?)", (state, url))
+
+    def listed_states(self) -> List[str]:
+        '''States whose provider pages are already queued.'''
+        with self._lock:
+            return [ row[0] for row in self._db.execute(
+                "SELECT state FROM states WHERE listed = 1") ]
+
+    def add_providers(self, state: str, urls: List[str]) -> int:
+        '''Queue the provider pages listed on a state page, returns how many were new.
+
+        A page listed by several states is queued, and scraped, once.
+        '''
+        now = time.time()
+        with self._transaction() as db:
+            db.execute("DELETE FROM state_providers WHERE state = ?", (state,))
+            db.executemany("INSERT INTO state_providers (state, position, url) VALUES (?, ?, ?)",
+                [ (state, position, url) for position, url in enumerate(urls) ])
+            before = db.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+            db.executemany("INSERT OR IGNORE INTO tasks (url, status, updated) VALUES (?, ?, ?)",
+                [ (url, QUEUED, now) for url in urls ])
+            added = db.execute("SELECT COUNT(*) FROM tasks").fetchone()[0] - before
+            db.execute("UPDATE states SET listed = 1 WHERE state = ?", (state,))
+
+        return added
+
+    def requeue_expired(self) -> int:
+        '''Queue the tasks whose lease ran out again, returns how many.
+
+        A task that already used up its max_attempts claims is marked failed instead.
+        '''
+        now = time.time()
+        with self._transaction() as db:
+            failed = db.execute('''
+                UPDATE tasks SET status = ?, worker = NULL, lease_expires = NULL,
+                    error = 'lease expired', updated = ?
+                WHERE status = ? AND lease_expires < ? AND attempts >= ?
+            ''', (FAILED, now, LEASED, now, self.max_attempts)).rowcount
+            requeued = db.execute('''
+                UPDATE tasks SET status = ?, worker = NULL, lease_expires = NULL, updated = ?
+                WHERE status = ? AND lease_expires < ?
+            ''', (QUEUED, now, LEASED, now)).rowcount
+
+        return requeued + failed
+
+    def finished_states(self) -> Iterator[Tuple[str, Optional[List[Dict]]]]:
+        '''(state, providers) of every listed state not finished yet whose pages are all done.
+
+        providers is None when one of the state's pages failed.
+        '''
+        with self._lock:
+            rows = self._db.execute('''
+                SELECT s.state FROM states s
+                WHERE s.listed = 1 AND s.finished = 0 AND NOT EXISTS (
+                    SELECT 1 FROM state_providers p JOIN tasks t ON t.url = p.url
+                    WHERE p.state = s.state AND t.status IN (?, ?))
+                ORDER BY s.state
+            ''', (QUEUED, LEASED)).fetchall()
+
+        for (state,) in rows:
+            with self._lock:
+                results = self._db.execute('''
+                    SELECT t.status, t.result FROM state_providers p JOIN tasks t ON t.url = p.url
+                    WHERE p.state = ? ORDER BY p.position
+                ''', (state,)).fetchall()
+
+            if any(status != DONE for status, _ in results):
+                yield state, None
+            else:
+                yield state, [ json.loads(result) for _, result in results ]
+
+    def mark_finished(self, state: str) -> None:
+        '''Record that a state from finished_states() was written out (or given up on).'''
+        with self._transaction() as db:
+            db.execute("UPDATE states SET finished = 1 WHERE state = ?", (state,))
+
+    def is_complete(self) -> bool:
+        '''Whether there are states and every one of them is finished.'''
+        with self._lock:
+            total, finished = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(finished), 0) FROM states").fetchone()
+
+        return total > 0 and finished == total
+
+    def retry_failed(self) -> int:
+        '''Queue failed tasks again (and reopen their states), returns how many.'''
+        now = time.time()
+        with self._transaction() as db:
+            db.execute('''
+                UPDATE states SET finished = 0 WHERE state IN (
+                    SELECT p.state FROM state_providers p JOIN tasks t ON t.url = p.url
+                    WHERE t.status = ?)
+            ''', (FAILED,))
+            return db.execute('''
+                UPDATE tasks SET status = ?, attempts = 0, error = NULL, updated = ?
+                WHERE status = ?
+            ''', (QUEUED, now, FAILED)).rowcount
+
+    #### worker ####
+
+    def claim(self, worker: str) -> Optional[LeasedTask]:
+        '''Lease the next queued task (or one whose lease expired) to worker.'''
+        now = time.time()
+        expires = now + self.lease_seconds
+        with self._transaction() as db:
+            row = db.execute('''
+                SELECT id, url, attempts FROM tasks
+                WHERE status = ? OR (status = ? AND lease_expires < ? AND attempts < ?)
+                ORDER BY id LIMIT 1
+            ''', (QUEUED, LEASED, now, self.max_attempts)).fetchone()
+            if row is None:
+                return None
+
+            task_id, url, attempts = row
+            db.execute('''
+                UPDATE tasks SET status = ?, worker = ?, lease_expires = ?, attempts = ?, updated = ?
+                WHERE id = ?
+            ''', (LEASED, worker, expires, attempts + 1, now, task_id))
+
+        return LeasedTask(task_id, url, attempts + 1, expires)
+
+    def renew(self, task: LeasedTask, worker: str) -> bool:
+        '''Extend the lease of a task still being worked on, False if it was lost.'''
+        expires = time.time() + self.lease_seconds
+        with self._transaction() as db:
+            renewed = db.execute('''
+                UPDATE tasks SET lease_expires = ? WHERE id = ? AND status = ? AND worker = ?
+            ''', (expires, task.id, LEASED, worker)).rowcount == 1
+
+        if renewed:
+            task.lease_expires = expires
+        return renewed
+
+    def complete(self, task: LeasedTask, worker: str, result: Any) -> bool:
+        '''Store the result of a task, False if the worker no longer held its lease.'''
+        encoded = json.dumps(result, default=json_default)
+        with self._transaction() as db:
+            return db.execute('''
+                UPDATE tasks SET status = ?, result = ?, error = NULL, worker = NULL,
+                    lease_expires = NULL, updated = ?
+                WHERE id = ? AND status = ? AND worker = ?
+            ''', (DONE, encoded, time.time(), task.id, LEASED, worker)).rowcount == 1
+
+    def fail(self, task: LeasedTask, worker: str, error: str) -> None:
+        '''Give a task back after an error, it is marked failed after max_attempts.'''
+        status = FAILED if task.attempts >= self.max_attempts else QUEUED
+        with self._transaction() as db:
+            db.execute('''
+                UPDATE tasks SET status = ?, error = ?, worker = NULL, lease_expires = NULL,
+                    updated = ?
+                WHERE id = ? AND status = ? AND worker = ?
+            ''', (status, error, time.time(), task.id, LEASED, worker))
+
+    #### reporting ####
+
+    def counts(self) -> Dict[str, int]:
+        '''Number of tasks by status.'''
+        with self._lock:
+            counts = dict(self._db.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status"))
+
+        return { status: counts.get(status, 0) for status in (QUEUED, LEASED, DONE, FAILED) }
+
+    def failures(self) -> List[Tuple[str, str]]:
+        '''(url, error) of every failed task.'''
+        with self._lock:
+            return self._db.execute("SELECT url, error FROM tasks WHERE status = ?",
+                (FAILED,)).fetchall()
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+class _Transaction:
+    '''BEGIN IMMEDIATE ... COMMIT, rolled back if the block raises.'''
+
+    def __init__(self, db: sqlite3.Connection, lock: threading.Lock):
+        self._db = db
+        self._lock = lock
+
+    def __enter__(self) -> sqlite3.Connection:
+        self._lock.acquire()
+        try:
+            self._db.execute("BEGIN IMMEDIATE")
+        except Exception:
+            self._lock.release()
+            raise
+        return self._db
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        try:
+            self._db.execute("ROLLBACK" if exc_type is not None else "COMMIT")
+        finally:
+            self._lock.release()
@@ -1,41 +1,84 @@
-import os
-
-from Scrape_Electrical_Providers import *
-from Collect_State_Info import *
-
-# Used by webdriver_manager if not supplying path to driver
-# from webdriver_manager.firefox import GeckoDriverManager
-# webdriver_manager info:
+# Command line for the whole scraper.
 #
-# https://github.com/SergeyPirogov/webdriver_manager#use-with-chrome
-# 
+#   python3 utility-scraper.py [options]          # collect and scrape every state into all-states-info.json
+#   python3 utility-scraper.py collect [options]  # Collect_State_Info.py, the datasets only
+#   python3 utility-scraper.py scrape [options]   # Scrape_Electrical_Providers.py
+#   python3 utility-scraper.py merge [options]    # Merge_Json.py
+#   python3 utility-scraper.py cluster ...        # Scrape_Cluster.py
 #
-# Or to download the browser driver:
-#   https://www.selenium.dev/documentation/webdriver/getting_started/install_drivers/
+# Each command imports its module when it runs, so a merge doesn't load
+#  selenium and a scrape doesn't load pandas. `python3 utility-scraper.py
+#  <command> --help` lists the options of a command.
 #
-DRIVER_PATH = "./geckodriver" # replace with path to driver for your OS
 
-BASE_URL = "https://findenergy.com/"
+# Python standard libs
+import argparse
+import importlib
+import json
+import os
+import sys
+from typing import Dict, List, Optional
 
-# Dataset files
-DATASETS_DIRECTORY_PATH            = "datasets" 
-US_ENERGY_PRODUCTION_BY_STATE_FILE = "annual_generation_state.xls"
-US_POPULATION_BY_CITY_FILE         = "sub-est2021_all.csv"
-US_WATER_PROVIDERS_BY_STATE_FILE   = "Water System Detail.csv"
+# local module
+from Scraper_Settings import BASE_URL, DATASETS_DIRECTORY_PATH, FIREFOX_PATH, OUTPUT_DIR, STATES
+from Scraper_Settings import US_ENERGY_PRODUCTION_BY_STATE_FILE, US_POPULATION_BY_CITY_FILE
+from Scraper_Settings import US_WATER_PROVIDERS_BY_STATE_FILE
 
 # Outputs
-OUTPUT_DIR  = 'outputs'
 OUTPUT_FILE = "all-states-info.json"
 
-
-def main():
+# command -> (module with a main(argv), description)
+COMMANDS = {
+    'collect': ('Collect_State_Info', "population, energy production and water providers per state"),
+    'scrape': ('Scrape_Electrical_Providers', "electrical providers of every state into {}/".format(OUTPUT_DIR)),
+    'merge': ('Merge_Json', "merge the collected and scraped files into one"),
+    'cluster': ('Scrape_Cluster', "scrape with a coordinator and workers sharing a work queue"),
+}
+
+
+def run_all(argv: Optional[List[str]] = None) -> int:
+    '''Collect the datasets and scrape the providers of every state into OUTPUT_FILE.'''
+    import asyncio
+
+    from Async_Scraper import scrape_states_async
+    from Collect_State_Info import get_energy_production_df, get_population_df
+    from Collect_State_Info import get_water_provider_df, iter_all_state_info
+    from Driver_Manager import DriverManager
+    from Json_Stream import OrderedMergeWriter, json_default, open_json_writer
+    from Page_Cache import PageCache
+    from Provider_Page_Parser import get_http_client
+    from Rate_Control import configure, controllers_summary
+    from Scrape_Electrical_Providers import add_scrape_arguments, field_profile, get_driver
+    from Scrape_Electrical_Providers import set_field_profile
+    from Scrape_Journal import JournalError, ScrapeJournal
+    from Scrape_Trace import instrument_driver, start_trace, stop_trace
+    from Scraper_Pool import scrape_states
+
+    parser = argparse.ArgumentParser(description="Collect utility info for all 50 states.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="commands, see `%(prog)s <command> --help`:\n" + "\n".join(
+            "  {:10} {}".format(command, description) for command, (_, description) in COMMANDS.items()))
+    add_scrape_arguments(parser)
+    parser.add_argument('--jsonl', action='store_true',
+        help="write {} as JSON Lines, one state per line".format(OUTPUT_FILE))
+    args = parser.parse_args(argv)
+
+    set_field_profile(args.fields, args.top_rows)
+    configure(rate=args.rate, max_rate=args.max_rate)
+
+    # before the datasets are loaded, a journal that can't be used stops the run right away
+    try:
+        journal = ScrapeJournal(resume=args.resume, fresh=args.fresh, fields=field_profile())
+    except JournalError as err:
+        print(err, file=sys.stderr)
+        return 1
 
     # State energy production
     energy_production_file = "{}/{}".format(
         DATASETS_DIRECTORY_PATH, US_ENERGY_PRODUCTION_BY_STATE_FILE
     )
 
-    energy_production_df = get_excel_df(energy_production_file, header=1, skiprows=0)
+    energy_production_df = get_energy_production_df(energy_production_file)
     if energy_production_df is None: return 1
 
     # State water providers
@@ -43,7 +86,7 @@ def main():
         DATASETS_DIRECTORY_PATH, US_WATER_PROVIDERS_BY_STATE_FILE
     )
 
-    water_provider_df = get_csv_df(water_provider_file)
+    water_provider_df = get_water_provider_df(water_provider_file)
     if water_provider_df is None: return 1
 
     # State populations
@@ -51,42 +94,77 @@ def main():
         DATASETS_DIRECTORY_PATH, US_POPULATION_BY_CITY_FILE
     )
 
-    statewide_pop_df = get_csv_df(population_file)
-    if statewide_pop_df is None: return None
-
-    # combine energy, water, and population info
-    states_dict = {}
-    for state_name, state_abrev in STATES.items():
-        states_dict[state_abrev] = get_state_info(
-            state_name, state_abrev,
-            energy_production_df, water_provider_df, statewide_pop_df
-        )
-
-    # collect state electrical provider data
-    driver = get_driver('Firefox', DRIVER_PATH, ['--headless', '--no-sandbox' ])
-    if driver is None:
-        print("Not able to create webdriver object")
-        return 1
+    statewide_pop_df = get_population_df(population_file)
+    if statewide_pop_df is None: return 1
+
+    # combine energy, water, and population info, each state is built and
+    #  written to OUTPUT_FILE as soon as its providers are scraped
+    state_info = iter_all_state_info(
+        energy_production_df, water_provider_df, statewide_pop_df
+    )
+    output = OrderedMergeWriter(open_json_writer(OUTPUT_FILE, lines=args.jsonl),
+        state_info, list(STATES.values()), 'electrical-providers')
 
     # create directory for outputs if not already there
-    if not os.path.exists(OUTPUT_DIR) or not os.path.isdir(OUTPUT_FILE):
-        os.makedirs(OUTPUT_DIR)
-    
-    info = {}
-    for name, abrv in STATES.items():
-        urlQueryString = "{}{}".format(BASE_URL, abrv)
-        info[abrv] = scrape_state(driver, urlQueryString, abrv)
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-        states_dict[abrv]['electrical-providers'] = info[abrv]
+    def driver_factory():
+        return instrument_driver(get_driver('Firefox', FIREFOX_PATH, ['--headless', '--no-sandbox' ],
+            lightweight=not args.full_pages))
 
+    def on_state_done(abrv: str, providers: List[Dict]) -> None:
         with open('{}/{}-energy-utility-info.json'.format(OUTPUT_DIR, abrv), 'w') as wf:
-            json.dump(info[abrv], wf)
+            json.dump(providers, wf, default=json_default)
 
-    driver.close()
+        output.add(abrv, providers)
 
-    write_json(OUTPUT_FILE, states_dict)
+    # collect state electrical provider data, one browser session per worker
+    state_urls = {}
+    for name, abrv in STATES.items():
+        state_urls[abrv] = "{}{}".format(BASE_URL, abrv)
+
+    http_client = None if args.browser_only else get_http_client()
+    cache = None if args.no_cache else PageCache(ttl=args.cache_ttl * 24 * 60 * 60)
+    drivers = DriverManager(driver_factory, args.recycle_pages, args.recycle_mb,
+        args.command_timeout, args.prewarm)
+
+    if args.trace:
+        start_trace()
+
+    try:
+        if args.engine == 'async':
+            asyncio.run(scrape_states_async(driver_factory, state_urls, args.concurrency, args.rate,
+                on_state_done, http_client, cache, journal, drivers, args.max_rate))
+        else:
+            scrape_states(driver_factory, state_urls, args.workers, on_state_done, http_client, cache,
+                journal, drivers)
+    finally:
+        # states that failed are written without their providers
+        output.close()
+
+    for host, summary in controllers_summary().items():
+        print("Rate control {}: {}".format(host, summary))
+    if cache is not None:
+        print("Page cache: {}".format(cache.summary()))
+        cache.close()
+    journal.record_run_complete(state_urls)
+    journal.close()
+
+    if args.trace:
+        stop_trace(args.trace)
 
     return 0
 
+def main(argv: Optional[List[str]] = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+
+    # no command (or options first) runs everything, as before the commands
+    if not argv or argv[0] not in COMMANDS:
+        return run_all(argv)
+
+    module_name, _ = COMMANDS[argv[0]]
+    module = importlib.import_module(module_name)
+    return module.main(argv[1:])
+
 if __name__ == "__main__":
-    sys.exit(main())
\ No newline at end of file
+    sys.exit(main())